@@ -0,0 +1,46 @@
+"""
+Асинхронные соединения с Postgres и Redis для режима ASGI (asgi.py)
+
+Используются асинхронными обработчиками выдачи токенов
+(users_bp.users_async). Engine SQLAlchemy работает через драйвер
+asyncpg с той же базой и пулом тех же размеров, что и синхронный
+(Config.ASYNC_DATABASE_URI, Config.ASYNC_ENGINE_OPTIONS), клиент Redis -
+с теми же параметрами, что и jwt_redis. Как и в синхронном режиме,
+соединения создаются при первом обращении.
+"""
+
+from typing import Optional
+
+from metrics import InstrumentedAsyncRedis
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+
+class AsyncResources:
+    """Асинхронные engine, фабрика сессий и клиент Redis приложения"""
+
+    def __init__(self):
+        self.app = None
+        self.engine: Optional[AsyncEngine] = None
+        self.session: Optional[sessionmaker] = None
+        self.redis: Optional[InstrumentedAsyncRedis] = None
+
+    def init_app(self, app):
+        self.app = app
+        self.engine = create_async_engine(
+            app.config["ASYNC_DATABASE_URI"], **app.config["ASYNC_ENGINE_OPTIONS"]
+        )
+        # Объекты остаются доступны после завершения сессии: соединение
+        # возвращается в пул сразу после чтения
+        self.session = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.redis = InstrumentedAsyncRedis(**app.config["REDIS_OPTIONS"])
+
+    async def close(self):
+        """Закрыть соединения при остановке сервера"""
+        await self.redis.close()
+        await self.engine.dispose()
+
+
+aio = AsyncResources()
@@ -2,107 +2,72 @@
 Основной модуль
 """
 
-import logging
-import os
-import shutil
-import sys
-import time
-
-from auth_config import Config, db, engine, insp, jwt, jwt_redis, migrate_obj
-from db_models import Group, User
+from auth_config import Config, db, jwt, migrate_obj
+from bootstrap import bootstrap_command
 from flasgger import Swagger
 from flask import Flask
-from flask_migrate import init, migrate, upgrade
-
 from groups_bp.groups_bp import groups_bp
-from password_hash import check_password, hash_password
+from health_bp.health_bp import health_bp
+from history_partitions import history_cli
+from history_sink import history_sink
+from json_provider import json_provider
+from metrics import metrics
+from password_hash import hasher
+from revoked_filter import revoked_filter
+from schema_validation import schema_validation
+from signing_keys import keys_cli, signing_keys
+from sql_counter import sql_counter
+from sql_profiler import sql_profiler
 from test_bp.test_bp import test_bp
-from users_bp.users_bp import users_bp
+from tokens_bp.tokens_bp import tokens_bp
+from users_bp.users_bp import users_bp, users_import
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 BASE_PATH = "/v1"
 
 
-def db_initialize(app):
-    """
-    Первоначальная инициализация приложения авторизации
-
-    Инициализируем структуру таблиц, создаем группу
-    администраторов и одного пользователя, входящего
-    в нее, а также одного пользователя не входящего
-    ни в какие группы. Пароли пользователей берутся
-    из переменных окружения ADMIN_PASSWORD и
-    NOBODY_PASSWORD.
-
-    Эта функция предназначена для начальной инициализации
-    базы и уничтожит все имеющиеся данные в ней
-    """
-    with app.app_context():
-        # FIXME: удалить после добавления WSGI сервера
-        time.sleep(5)
-        try:
-            db.close_all_sessions()
-            db.drop_all()
-            if os.path.isdir(Config.MIGRATIONS_PATH):
-                shutil.rmtree(Config.MIGRATIONS_PATH)
-                engine.execute("DELETE FROM alembic_version")
-            init(Config.MIGRATIONS_PATH)
-            migrate(Config.MIGRATIONS_PATH)
-            upgrade(Config.MIGRATIONS_PATH)
-            # db.create_all()
-            admin_group = Group(name="admin", description="Administrators")
-            admin_user = User(
-                login="admin",
-                email="root@localhost",
-                password_hash="",
-                full_name="Site administrator",
-            )
-            regular_user = User(
-                login="nobody",
-                email="nobody@localhost",
-                password_hash="",
-                full_name="Regular user",
-            )
-            # Берем пароли из переменных окружения
-            admin_user.password = os.getenv("ADMIN_PASSWORD")
-            regular_user.password = os.getenv("NOBODY_PASSWORD")
-            db.session.add(admin_group)
-            db.session.add(admin_user)
-            db.session.add(regular_user)
-            db.session.commit()
-            # Только после первого коммита пользователь и группа получат
-            # автосгенерированные UUID
-            admin_group.users.append(admin_user)
-            db.session.add(admin_group)
-            db.session.commit()
-        except Exception as ex:
-            logging.error(f"we have a problem: {ex}")
-
-
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config())
+    if Config.PROXY_FIX_HOPS:
+        # За обратным прокси адрес клиента берется из X-Forwarded-For
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.PROXY_FIX_HOPS)
+    json_provider.init_app(app)
     app.register_blueprint(groups_bp, url_prefix=f"{BASE_PATH}/groups")
     app.register_blueprint(users_bp, url_prefix=f"{BASE_PATH}/users")
+    app.register_blueprint(tokens_bp, url_prefix=f"{BASE_PATH}/tokens")
     app.register_blueprint(test_bp, url_prefix="/test")
+    app.register_blueprint(health_bp)
+    # Префикс blueprint отделяет правило косой чертой, поэтому
+    # /v1/users:import регистрируется непосредственно в приложении
+    app.add_url_rule(
+        f"{BASE_PATH}/users:import", view_func=users_import, methods=["POST"]
+    )
+    # Публикация открытых ключей в JWKS, до инициализации Swagger
+    signing_keys.init_app(app)
     swagger = Swagger(app, template=Config.SWAGGER_TEMPLATE)
+    # Схемы компилируются один раз, когда все маршруты уже зарегистрированы
+    schema_validation.init_app(app)
+    # Соединения с базой и Redis создаются при первом обращении, схема
+    # и миграции готовятся отдельно командой flask bootstrap
     db.init_app(app)
-    # engine = db.create_engine(Config.SQLALCHEMY_DATABASE_URI, {})
-    engine.execute("CREATE SCHEMA IF NOT EXISTS auth;")
     jwt.init_app(app)
-    migrate_obj.init_app(app, db)
+    migrate_obj.init_app(app, db, directory=Config.MIGRATIONS_PATH)
+    history_sink.init_app(app)
+    hasher.init_app(app)
+    revoked_filter.init_app(app)
+    # Профилировщик подключается раньше счетчика запросов: его
+    # after_request выполняется последним, и EXPLAIN не попадает в счетчик
+    sql_profiler.init_app(app)
+    sql_counter.init_app(app)
+    metrics.init_app(app)
+    app.cli.add_command(history_cli)
+    app.cli.add_command(keys_cli)
+    app.cli.add_command(bootstrap_command)
 
     return app
 
 
 if __name__ == "__main__":
     app = create_app()
-
-    with app.app_context():
-        # При прогоне тестов удаляем прошлые данные из базы и создаем заново
-        if len(sys.argv) == 2 and sys.argv[1] == "--reinitialize":
-            db.drop_all()
-        # Инициалиазции базы. Проверяем наличие таблицы пользователей
-        if not insp.has_table("user", schema="auth"):
-            logging.info(f"initializing...")
-            db_initialize(app)
-        app.run(host="0.0.0.0")
+    app.run(host="0.0.0.0")
@@ -0,0 +1,37 @@
+"""
+Запуск приложения в асинхронном режиме (ASGI)
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+
+Выдача и отзыв токенов (login, refresh, logout из users_bp)
+обслуживаются асинхронными обработчиками users_bp.users_async, все
+остальные маршруты - тем же приложением Flask, что и в wsgi.py, в пуле
+из ASGI_WSGI_THREADS потоков.
+"""
+
+from a2wsgi import WSGIMiddleware
+from aio import aio
+from app import BASE_PATH, create_app
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from users_bp import users_async
+
+
+def create_asgi_app():
+    flask_app = create_app()
+    aio.init_app(flask_app)
+    return Starlette(
+        routes=[
+            *users_async.routes(f"{BASE_PATH}/users"),
+            Mount(
+                "/",
+                app=WSGIMiddleware(
+                    flask_app, workers=flask_app.config["ASGI_WSGI_THREADS"]
+                ),
+            ),
+        ],
+        on_shutdown=[aio.close],
+    )
+
+
+app = create_asgi_app()
@@ -1,21 +1,85 @@
 import os
 from datetime import timedelta
 
+from db_pool import TimedAsyncQueuePool, TimedQueuePool
+from db_routing import RoutingSQLAlchemy, replica_binds
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy, inspect
-
-import redis
+from metrics import InstrumentedRedis
 
 
 class Config:
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = f"postgresql+psycopg2://{os.getenv('DB_USERNAME')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Реплики для чтения: адреса через запятую в DB_REPLICA_URIS
+    SQLALCHEMY_BINDS = replica_binds(
+        [uri for uri in os.getenv("DB_REPLICA_URIS", "").split(",") if uri]
+    )
+    DB_REPLICA_RETRY_INTERVAL = float(os.getenv("DB_REPLICA_RETRY_INTERVAL", 30))
+    # Проверка отставания реплик: период, секунд (0 - не проверять), и
+    # наибольшее допустимое отставание, секунд
+    DB_REPLICA_PROBE_INTERVAL = float(os.getenv("DB_REPLICA_PROBE_INTERVAL", 5))
+    DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+    DB_READ_YOUR_WRITES_WINDOW = float(os.getenv("DB_READ_YOUR_WRITES_WINDOW", 5))
+    # Ограничение времени выполнения одного запроса, мс, и времени
+    # установки соединения, секунд
+    DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 30000))
+    DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))
+    # Единственный пул соединений приложения, размер пула в каждом рабочем
+    # процессе - DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW соединений
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_POOL_MAX_OVERFLOW", 5)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+        "connect_args": {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT}",
+            "connect_timeout": DB_CONNECT_TIMEOUT,
+        },
+    }
+    # Асинхронный режим (asgi.py): та же база через драйвер asyncpg, пул
+    # тех же размеров в каждом рабочем процессе
+    ASYNC_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace("+psycopg2", "+asyncpg", 1)
+    ASYNC_ENGINE_OPTIONS = {
+        **SQLALCHEMY_ENGINE_OPTIONS,
+        "poolclass": TimedAsyncQueuePool,
+        "connect_args": {
+            "server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT)},
+            "timeout": DB_CONNECT_TIMEOUT,
+        },
+    }
+    # Сколько потоков обслуживают синхронные маршруты Flask в режиме ASGI
+    ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", 10))
     JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=30)
     ACCESS_EXPIRES = timedelta(hours=1)
+    JWT_IDENTITY_CLAIM = "sub"
+    # Подпись токенов: RS256 или EdDSA - ключами из общего для всех
+    # процессов каталога JWT_KEYS_PATH с публикацией открытых ключей в
+    # JWKS, HS256 - общим секретом JWT_SECRET_KEY. Токены HS256 не
+    # проверяются ключами каталога: после перехода на RS256 или EdDSA
+    # пользователи входят заново
+    JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+    JWT_KEYS_PATH = os.getenv("JWT_KEYS_PATH", "keys")
+    JWT_KEYS_RELOAD_INTERVAL = float(os.getenv("JWT_KEYS_RELOAD_INTERVAL", 10))
+    # Сколько секунд другие сервисы кэшируют JWKS, и через сколько секунд
+    # после создания новый ключ начинает подписывать токены
+    JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", 300))
+    JWT_KEY_ACTIVATION_DELAY = float(
+        os.getenv("JWT_KEY_ACTIVATION_DELAY", JWKS_MAX_AGE)
+    )
+    # Сколько секунд процесс помнит номер поколения токенов пользователя
+    TOKEN_GENERATION_CACHE_TTL = float(os.getenv("TOKEN_GENERATION_CACHE_TTL", 5))
+    TOKEN_GENERATION_CACHE_SIZE = int(os.getenv("TOKEN_GENERATION_CACHE_SIZE", 100000))
+    # Локальный фильтр отозванных токенов: ожидаемое число отзывов
+    # за ACCESS_EXPIRES, доля ложных срабатываний и период синхронизации
+    REVOKED_FILTER_CAPACITY = int(os.getenv("REVOKED_FILTER_CAPACITY", 100000))
+    REVOKED_FILTER_ERROR_RATE = float(os.getenv("REVOKED_FILTER_ERROR_RATE", 0.001))
+    REVOKED_FILTER_SYNC_INTERVAL = float(os.getenv("REVOKED_FILTER_SYNC_INTERVAL", 1.0))
     SWAGGER_TEMPLATE = {
         "securityDefinitions": {
             "APIKeyHeader": {
@@ -26,19 +90,103 @@ class Config:
             }
         }
     }
-    MIGRATIONS_PATH = os.getenv("MIGRATIONS_PATH")
+    MIGRATIONS_PATH = os.getenv(
+        "MIGRATIONS_PATH", os.path.join(os.path.dirname(__file__), "migrations")
+    )
+    # Ожидание зависимостей командой flask bootstrap: число попыток,
+    # начальная и наибольшая пауза между ними, секунд
+    STARTUP_RETRY_ATTEMPTS = int(os.getenv("STARTUP_RETRY_ATTEMPTS", 10))
+    STARTUP_RETRY_BASE_DELAY = float(os.getenv("STARTUP_RETRY_BASE_DELAY", 0.5))
+    STARTUP_RETRY_MAX_DELAY = float(os.getenv("STARTUP_RETRY_MAX_DELAY", 10))
+    # Лимиты частоты запросов по маршрутам и измерениям: "<запросов>/<секунд>"
+    RATE_LIMITS = {
+        "login": {
+            "ip": os.getenv("RATE_LIMIT_LOGIN_IP", "30/60"),
+            "login": os.getenv("RATE_LIMIT_LOGIN_LOGIN", "10/60"),
+        },
+        "register": {
+            "ip": os.getenv("RATE_LIMIT_REGISTER_IP", "10/60"),
+        },
+    }
+    # Измерения, корзины которых списываются только при неудачной попытке
+    RATE_LIMITS_ON_FAILURE = {"login": ("login",)}
+    # Число доверенных обратных прокси перед приложением: адрес клиента
+    # берется из X-Forwarded-For (0 - приложение доступно напрямую)
+    PROXY_FIX_HOPS = int(os.getenv("PROXY_FIX_HOPS", 0))
+    # Общий секрет сервисов, вызывающих служебные маршруты (introspection)
+    # без токена администратора; пустое значение - только администраторы
+    SERVICE_SECRET = os.getenv("SERVICE_SECRET", "")
+    PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", 50))
+    PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", 1000))
+    # Возвращать число SQL запросов обработчика в заголовке X-SQL-Statements
+    SQL_COUNT_HEADER = os.getenv("SQL_COUNT_HEADER", "false").lower() == "true"
+    # Профилирование SQL: для всех запросов (SQL_PROFILE) или для доли
+    # запросов SQL_PROFILE_SAMPLE_RATE; порог медленного запроса, мс, и
+    # сколько повторов запроса одного вида считать признаком N+1
+    SQL_PROFILE = os.getenv("SQL_PROFILE", "false").lower() == "true"
+    SQL_PROFILE_SAMPLE_RATE = float(os.getenv("SQL_PROFILE_SAMPLE_RATE", 0))
+    SQL_PROFILE_SLOW_MS = float(os.getenv("SQL_PROFILE_SLOW_MS", 500))
+    SQL_PROFILE_REPEAT_THRESHOLD = int(os.getenv("SQL_PROFILE_REPEAT_THRESHOLD", 5))
+    # Наименьший промежуток между планами EXPLAIN медленных запросов, секунд
+    SQL_PROFILE_EXPLAIN_INTERVAL = float(os.getenv("SQL_PROFILE_EXPLAIN_INTERVAL", 60))
+    # Массовые операции: не более BULK_MAX_ITEMS записей в запросе,
+    # вставка пачками по BULK_CHUNK_SIZE строк
+    BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 100000))
+    BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+    # Сколько пользователей с открытым паролем можно импортировать одним
+    # запросом: остальным нужен готовый password_hash
+    BULK_MAX_PASSWORDS = int(os.getenv("BULK_MAX_PASSWORDS", 100))
+    # Сколько токенов можно проверить одним запросом introspect
+    INTROSPECT_MAX_TOKENS = int(os.getenv("INTROSPECT_MAX_TOKENS", 100))
+    # Сколько строк читать из базы за раз при потоковой выгрузке
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    # Кэш списка групп: как часто процесс сверяет версию списка с Redis
+    # и сколько секунд хранится в Redis каждая версия, секунд
+    GROUP_CATALOG_CHECK_INTERVAL = float(os.getenv("GROUP_CATALOG_CHECK_INTERVAL", 1))
+    GROUP_CATALOG_CACHE_TTL = int(os.getenv("GROUP_CATALOG_CACHE_TTL", 3600))
+    # Время жизни кэша членства в группах в Redis, секунд
+    MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", 300))
+    # Запись истории входов: async - пакетами в фоне, sync - в каждом запросе
+    HISTORY_SINK_MODE = os.getenv("HISTORY_SINK_MODE", "async")
+    HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 500))
+    HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 1.0))
+    HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", 10000))
+    # Сколько ждать места в переполненной очереди и сколько раз пытаться
+    # записать запись истории, прежде чем ее отбросить
+    HISTORY_PUT_TIMEOUT = float(os.getenv("HISTORY_PUT_TIMEOUT", 0.5))
+    HISTORY_WRITE_ATTEMPTS = int(os.getenv("HISTORY_WRITE_ATTEMPTS", 5))
+    # Секции истории по месяцам: сколько месяцев создавать заранее,
+    # сколько хранить и что делать со старыми (drop - удалять,
+    # detach - только отсоединять), за сколько последних дней
+    # пересчитывать дневную сводку
+    HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", 3))
+    HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", 12))
+    HISTORY_RETENTION_MODE = os.getenv("HISTORY_RETENTION_MODE", "drop")
+    HISTORY_ROLLUP_DAYS = int(os.getenv("HISTORY_ROLLUP_DAYS", 2))
+    # Наибольший период дневной сводки в ответе /history/daily, дней
+    HISTORY_DAILY_MAX_DAYS = int(os.getenv("HISTORY_DAILY_MAX_DAYS", 3660))
+    # Хэширование паролей: алгоритм (bcrypt, pbkdf2) и его стоимость,
+    # пустое значение стоимости - значение по умолчанию для алгоритма
+    PASSWORD_HASH_ALGORITHM = os.getenv("PASSWORD_HASH_ALGORITHM", "bcrypt")
+    PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", 0)) or None
+    PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count()))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 16))
+    PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", 1.0))
+    # Параметры соединения с Redis, общие для синхронного (jwt_redis) и
+    # асинхронного (aio) клиентов
+    REDIS_OPTIONS = {
+        "host": str(os.getenv("REDIS_AUTH_HOST")),
+        "port": int(os.getenv("REDIS_AUTH_PORT", 6379)),
+        "password": os.getenv("REDIS_AUTH_PASSWORD"),
+        "db": 0,
+        "decode_responses": True,
+        "socket_connect_timeout": float(os.getenv("REDIS_CONNECT_TIMEOUT", 2)),
+    }
 
 
-db = SQLAlchemy(session_options={"autoflush": False})
 migrate_obj = Migrate()
-engine = db.create_engine(Config.SQLALCHEMY_DATABASE_URI, {})
-insp = inspect(engine)
 
-jwt_redis = redis.Redis(
-    host=str(os.getenv("REDIS_AUTH_HOST")),
-    port=int(os.getenv("REDIS_AUTH_PORT", 6379)),
-    password=os.getenv("REDIS_AUTH_PASSWORD"),
-    db=0,
-    decode_responses=True,
-)
+jwt_redis = InstrumentedRedis(**Config.REDIS_OPTIONS)
+db = RoutingSQLAlchemy(session_options={"autoflush": False}, pin_redis=jwt_redis)
 jwt = JWTManager()
@@ -0,0 +1,8 @@
+"""
+Нагрузочные тесты и микробенчмарки сервиса авторизации
+
+Запускаются из каталога flask_app, например:
+    python -m benchmarks.password_hash_bench
+
+Дополнительные зависимости (fakeredis): benchmarks/requirements.txt
+"""
@@ -0,0 +1,328 @@
+"""
+Нагрузочный тест сценариев сервиса авторизации без docker-compose
+
+Приложение (create_app) работает в этом же процессе и обслуживает
+запросы тестового клиента Flask из --concurrency потоков. База -
+Postgres из переменных окружения DB_* (как у приложения), например
+временный контейнер:
+
+    docker run --rm -d -p 5432:5432 -e POSTGRES_PASSWORD=bench postgres:13
+
+Redis по умолчанию заменяется fakeredis в памяти процесса (--redis
+fake), с --redis env используется Redis из переменных REDIS_AUTH_*.
+База готовится командой flask bootstrap, после чего добавляются
+--users пользователей bench-NNNNN с паролем --password, входящих в
+группу bench (повторный запуск их не пересоздает).
+
+Сценарии: login, refresh (цепочка обновлений одного входа), logout,
+list_users (страница --page-size пользователей) и get_membership.
+Для каждого сценария выводятся число запросов в секунду, задержки
+p50/p95/p99 и среднее число SQL запросов на HTTP запрос (по заголовку
+X-SQL-Statements, см. sql_counter). Входы, которые нужны logout и
+refresh для получения токенов, в отчет не попадают, но занимают время
+прогона:
+
+    python -m benchmarks.auth_load_bench --concurrency 8 --output before.json
+
+Режим сравнения отмечает ухудшения второго прогона относительно
+первого: падение RPS или рост задержек больше чем на --threshold (доля)
+и любой рост числа SQL запросов. При ухудшениях код возврата 1:
+
+    python -m benchmarks.auth_load_bench --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+from benchmarks.stats import percentile
+
+SCENARIOS = ("login", "refresh", "logout", "list_users", "get_membership")
+BENCH_GROUP = "bench"
+BENCH_LOGIN = "bench-{number:05d}"
+
+
+def configure_environment(args):
+    """
+    Настройки приложения для теста. Config читает переменные окружения
+    при импорте auth_config, поэтому модули приложения импортируются
+    только после этого
+    """
+    os.environ["SQL_COUNT_HEADER"] = "true"
+    os.environ["PASSWORD_HASH_ROUNDS"] = str(args.password_rounds)
+    # Все входы идут с одного адреса, лимиты частоты не должны мешать
+    for name in ("RATE_LIMIT_LOGIN_IP", "RATE_LIMIT_LOGIN_LOGIN"):
+        os.environ[name] = "1000000000/1"
+
+
+def create_bench_app(args):
+    import auth_config
+    from app import create_app
+
+    if args.redis == "fake":
+        # fakeredis нужен только этому режиму
+        import fakeredis
+
+        auth_config.jwt_redis.connection_pool = fakeredis.FakeRedis(
+            server=fakeredis.FakeServer(), decode_responses=True
+        ).connection_pool
+    app = create_app()
+    result = app.test_cli_runner().invoke(args=["bootstrap"])
+    if result.exit_code != 0:
+        raise RuntimeError(f"flask bootstrap failed:\n{result.output}")
+    return app
+
+
+def seed(app, users: int, password: str) -> Dict[str, list]:
+    """
+    Создать недостающих пользователей bench-NNNNN и группу bench.
+    Возвращает логины и id пользователей и id группы
+    """
+    from auth_config import db
+    from db_models import Group, User, user_group
+    from membership_cache import set_members
+    from password_hash import hasher
+
+    logins = [BENCH_LOGIN.format(number=number) for number in range(users)]
+    with app.app_context():
+        group = Group.query.filter_by(name=BENCH_GROUP).one_or_none()
+        if group is None:
+            group = Group(name=BENCH_GROUP, description="Benchmark users")
+            db.session.add(group)
+        existing = {
+            login
+            for (login,) in db.session.query(User.login).filter(User.login.in_(logins))
+        }
+        # Хэш одинаковый для всех: пароль один, а хэширование медленное
+        password_hash = hasher.hash(password)
+        created = [
+            User(
+                login=login,
+                email=f"{login}@localhost",
+                full_name="Benchmark user",
+                password_hash=password_hash,
+            )
+            for login in logins
+            if login not in existing
+        ]
+        db.session.add_all(created)
+        db.session.flush()
+        if created:
+            db.session.execute(
+                user_group.insert(),
+                [{"user_id": user.id, "group_id": group.id} for user in created],
+            )
+        db.session.commit()
+        user_ids = [
+            str(user_id)
+            for (user_id,) in db.session.query(User.id)
+            .filter(User.login.in_(logins))
+            .order_by(User.login)
+        ]
+        # Кэш членства заполняется заранее, чтобы прогоны были сравнимы
+        # независимо от того, созданы пользователи сейчас или раньше
+        set_members(group.id, user_ids, True)
+        return {"logins": logins, "user_ids": user_ids, "group_id": str(group.id)}
+
+
+class Worker:
+    """Поток нагрузки со своим тестовым клиентом"""
+
+    def __init__(self, app, number: int, data: dict, args):
+        self.client = app.test_client()
+        self.number = number
+        self.data = data
+        self.args = args
+        self.iteration = 0
+        self.tokens = None
+        self.latencies: List[float] = []
+        self.statements: List[int] = []
+        self.errors = 0
+
+    def timed(self, method: str, url: str, **kwargs):
+        """Запрос, время и число SQL запросов которого попадают в отчет"""
+        started = time.perf_counter()
+        response = self.client.open(url, method=method, **kwargs)
+        self.latencies.append(time.perf_counter() - started)
+        self.statements.append(int(response.headers.get("X-SQL-Statements", 0)))
+        if response.status_code != 200:
+            self.errors += 1
+        return response
+
+    def untimed(self, method: str, url: str, **kwargs):
+        return self.client.open(url, method=method, **kwargs)
+
+    @property
+    def login_name(self) -> str:
+        logins = self.data["logins"]
+        return logins[(self.number + self.iteration) % len(logins)]
+
+    def login(self, timed: bool = True):
+        request = self.timed if timed else self.untimed
+        response = request(
+            "POST",
+            "/v1/users/login",
+            query_string={"login": self.login_name, "password": self.args.password},
+        )
+        return response.get_json() if response.status_code == 200 else None
+
+    @staticmethod
+    def bearer(token: str) -> dict:
+        return {"Authorization": f"Bearer {token}"}
+
+    def step_login(self):
+        self.login()
+
+    def step_refresh(self):
+        if self.tokens is None:
+            self.tokens = self.login(timed=False)
+            return
+        response = self.timed(
+            "POST",
+            "/v1/users/refresh",
+            headers=self.bearer(self.tokens["refresh_token"]),
+        )
+        self.tokens = response.get_json() if response.status_code == 200 else None
+
+    def step_logout(self):
+        tokens = self.login(timed=False)
+        if tokens is None:
+            self.errors += 1
+            return
+        self.timed(
+            "DELETE", "/v1/users/logout", headers=self.bearer(tokens["access_token"])
+        )
+
+    def step_list_users(self):
+        self.timed("GET", "/v1/users/", query_string={"page_size": self.args.page_size})
+
+    def step_get_membership(self):
+        user_ids = self.data["user_ids"]
+        user_id = user_ids[(self.number + self.iteration) % len(user_ids)]
+        self.timed("GET", f"/v1/groups/{self.data['group_id']}/user/{user_id}")
+
+    def run(self, step: Callable, deadline: float):
+        while time.perf_counter() < deadline:
+            step()
+            self.iteration += 1
+
+
+def run_scenario(app, scenario: str, data: dict, args) -> dict:
+    workers = [Worker(app, number, data, args) for number in range(args.concurrency)]
+
+    def run(duration: float):
+        deadline = time.perf_counter() + duration
+        threads = [
+            threading.Thread(
+                target=worker.run, args=(getattr(worker, f"step_{scenario}"), deadline)
+            )
+            for worker in workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    run(args.warmup)
+    for worker in workers:
+        worker.latencies.clear()
+        worker.statements.clear()
+        worker.errors = 0
+    started = time.perf_counter()
+    run(args.duration)
+    elapsed = time.perf_counter() - started
+    latencies = [value for worker in workers for value in worker.latencies]
+    statements = [value for worker in workers for value in worker.statements]
+    return {
+        "requests": len(latencies),
+        "errors": sum(worker.errors for worker in workers),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "queries_per_request": round(sum(statements) / max(len(statements), 1), 2),
+    }
+
+
+def compare(base: dict, new: dict, threshold: float) -> dict:
+    """Сравнить сценарии двух отчетов и найти ухудшения"""
+    regressions = []
+    scenarios = defaultdict(dict)
+    for (name, before) in base["scenarios"].items():
+        after = new["scenarios"].get(name)
+        if after is None:
+            continue
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "queries_per_request"):
+            change = 0.0
+            if before[metric]:
+                change = (after[metric] - before[metric]) / before[metric]
+            scenarios[name][metric] = {
+                "before": before[metric],
+                "after": after[metric],
+                "change": round(change, 3),
+            }
+            if metric == "rps":
+                regressed = change < -threshold
+            elif metric == "queries_per_request":
+                regressed = after[metric] > before[metric]
+            else:
+                regressed = change > threshold
+            if regressed:
+                regressions.append(f"{name}.{metric}")
+    return {"threshold": threshold, "scenarios": scenarios, "regressions": regressions}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--redis", choices=("fake", "env"), default="fake")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--password-rounds", type=int, default=4)
+    parser.add_argument("--output", help="сохранить отчет в файл")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"))
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        result = compare(*reports, args.threshold)
+        print(json.dumps(result, indent=2))
+        sys.exit(1 if result["regressions"] else 0)
+
+    configure_environment(args)
+    app = create_bench_app(args)
+    data = seed(app, args.users, args.password)
+    report = {
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "redis": args.redis,
+        "users": args.users,
+        "scenarios": {
+            scenario: run_scenario(app, scenario, data, args)
+            for scenario in args.scenarios
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Микробенчмарк сериализации ответов API
+
+Строит ответы list_users и истории входов из --rows записей и
+измеряет, сколько раз в секунду jsonify сериализует их стандартным
+кодировщиком Flask и через orjson (OrjsonEncoder).
+
+    python -m benchmarks.json_bench --rows 10000
+"""
+
+import argparse
+import datetime
+import json
+import time
+import uuid
+from types import SimpleNamespace
+
+from db_models import History, User
+from flask import Flask
+from flask.json import JSONEncoder, jsonify
+from json_provider import OrjsonEncoder
+
+
+def users_payload(rows: int) -> list:
+    return [
+        User.row_to_json(
+            SimpleNamespace(
+                id=uuid.uuid4(), login=f"user-{i}", email=f"user-{i}@localhost"
+            )
+        )
+        for i in range(rows)
+    ]
+
+
+def history_payload(rows: int) -> list:
+    user_id = uuid.uuid4()
+    now = datetime.datetime.utcnow()
+    return [
+        History(
+            id=uuid.uuid4(),
+            user_id=user_id,
+            useragent="Mozilla/5.0 (X11; Linux x86_64)",
+            timestamp=now - datetime.timedelta(minutes=i),
+        ).to_json()
+        for i in range(rows)
+    ]
+
+
+def measure(app: Flask, payload: list, duration: float) -> float:
+    """Сколько ответов jsonify в секунду удается построить за duration"""
+    count = 0
+    with app.app_context():
+        started = time.perf_counter()
+        while True:
+            jsonify(payload)
+            count += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= duration:
+                return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    payloads = {
+        "list_users": users_payload(args.rows),
+        "history": history_payload(args.rows),
+    }
+    encoders = {"stdlib": JSONEncoder, "orjson": OrjsonEncoder}
+    report = []
+    for (name, payload) in payloads.items():
+        result = {"payload": name, "rows": args.rows}
+        for (encoder_name, encoder) in encoders.items():
+            app = Flask(__name__)
+            app.json_encoder = encoder
+            result[f"{encoder_name}_per_sec"] = round(
+                measure(app, payload, args.duration), 2
+            )
+        result["speedup"] = round(
+            result["orjson_per_sec"] / result["stdlib_per_sec"], 2
+        )
+        report.append(result)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Микробенчмарк проверки паролей
+
+Для каждого алгоритма хэширования измеряет число проверок пароля
+в секунду на одно ядро (в одном потоке) и суммарно через пул
+PasswordHasher с заданным числом исполнителей.
+
+    python -m benchmarks.password_hash_bench --algorithm bcrypt:12 pbkdf2
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from password_hash import ALGORITHMS, PasswordHasher
+
+PASSWORD = "correct horse battery staple"
+
+
+def parse_algorithm(value: str):
+    """Разобрать строку вида <алгоритм>[:<стоимость>]"""
+    name, _, rounds = value.partition(":")
+    if name not in ALGORITHMS:
+        raise argparse.ArgumentTypeError(f"unknown algorithm {name}")
+    return name, int(rounds) if rounds else ALGORITHMS[name].default_rounds
+
+
+def measure(fn, duration: float) -> float:
+    """Сколько раз в секунду удается выполнить fn за время duration"""
+    count = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def measure_pool(hasher: PasswordHasher, hashed: str, duration: float) -> float:
+    """Суммарная пропускная способность пула при полной загрузке"""
+    deadline = time.perf_counter() + duration
+
+    def client():
+        done = 0
+        while time.perf_counter() < deadline:
+            hasher.verify(PASSWORD, hashed)
+            done += 1
+        return done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(hasher.workers) as clients:
+        total = sum(clients.map(lambda _: client(), range(hasher.workers)))
+    return total / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--algorithm",
+        nargs="+",
+        type=parse_algorithm,
+        default=[(name, a.default_rounds) for (name, a) in ALGORITHMS.items()],
+        help="алгоритмы в виде <алгоритм>[:<стоимость>]",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    report = []
+    for (name, rounds) in args.algorithm:
+        hasher = PasswordHasher(
+            name,
+            rounds,
+            workers=args.workers,
+            queue_size=args.workers,
+            queue_timeout=60,
+            executor=args.executor,
+        )
+        hashed = ALGORITHMS[name].hash(PASSWORD, rounds)
+        per_core = measure(
+            lambda: ALGORITHMS[name].verify(PASSWORD, hashed), args.duration
+        )
+        pooled = measure_pool(hasher, hashed, args.duration)
+        report.append(
+            {
+                "algorithm": name,
+                "rounds": rounds,
+                "verify_per_sec_per_core": round(per_core, 2),
+                "verify_per_sec_pool": round(pooled, 2),
+                "workers": args.workers,
+                "executor": args.executor,
+            }
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
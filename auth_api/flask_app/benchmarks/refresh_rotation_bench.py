@@ -0,0 +1,121 @@
+"""
+Бенчмарк ротации refresh токенов
+
+Измеряет число обновлений в секунду и число обращений к Redis на одно
+обновление для Lua скрипта из refresh_families и, для сравнения, для
+той же логики на WATCH/MULTI. Обращения считаются по числу отправок
+команд в соединение: конвейер из нескольких команд - одно обращение.
+
+    python -m benchmarks.refresh_rotation_bench --redis-url redis://localhost:6379/0
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from refresh_families import FAMILY_KEY, ROTATE_SCRIPT
+
+
+class CountingConnection(redis.Connection):
+    """Соединение, подсчитывающее обращения к серверу"""
+
+    round_trips = 0
+    _lock = threading.Lock()
+
+    def send_packed_command(self, command, check_health=True):
+        with CountingConnection._lock:
+            CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def rotate_watch(client, key, old_jti, new_jti, ttl):
+    """Ротация через оптимистичную транзакцию WATCH/MULTI"""
+    with client.pipeline() as pipe:
+        pipe.watch(key)
+        current = pipe.hget(key, "jti")
+        if current is None:
+            return 0
+        pipe.multi()
+        if current != old_jti:
+            pipe.delete(key)
+            pipe.execute()
+            return -1
+        pipe.hset(key, "jti", new_jti)
+        pipe.expire(key, ttl)
+        pipe.execute()
+        return 1
+
+
+def run(client, rotate_fn, families: int, rounds: int, threads: int):
+    """Провести rounds обновлений для каждого из families семейств"""
+    keys = [FAMILY_KEY.format(family_id=uuid.uuid4()) for _ in range(families)]
+    current = {}
+    for key in keys:
+        current[key] = str(uuid.uuid4())
+        client.hset(key, mapping={"jti": current[key], "user_id": "bench"})
+
+    def chain(key):
+        for _ in range(rounds):
+            new_jti = str(uuid.uuid4())
+            assert rotate_fn(key, current[key], new_jti) == 1
+            current[key] = new_jti
+
+    CountingConnection.round_trips = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(chain, keys))
+    elapsed = time.perf_counter() - started
+    trips = CountingConnection.round_trips
+    client.delete(*keys)
+    total = families * rounds
+    return {
+        "refreshes": total,
+        "refresh_per_sec": round(total / elapsed, 1),
+        "round_trips_per_refresh": round(trips / total, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--redis-url",
+        default=(
+            f"redis://:{os.getenv('REDIS_AUTH_PASSWORD', '')}@"
+            f"{os.getenv('REDIS_AUTH_HOST', 'localhost')}:"
+            f"{os.getenv('REDIS_AUTH_PORT', 6379)}/0"
+        ),
+    )
+    parser.add_argument("--families", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(
+        args.redis_url, connection_class=CountingConnection, decode_responses=True
+    )
+    client = redis.Redis(connection_pool=pool)
+    script = client.register_script(ROTATE_SCRIPT)
+    ttl = 3600
+
+    def rotate_lua(key, old_jti, new_jti):
+        return script(keys=[key], args=[old_jti, new_jti, ttl])
+
+    def rotate_tx(key, old_jti, new_jti):
+        return rotate_watch(client, key, old_jti, new_jti, ttl)
+
+    # Первый вызов загружает скрипт на сервер (EVALSHA -> EVAL)
+    rotate_lua(FAMILY_KEY.format(family_id="warmup"), "", "")
+    report = {
+        "lua": run(client, rotate_lua, args.families, args.rounds, args.threads),
+        "watch_multi": run(client, rotate_tx, args.families, args.rounds, args.threads),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
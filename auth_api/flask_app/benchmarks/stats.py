@@ -0,0 +1,11 @@
+"""
+Общие расчеты для отчетов нагрузочных тестов
+"""
+
+from typing import List
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (доля от 0 до 1) значений values, 0 для пустого списка"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
@@ -0,0 +1,317 @@
+"""
+Нагрузочный тест выдачи токенов: синхронный (wsgi.py) и асинхронный
+(asgi.py) режимы при одинаковом объеме памяти
+
+Для каждого режима запускается сервер на локальном порту с базой и
+Redis из переменных окружения (как у приложения), и concurrency
+клиентов в течение duration секунд повторяют сценарий login ->
+refresh -> logout. Сравниваются число запросов в секунду и задержки
+(p50, p99) по каждому маршруту.
+
+Память уравнивается так: сервер каждого режима сначала запускается с
+одним и с двумя рабочими процессами и после прогрева измеряется его
+RSS (вместе с дочерними процессами). По этим замерам число рабочих
+процессов выбирается так, чтобы уложиться в --memory-mb, и измерение
+повторяется. RSS во время измерения тоже попадает в отчет.
+
+    python -m benchmarks.token_load_bench --memory-mb 600 --concurrency 64
+
+Лимиты частоты входов на время теста снимаются, стоимость хэширования
+паролей задается --password-rounds (по умолчанию минимальная для
+bcrypt), чтобы сравнивались ожидания ввода-вывода, а не bcrypt.
+Пользователь --login должен существовать (см. flask bootstrap).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from benchmarks.stats import percentile
+
+FLASK_APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "sync": [
+        "uwsgi",
+        "--http11-socket",
+        "127.0.0.1:{port}",
+        "--master",
+        "--processes",
+        "{workers}",
+        "--threads",
+        "{threads}",
+        "--wsgi-file",
+        "wsgi.py",
+        "--callable",
+        "app",
+        "--lazy-apps",
+        "--die-on-term",
+        "--disable-logging",
+    ],
+    "async": [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "asgi:app",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        "{port}",
+        "--workers",
+        "{workers}",
+        "--no-access-log",
+        "--log-level",
+        "warning",
+    ],
+}
+
+
+class HttpConnection:
+    """Соединение HTTP/1.1 с keep-alive для клиента нагрузки"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(
+        self, method: str, path: str, token: Optional[str] = None
+    ) -> Tuple[int, bytes]:
+        if self.writer is None:
+            (self.reader, self.writer) = await asyncio.open_connection(
+                self.host, self.port
+            )
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: 0\r\n"
+        if token:
+            head += f"Authorization: Bearer {token}\r\n"
+        self.writer.write((head + "\r\n").encode("latin-1"))
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _, value) = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def client(port: int, login: str, password: str, deadline: float, samples: Dict):
+    """Повторять сценарий login -> refresh -> logout до deadline"""
+    conn = HttpConnection("127.0.0.1", port)
+
+    async def call(name, method, path, token=None) -> Optional[dict]:
+        started = time.perf_counter()
+        try:
+            (status, body) = await conn.request(method, path, token)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            conn.close()
+            status, body = 0, b""
+        samples[name].append(time.perf_counter() - started)
+        if status != 200:
+            samples["errors"].append(status)
+            return None
+        return json.loads(body)
+
+    try:
+        while time.perf_counter() < deadline:
+            tokens = await call(
+                "login", "POST", f"/v1/users/login?login={login}&password={password}"
+            )
+            if tokens is None:
+                continue
+            tokens = await call(
+                "refresh", "POST", "/v1/users/refresh", tokens["refresh_token"]
+            )
+            if tokens is None:
+                continue
+            await call("logout", "DELETE", "/v1/users/logout", tokens["access_token"])
+    finally:
+        conn.close()
+
+
+async def load(args, port: int, duration: float) -> Tuple[Dict[str, list], float]:
+    samples = defaultdict(list)
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(
+        *(
+            client(port, args.login, args.password, deadline, samples)
+            for _ in range(args.concurrency)
+        )
+    )
+    return samples, time.perf_counter() - started
+
+
+def rss_mb(pid: int) -> float:
+    """RSS процесса pid и всех его потомков, МБ"""
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Имя процесса в скобках может содержать пробелы
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(entry))
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+def start_server(mode: str, args, workers: int) -> subprocess.Popen:
+    command = [
+        part.format(port=args.port, workers=workers, threads=args.threads)
+        for part in SERVERS[mode]
+    ]
+    env = {
+        **os.environ,
+        "RATE_LIMIT_LOGIN_IP": "1000000000/1",
+        "RATE_LIMIT_LOGIN_LOGIN": "1000000000/1",
+        "PASSWORD_HASH_ROUNDS": str(args.password_rounds),
+    }
+    process = subprocess.Popen(
+        command, cwd=FLASK_APP_PATH, env=env, start_new_session=True
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            status = asyncio.run(
+                HttpConnection("127.0.0.1", args.port).request("GET", "/healthz")
+            )[0]
+            if status == 200:
+                return process
+        except OSError:
+            pass
+        if process.poll() is not None:
+            break
+        time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"{mode} server did not start: {' '.join(command)}")
+
+
+def stop_server(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def measure(mode: str, args, workers: int) -> dict:
+    process = start_server(mode, args, workers)
+    try:
+        asyncio.run(load(args, args.port, args.warmup))
+        (samples, elapsed) = asyncio.run(load(args, args.port, args.duration))
+        rss = rss_mb(process.pid)
+    finally:
+        stop_server(process)
+    errors = samples.pop("errors", [])
+    latencies = [value for values in samples.values() for value in values]
+    return {
+        "workers": workers,
+        "rss_mb": round(rss, 1),
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "endpoints": {
+            name: {
+                "requests": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            }
+            for (name, values) in samples.items()
+        },
+    }
+
+
+def warm_rss(mode: str, args, workers: int) -> float:
+    process = start_server(mode, args, workers)
+    try:
+        asyncio.run(load(args, args.port, args.warmup))
+        return rss_mb(process.pid)
+    finally:
+        stop_server(process)
+
+
+def workers_for_budget(mode: str, args) -> int:
+    """
+    Число рабочих процессов, при котором сервер укладывается в
+    --memory-mb. Память управляющего процесса (master uwsgi, supervisor
+    uvicorn) и одного рабочего процесса оцениваются по прогревочным
+    запускам с одним и двумя рабочими процессами
+    """
+    one = warm_rss(mode, args, 1)
+    two = warm_rss(mode, args, 2)
+    per_worker = max(two - one, 1.0)
+    base = max(two - 2 * per_worker, 0.0)
+    return max(1, int((args.memory_mb - base) // per_worker))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"])
+    parser.add_argument("--memory-mb", type=float, default=600)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--threads", type=int, default=4, help="потоков uwsgi")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--login", default="nobody")
+    parser.add_argument("--password", default=os.getenv("NOBODY_PASSWORD"))
+    parser.add_argument("--password-rounds", type=int, default=4)
+    args = parser.parse_args()
+
+    report = {
+        "memory_mb": args.memory_mb,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+    }
+    for mode in args.modes:
+        report[mode] = measure(mode, args, workers_for_budget(mode, args))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Микробенчмарк проверки тела запроса регистрации
+
+Сравнивает, сколько раз в секунду проверяется тело запроса
+/register так, как это делал flasgger (swag_from с validation=True:
+разбор YAML файла схемы и jsonschema при каждом вызове), и
+скомпилированной при старте приложения проверкой schema_validation.
+
+    python -m benchmarks.validation_bench
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Callable
+
+from flasgger.utils import validate
+from flask import Flask
+from schema_validation import SCHEMES_PATH, schema_validation
+
+SCHEME = "user_register.yaml"
+
+PAYLOAD = {
+    "login": "user",
+    "email": "user@localhost",
+    "password": "password",
+    "full_name": "User",
+    "phone": "+70000000000",
+}
+
+
+def measure(check: Callable, duration: float) -> float:
+    """Сколько проверок в секунду удается выполнить за duration"""
+    count = 0
+    started = time.perf_counter()
+    while True:
+        check()
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    filepath = os.path.join(SCHEMES_PATH, SCHEME)
+    schema_validation.load()
+    validator = schema_validation.validators[SCHEME]
+    checks = {
+        "flasgger": lambda: validate(PAYLOAD, "User", filepath=filepath),
+        "compiled": lambda: validator(PAYLOAD),
+    }
+    result = {"scheme": SCHEME}
+    # flasgger обращается к текущему запросу и его обработчику
+    app = Flask(__name__)
+    app.add_url_rule("/register", "register", methods=["POST"])
+    with app.test_request_context("/register", method="POST"):
+        for (name, check) in checks.items():
+            result[f"{name}_per_sec"] = round(measure(check, args.duration), 2)
+    result["speedup"] = round(
+        result["compiled_per_sec"] / result["flasgger_per_sec"], 2
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
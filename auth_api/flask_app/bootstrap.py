@@ -0,0 +1,152 @@
+"""
+Подготовка базы к работе: flask bootstrap
+
+Выполняется один раз перед запуском (или обновлением) серверов
+приложения отдельной командой, а не при старте каждого рабочего
+процесса: процессы при запуске не обращаются ни к Postgres, ни к
+Redis и готовы принимать запросы сразу, а о доступности зависимостей
+сообщает /readyz.
+
+Команда дожидается Postgres (ограниченное число попыток с
+экспоненциальной паузой и jitter, см. retry), создает схему auth,
+применяет миграции из MIGRATIONS_PATH, создает секции истории
+входов и, если их еще нет, группу администраторов и пользователей
+admin и nobody. Пароли пользователей берутся из переменных окружения
+ADMIN_PASSWORD и NOBODY_PASSWORD. Повторный запуск ничего не меняет,
+поэтому команду можно выполнять при каждом развертывании.
+
+Ранние развертывания создавали схему собственной автосгенерированной
+миграцией, ревизии которой нет в MIGRATIONS_PATH, и upgrade на такой
+базе завершался ошибкой. Если таблица auth.user уже есть, а записанная
+в alembic_version ревизия неизвестна (или не записана вовсе), база
+отмечается первой миграцией BASE_REVISION, и применяются только
+последующие.
+
+С флагом --reinitialize все данные предварительно удаляются (для
+прогона тестов).
+"""
+
+import datetime
+import os
+
+import click
+from alembic import command
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from auth_config import Config, db
+from db_models import Group, User
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_migrate import upgrade
+from history_partitions import ensure_partitions
+from retry import retry
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# Первая миграция, схема которой совпадает со схемой ранних развертываний
+BASE_REVISION = "c9179e686cbe"
+
+
+def wait_for(operation, exceptions, description: str):
+    """Выполнить operation с повторами по настройкам STARTUP_RETRY_*"""
+    return retry(
+        operation,
+        exceptions,
+        attempts=Config.STARTUP_RETRY_ATTEMPTS,
+        base_delay=Config.STARTUP_RETRY_BASE_DELAY,
+        max_delay=Config.STARTUP_RETRY_MAX_DELAY,
+        description=description,
+    )
+
+
+def ping_database():
+    with db.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+def drop_database():
+    """Удалить все данные приложения вместе с версией миграций"""
+    db.session.close()
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS auth CASCADE"))
+        conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
+
+
+def stamp_unknown_revision():
+    """
+    Отметить первой миграцией базу, созданную до появления миграций в
+    MIGRATIONS_PATH: таблица auth.user есть, а ревизия в alembic_version
+    неизвестна или отсутствует
+    """
+    config = current_app.extensions["migrate"].migrate.get_config(
+        Config.MIGRATIONS_PATH
+    )
+    known = {
+        script.revision
+        for script in ScriptDirectory.from_config(config).walk_revisions()
+    }
+    with db.engine.connect() as conn:
+        if not conn.execute(text("SELECT to_regclass('auth.user')")).scalar():
+            return
+        current = MigrationContext.configure(conn).get_current_heads()
+    if current and set(current) <= known:
+        return
+    click.echo(
+        f"unknown migration revision {', '.join(current) or 'none'}, "
+        f"stamping {BASE_REVISION}"
+    )
+    command.stamp(config, BASE_REVISION, purge=True)
+
+
+def get_or_create_user(login: str, email: str, full_name: str, password: str):
+    user = User.query.filter_by(login=login).one_or_none()
+    if user is None:
+        user = User(login=login, email=email, password_hash="", full_name=full_name)
+        user.password = password
+        db.session.add(user)
+    return user
+
+
+def seed():
+    """
+    Создать группу администраторов, пользователя admin, входящего в
+    нее, и пользователя nobody, не входящего ни в какие группы
+    """
+    admin_group = Group.query.filter_by(name="admin").one_or_none()
+    if admin_group is None:
+        admin_group = Group(name="admin", description="Administrators")
+        db.session.add(admin_group)
+    admin_user = get_or_create_user(
+        "admin", "root@localhost", "Site administrator", os.getenv("ADMIN_PASSWORD")
+    )
+    get_or_create_user(
+        "nobody", "nobody@localhost", "Regular user", os.getenv("NOBODY_PASSWORD")
+    )
+    # Пользователь и группа получают автосгенерированные UUID только
+    # после первого коммита
+    db.session.commit()
+    if admin_user not in admin_group.users:
+        admin_group.users.append(admin_user)
+        db.session.commit()
+
+
+@click.command("bootstrap")
+@click.option(
+    "--reinitialize", is_flag=True, help="Удалить все данные перед подготовкой"
+)
+@with_appcontext
+def bootstrap_command(reinitialize):
+    """Подготовить базу: миграции, секции истории, начальные пользователи"""
+    wait_for(ping_database, (OperationalError,), "Postgres connection")
+    if reinitialize:
+        drop_database()
+    with db.engine.begin() as conn:
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS auth"))
+    stamp_unknown_revision()
+    upgrade(Config.MIGRATIONS_PATH)
+    with db.engine.begin() as conn:
+        ensure_partitions(
+            conn, datetime.datetime.utcnow().date(), Config.HISTORY_PARTITIONS_AHEAD
+        )
+    seed()
+    click.echo("database is ready")
@@ -0,0 +1,216 @@
+"""
+Массовые операции: добавление пользователей в группу и импорт пользователей
+
+Записи обрабатываются наборами: существующие объекты проверяются одним
+запросом на пачку, вставка выполняется многострочным
+INSERT ... ON CONFLICT DO NOTHING RETURNING, по возвращенным строкам
+определяется, какие записи действительно добавлены. Все пачки одной
+операции выполняются в одной транзакции. Для каждой переданной записи
+возвращается результат ее обработки.
+"""
+
+import datetime
+import json
+import uuid
+from typing import Iterable, List
+
+from auth_config import Config, db
+from db_models import User, user_group
+from password_hash import hasher, valid_hash
+from sqlalchemy.dialects.postgresql import insert
+
+ADDED = "added"
+ALREADY_MEMBER = "already in group"
+CREATED = "created"
+CONFLICT = "conflict"
+USER_NOT_FOUND = "user not found"
+INVALID_ID = "invalid id"
+
+# Поля пользователя, которые можно передать при импорте
+IMPORT_FIELDS = {
+    "id",
+    "login",
+    "email",
+    "full_name",
+    "phone",
+    "avatar_link",
+    "address",
+    "password",
+    "password_hash",
+}
+IMPORT_REQUIRED_FIELDS = ("login", "email", "full_name")
+IMPORT_NULLABLE_FIELDS = {"phone", "avatar_link", "address"}
+# Наибольшая длина строкового поля импортируемого пользователя
+IMPORT_MAX_FIELD_LENGTH = 1024
+
+
+class TooManyItems(ValueError):
+    """Передано больше записей, чем BULK_MAX_ITEMS"""
+
+
+class TooManyPasswords(ValueError):
+    """Передано больше открытых паролей, чем BULK_MAX_PASSWORDS"""
+
+
+def _chunks(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def parse_uuid(value):
+    """UUID из строки или None, если строка не является UUID"""
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def add_group_members(group_id, user_ids: List) -> List[dict]:
+    """
+    Добавить в группу пользователей user_ids
+
+    Возвращает результат для каждого переданного идентификатора и не
+    фиксирует транзакцию
+    """
+    if len(user_ids) > Config.BULK_MAX_ITEMS:
+        raise TooManyItems(len(user_ids))
+    parsed = [parse_uuid(user_id) for user_id in user_ids]
+    valid = list({user_id for user_id in parsed if user_id is not None})
+    existing = set()
+    added = set()
+    for chunk in _chunks(valid, Config.BULK_CHUNK_SIZE):
+        existing.update(
+            row.id for row in db.session.query(User.id).filter(User.id.in_(chunk))
+        )
+        rows = [
+            {"id": uuid.uuid4(), "user_id": user_id, "group_id": group_id}
+            for user_id in chunk
+            if user_id in existing
+        ]
+        if not rows:
+            continue
+        result = db.session.execute(
+            insert(user_group)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["user_id", "group_id"])
+            .returning(user_group.c.user_id)
+        )
+        added.update(row.user_id for row in result)
+    results = []
+    for (user_id, value) in zip(user_ids, parsed):
+        if value is None:
+            result = INVALID_ID
+        elif value not in existing:
+            result = USER_NOT_FOUND
+        elif value in added:
+            result = ADDED
+            # Повторы в запросе считаем уже добавленными
+            added.discard(value)
+        else:
+            result = ALREADY_MEMBER
+        results.append({"user_id": str(user_id), "result": result})
+    return results
+
+
+def _import_row(number: int, line: bytes):
+    """
+    Разобрать строку NDJSON импорта: вернуть запись для вставки или
+    описание ошибки
+    """
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return None, {"line": number, "error": "invalid json"}
+    if not isinstance(obj, dict):
+        return None, {"line": number, "error": "object expected"}
+    unknown = set(obj) - IMPORT_FIELDS
+    if unknown:
+        return None, {"line": number, "error": f"unknown fields {sorted(unknown)}"}
+    for (field, value) in obj.items():
+        if value is None and field in IMPORT_NULLABLE_FIELDS:
+            continue
+        if not isinstance(value, str):
+            return None, {"line": number, "error": f"{field} must be a string"}
+        if len(value) > IMPORT_MAX_FIELD_LENGTH:
+            return None, {"line": number, "error": f"{field} is too long"}
+    missing = [f for f in IMPORT_REQUIRED_FIELDS if not obj.get(f)]
+    if missing:
+        return None, {"line": number, "error": f"missing fields {missing}"}
+    if ("password" in obj) == ("password_hash" in obj):
+        return None, {
+            "line": number,
+            "error": "exactly one of password and password_hash is required",
+        }
+    if "password_hash" in obj and not valid_hash(obj["password_hash"]):
+        return None, {"line": number, "error": "unknown password hash format"}
+    user_id = parse_uuid(obj.get("id", uuid.uuid4()))
+    if user_id is None:
+        return None, {"line": number, "error": INVALID_ID}
+    obj["id"] = user_id
+    return obj, None
+
+
+def import_users(lines: Iterable[bytes]) -> List[dict]:
+    """
+    Импортировать пользователей из строк NDJSON
+
+    Пароль передается либо открытым текстом (password), либо готовым
+    хэшем известного формата (password_hash). Открытых паролей в
+    запросе не больше BULK_MAX_PASSWORDS: хэширование занимает пул,
+    общий с входом пользователей. Пользователи, у которых
+    совпадает id, login или email с уже существующими, не добавляются.
+    Возвращает результат для каждой непустой строки и не фиксирует
+    транзакцию
+    """
+    results = []
+    rows = []
+    passwords = 0
+    for (number, line) in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        if len(results) >= Config.BULK_MAX_ITEMS:
+            raise TooManyItems(number)
+        (row, error) = _import_row(number, line)
+        if error is not None:
+            results.append(error)
+            continue
+        if "password" in row:
+            passwords += 1
+            if passwords > Config.BULK_MAX_PASSWORDS:
+                raise TooManyPasswords(number)
+        results.append({"line": number, "id": str(row["id"]), "login": row["login"]})
+        rows.append(row)
+    plain = [row for row in rows if "password" in row]
+    for (row, hashed) in zip(plain, hasher.hash_many([r["password"] for r in plain])):
+        row["password_hash"] = hashed
+        del row["password"]
+    created = set()
+    now = datetime.datetime.utcnow()
+    for chunk in _chunks(rows, Config.BULK_CHUNK_SIZE):
+        # В многострочном INSERT у всех строк должен быть одинаковый
+        # набор столбцов
+        values = [
+            dict(
+                {f: row.get(f) for f in IMPORT_FIELDS - {"password"}},
+                created_at=now,
+                updated_at=now,
+            )
+            for row in chunk
+        ]
+        result = db.session.execute(
+            insert(User.__table__)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(User.id)
+        )
+        created.update(str(row.id) for row in result)
+    for result in results:
+        if "id" not in result:
+            continue
+        if result["id"] in created:
+            result["result"] = CREATED
+            # Повторы id в запросе считаем конфликтующими
+            created.discard(result["id"])
+        else:
+            result["result"] = CONFLICT
+    return results
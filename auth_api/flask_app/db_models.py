@@ -3,8 +3,10 @@ import uuid
 from typing import Optional
 
 from auth_config import db
+from password_hash import hasher
+from sqlalchemy import and_, exists
 from sqlalchemy.dialects.postgresql import UUID
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy.orm import lazyload, load_only
 
 user_group = db.Table(
     "user_group_rel",
@@ -18,11 +20,28 @@ user_group = db.Table(
     ),
     db.Column("user_id", UUID(as_uuid=True), db.ForeignKey("auth.user.id")),
     db.Column("group_id", UUID(as_uuid=True), db.ForeignKey("auth.group.id")),
+    # Пользователь входит в группу не более одного раза. Индекс ограничения
+    # обслуживает проверку членства
+    db.UniqueConstraint(
+        "user_id", "group_id", name="uq_user_group_rel_user_id_group_id"
+    ),
     extend_existing=True,
     schema="auth",
 )
 
 
+def membership_exists(user_id, group_id) -> bool:
+    """
+    Проверить, состоит ли пользователь в группе, одним запросом
+    EXISTS по индексу, не загружая состав группы
+    """
+    return db.session.query(
+        exists().where(
+            and_(user_group.c.user_id == user_id, user_group.c.group_id == group_id)
+        )
+    ).scalar()
+
+
 class User(db.Model):
     """Зарегистрированный в системе пользователь"""
 
@@ -46,8 +65,10 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+    # Групп у пользователя немного, и они нужны при выдаче токенов -
+    # загружаются вторым запросом сразу для всех выбранных пользователей
     groups = db.relationship(
-        "Group", secondary=user_group, lazy="subquery", back_populates="users"
+        "Group", secondary=user_group, lazy="selectin", back_populates="users"
     )
 
     @property
@@ -56,17 +77,26 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(password, self.password_hash)
+
+    def password_needs_rehash(self):
+        """Получен ли хэш пароля устаревшим алгоритмом или с другой стоимостью"""
+        return hasher.needs_rehash(self.password_hash)
 
     def __repr__(self):
         return f"<User {self.login}>"
 
+    @staticmethod
+    def exists(user_id) -> bool:
+        """Есть ли пользователь с таким идентификатором"""
+        return db.session.query(exists().where(User.id == user_id)).scalar()
+
     def in_group(self, group_id):
         """Проверить, состоит ли пользователь в указанной группе"""
-        return self.groups.filter_by(group_id=group_id).first() is not None
+        return membership_exists(self.id, group_id)
 
     def get_all_groups(self):
         """Список всех групп, в которых состоит пользователь"""
@@ -80,6 +110,29 @@ class User(db.Model):
                 return True
         return False
 
+    @staticmethod
+    def json_options():
+        """
+        Параметры загрузки пользователя только с полями, нужными для to_json
+        """
+        return (load_only(User.id, User.login, User.email), lazyload(User.groups))
+
+    @staticmethod
+    def json_query():
+        """Запрос столбцов пользователей, нужных для row_to_json"""
+        return db.session.query(User.id, User.login, User.email)
+
+    @staticmethod
+    def row_to_json(row, *, url_prefix: Optional[str] = None):
+        """
+        Преобразовать строку json_query (или запись пользователя)
+        в объект для сериализации в Python
+        """
+        obj = {"id": str(row.id), "login": row.login, "email": row.email}
+        if url_prefix:
+            obj["url"] = f"{url_prefix}/user/account/{row.login}"
+        return obj
+
     def to_json(self, *, url_prefix: Optional[str] = None):
         """
         Преобразовать запись пользователя в объект для сериализации в Python
@@ -88,10 +141,7 @@ class User(db.Model):
         URL для доступа к информации о пользователе, с указанным
         префиксом.
         """
-        obj = {"id": self.id, "login": self.login, "email": self.email}
-        if url_prefix:
-            obj["url"] = f"{url_prefix}/user/account/{self.login}"
-        return obj
+        return User.row_to_json(self, url_prefix=url_prefix)
 
     def get_history(self, since: Optional[datetime.datetime] = None):
         """
@@ -104,11 +154,11 @@ class User(db.Model):
             return (
                 History.query.filter(History.user_id == self.id)
                 .filter(History.timestamp >= since)
-                .order_by(History.timestamp.desc())
+                .order_by(History.timestamp.desc(), History.id.desc())
             )
         else:
             return History.query.filter(History.user_id == self.id).order_by(
-                History.timestamp.desc()
+                History.timestamp.desc(), History.id.desc()
             )
 
 
@@ -128,24 +178,67 @@ class Group(db.Model):
     name = db.Column(db.String, unique=True, nullable=False)
     description = db.Column(db.String, nullable=False)
 
+    # Участников группы может быть много - вместо списка отношение
+    # возвращает запрос, который выполняется только при обращении к нему
     users = db.relationship(
-        "User", secondary=user_group, lazy="subquery", back_populates="groups"
+        "User", secondary=user_group, lazy="dynamic", back_populates="groups"
     )
 
     def __repr__(self):
         return f"<Group {self.name}>"
 
+    @staticmethod
+    def exists(group_id) -> bool:
+        """Есть ли группа с таким идентификатором"""
+        return db.session.query(exists().where(Group.id == group_id)).scalar()
+
     def is_admin(self):
         """Является ли группа группой администраторов"""
         return self.name == "admin"
 
     def user_in_group(self, user_id):
         """Проверить, состоит ли пользователь в указанной группе"""
-        return self.users.filter_by(user_id=user_id).first() is not None
+        return membership_exists(user_id, self.id)
 
     def get_all_users(self):
         """Список всех пользователей в этой группе"""
-        return User.query.filter(User.groups.any(id=self.id))
+        return self.users
+
+    @staticmethod
+    def member_ids(group_id) -> list:
+        """Идентификаторы участников группы без загрузки их записей"""
+        return [
+            row.user_id
+            for row in db.session.query(user_group.c.user_id).filter(
+                user_group.c.group_id == group_id
+            )
+        ]
+
+    @staticmethod
+    def members_json_query(group_id):
+        """Запрос столбцов участников группы, нужных для User.row_to_json"""
+        return (
+            User.json_query()
+            .join(user_group, user_group.c.user_id == User.id)
+            .filter(user_group.c.group_id == group_id)
+            .order_by(User.login)
+        )
+
+    @staticmethod
+    def json_query():
+        """Запрос столбцов групп, нужных для row_to_json"""
+        return db.session.query(Group.id, Group.name, Group.description)
+
+    @staticmethod
+    def row_to_json(row, *, url_prefix: Optional[str] = None):
+        """
+        Преобразовать строку json_query (или группу) в объект для
+        сериализации в Python
+        """
+        obj = {"id": str(row.id), "name": row.name, "description": row.description}
+        if url_prefix:
+            obj["url"] = f"{url_prefix}/group/{row.id}"
+        return obj
 
     def to_json(self, *, url_prefix: Optional[str] = None):
         """
@@ -155,10 +248,7 @@ class Group(db.Model):
         URL для доступа к информации об указанной группе, с указанным
         префиксом.
         """
-        obj = {"id": self.id, "name": self.name, "description": self.description}
-        if url_prefix:
-            obj["url"] = f"{url_prefix}/group/{self.id}"
-        return obj
+        return Group.row_to_json(self, url_prefix=url_prefix)
 
     @staticmethod
     def from_json(obj):
@@ -173,27 +263,59 @@ class Group(db.Model):
 
 
 class History(db.Model):
-    __table_args__ = {"schema": "auth", "extend_existing": True}
+    """
+    Запись о входе пользователя
+
+    Таблица секционирована по месяцам по полю timestamp (см.
+    history_partitions), поэтому первичный ключ включает timestamp,
+    а запросы с условием на timestamp читают только нужные секции
+    """
+
+    __table_args__ = (
+        # Индекс для постраничной выдачи истории пользователя по ключу
+        # (timestamp, id) в порядке убывания
+        db.Index("ix_history_user_id_timestamp_id", "user_id", "timestamp", "id"),
+        {
+            "schema": "auth",
+            "extend_existing": True,
+            "postgresql_partition_by": "RANGE (timestamp)",
+        },
+    )
     __tablename__ = "history"
 
     id = db.Column(
         UUID(as_uuid=True),
         primary_key=True,
         default=uuid.uuid4,
-        unique=True,
         nullable=False,
     )
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("auth.user.id"))
     useragent = db.Column(db.String, nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False)
+    timestamp = db.Column(db.DateTime, primary_key=True, nullable=False)
 
     def __repr__(self):
         return f"<History {self.useragent}>"
 
     def to_json(self):
         return {
-            "id": self.id,
-            "user_id": self.user_id,
+            "id": str(self.id),
+            "user_id": str(self.user_id) if self.user_id else None,
             "useragent": self.useragent,
             "timestamp": self.timestamp.isoformat(),
         }
+
+
+class HistoryDaily(db.Model):
+    """Число входов пользователя за день (сводка по истории входов)"""
+
+    __table_args__ = {"schema": "auth", "extend_existing": True}
+    __tablename__ = "history_daily"
+
+    user_id = db.Column(
+        UUID(as_uuid=True), db.ForeignKey("auth.user.id"), primary_key=True
+    )
+    day = db.Column(db.Date, primary_key=True)
+    logins = db.Column(db.Integer, nullable=False)
+
+    def to_json(self):
+        return {"day": self.day.isoformat(), "logins": self.logins}
@@ -0,0 +1,79 @@
+"""
+Пул соединений с Postgres и его статистика
+
+Приложение использует один engine, который создает Flask-SQLAlchemy
+при первом обращении к базе. Его пул настраивается параметрами
+DB_POOL_* из окружения (см. Config.SQLALCHEMY_ENGINE_OPTIONS).
+TimedQueuePool дополнительно измеряет, сколько запросы ждут
+свободное соединение: по этому времени и по загрузке пула
+подбирается число рабочих процессов сервера так, чтобы суммарный
+размер пулов не превышал max_connections в Postgres.
+"""
+
+import threading
+import time
+
+from metrics import DB_POOL_WAIT
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class PoolStats:
+    """Накопленные показатели получения соединений из пула"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, измеряющий время ожидания соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            pool_stats.record_wait(waited)
+            DB_POOL_WAIT.observe(waited)
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """То же для асинхронного engine (режим ASGI)"""
+
+
+def pool_status(engine) -> dict:
+    """Текущее состояние пула engine и накопленная статистика ожидания"""
+    pool = engine.pool
+    status = {
+        "checkouts": pool_stats.checkouts,
+        "wait_total_seconds": pool_stats.wait_total,
+        "wait_max_seconds": pool_stats.wait_max,
+        "wait_avg_seconds": (
+            pool_stats.wait_total / pool_stats.checkouts if pool_stats.checkouts else 0
+        ),
+    }
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update(
+            {
+                "size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "utilisation": pool.checkedout() / capacity if capacity > 0 else 0,
+            }
+        )
+    return status
@@ -0,0 +1,339 @@
+"""
+Распределение запросов к базе между основным сервером и репликами
+
+Адреса реплик задаются в DB_REPLICA_URIS (через запятую) и
+превращаются в binds Flask-SQLAlchemy с ключами replica_<номер>.
+Обработчики, помеченные декоратором read_only, читают с реплик по
+очереди (round-robin). Все остальные запросы, а также любая запись
+(flush) идут на основной сервер.
+
+Реплика, на которой произошла ошибка соединения, исключается из
+очереди на DB_REPLICA_RETRY_INTERVAL секунд, а обработчик повторяется
+на основном сервере. Кроме того, раз в DB_REPLICA_PROBE_INTERVAL секунд
+фоновый поток проверяет отставание реплик: реплика, отстающая больше
+чем на DB_REPLICA_MAX_LAG секунд или не ответившая, не используется до
+следующей проверки.
+
+Чтение своих изменений: после запроса, изменившего данные, и после
+записи истории входов пользователь отмечается в Redis, и в течение
+DB_READ_YOUR_WRITES_WINDOW секунд его запросы на чтение идут на
+основной сервер. Пользователь определяется по токену запроса, поэтому
+запросы без токена всегда читают с реплик.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial, wraps
+from typing import Callable, Iterable, List, Optional
+
+import redis
+from flask import current_app, g, has_request_context
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm, text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = "replica_"
+PIN_KEY = "db_primary_pin:{user_id}"
+
+# Отставание реплики, секунд. Если реплика получила весь журнал, она не
+# отстает, даже если основной сервер давно ничего не менял
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM "
+    "now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+def replica_binds(uris: List[str]) -> dict:
+    """Binds Flask-SQLAlchemy для списка адресов реплик"""
+    return {f"{REPLICA_BIND_PREFIX}{i}": uri for (i, uri) in enumerate(uris)}
+
+
+class ReplicaSet:
+    """Очередь реплик с исключением недоступных и отстающих"""
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.retry_interval = 30.0
+        self.max_lag = 0.0
+        self.probe_interval = 0.0
+        self._lag_of: Optional[Callable[[str], float]] = None
+        self._down_until = {}
+        self._lagging = set()
+        self._cycle = itertools.cycle([])
+        self._lock = threading.Lock()
+        self._prober: Optional[threading.Thread] = None
+        self._prober_pid = None
+
+    def configure(
+        self,
+        keys: List[str],
+        retry_interval: float,
+        max_lag: float = 0.0,
+        probe_interval: float = 0.0,
+        lag_of: Optional[Callable[[str], float]] = None,
+    ):
+        self.keys = keys
+        self.retry_interval = retry_interval
+        self.max_lag = max_lag
+        self.probe_interval = probe_interval
+        self._lag_of = lag_of
+        self._down_until = {}
+        self._lagging = set()
+        self._cycle = itertools.cycle(keys)
+
+    def choose(self) -> Optional[str]:
+        """Следующая доступная реплика или None, если доступных нет"""
+        self._ensure_prober()
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = next(self._cycle)
+                if self._available(key, now):
+                    return key
+        return None
+
+    def mark_down(self, key: str):
+        with self._lock:
+            self._down_until[key] = time.monotonic() + self.retry_interval
+
+    def healthy(self) -> List[str]:
+        now = time.monotonic()
+        return [k for k in self.keys if self._available(k, now)]
+
+    def probe(self):
+        """Проверить отставание всех реплик"""
+        lagging = set()
+        for key in self.keys:
+            try:
+                lag = self._lag_of(key)
+            except Exception as ex:
+                logger.warning("replica %s probe failed: %s", key, ex)
+                lagging.add(key)
+                continue
+            if lag > self.max_lag:
+                logger.warning("replica %s lags %.1f s behind", key, lag)
+                lagging.add(key)
+        with self._lock:
+            self._lagging = lagging
+
+    def _available(self, key: str, now: float) -> bool:
+        return self._down_until.get(key, 0) <= now and key not in self._lagging
+
+    def _ensure_prober(self):
+        # Поток запускается в рабочем процессе сервера при первом выборе
+        # реплики: после fork потоки родителя не наследуются
+        if not self.probe_interval or self._lag_of is None or not self.keys:
+            return
+        if self._prober_pid == os.getpid() and self._prober.is_alive():
+            return
+        with self._lock:
+            if self._prober_pid == os.getpid() and self._prober.is_alive():
+                return
+            self._prober = threading.Thread(
+                target=self._run_prober, name="replica-prober", daemon=True
+            )
+            self._prober.start()
+            self._prober_pid = os.getpid()
+
+    def _run_prober(self):
+        while True:
+            self.probe()
+            time.sleep(self.probe_interval)
+
+
+replicas = ReplicaSet()
+
+
+class PrimaryPins:
+    """
+    Окна чтения своих изменений по пользователям. Хранятся в Redis,
+    поэтому действуют во всех процессах и для клиентов без cookie
+    """
+
+    def __init__(self):
+        self.redis = None
+        self.window = 0.0
+
+    def configure(self, redis_client, window: float):
+        self.redis = redis_client
+        self.window = window
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None and self.window > 0 and bool(replicas.keys)
+
+    def pin(self, user_ids: Iterable):
+        """Направлять чтение пользователей user_ids на основной сервер"""
+        if not self.enabled:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.set(
+                    PIN_KEY.format(user_id=user_id), "", px=int(self.window * 1000)
+                )
+            pipe.execute()
+        except redis.exceptions.RedisError as ex:
+            logger.warning("could not pin users to the primary: %s", ex)
+
+    def pinned(self, user_id) -> bool:
+        """Попадает ли пользователь в окно чтения своих изменений"""
+        if not self.enabled:
+            return False
+        try:
+            return bool(self.redis.exists(PIN_KEY.format(user_id=user_id)))
+        except redis.exceptions.RedisError:
+            # Без Redis окно не проверить - читаем с основного сервера
+            return True
+
+
+primary_pins = PrimaryPins()
+
+
+def current_identity():
+    """Пользователь из проверенного токена запроса или None"""
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+
+def primary_forced() -> bool:
+    """
+    Должен ли обработчик read_only читать с основного сервера. Токен
+    проверяется декораторами внутри read_only, поэтому окно пользователя
+    определяется при первом обращении к базе
+    """
+    if g.get("db_force_primary"):
+        return True
+    if "db_pinned" not in g:
+        identity = current_identity()
+        if identity is None:
+            return False
+        g.db_pinned = primary_pins.pinned(identity)
+    return g.db_pinned
+
+
+class RoutingSession(SignallingSession):
+    """Сессия, отправляющая чтение в обработчиках read_only на реплики"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if (
+            not self._flushing
+            and has_request_context()
+            and g.get("db_read_only")
+            and not primary_forced()
+        ):
+            if "db_replica" not in g:
+                g.db_replica = replicas.choose()
+            if g.db_replica is not None:
+                return self.db.get_engine(self.app, bind=g.db_replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy с сессией RoutingSession. pin_redis - клиент Redis
+    для окон чтения своих изменений
+    """
+
+    def __init__(self, *args, pin_redis=None, **kwargs):
+        self.pin_redis = pin_redis
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        super().init_app(app)
+        replicas.configure(
+            sorted(app.config.get("SQLALCHEMY_BINDS") or {}),
+            app.config["DB_REPLICA_RETRY_INTERVAL"],
+            app.config["DB_REPLICA_MAX_LAG"],
+            app.config["DB_REPLICA_PROBE_INTERVAL"],
+            partial(self.replica_lag, app),
+        )
+        primary_pins.configure(self.pin_redis, app.config["DB_READ_YOUR_WRITES_WINDOW"])
+
+        @event.listens_for(RoutingSession, "after_flush")
+        def remember_write(session, flush_context):
+            if has_request_context():
+                g.db_wrote = True
+
+        @app.after_request
+        def pin_primary(response):
+            if g.get("db_wrote"):
+                identity = current_identity()
+                if identity is not None:
+                    primary_pins.pin([identity])
+            return response
+
+    def replica_lag(self, app, key: str) -> float:
+        """Отставание реплики key, секунд"""
+        with self.get_engine(app, bind=key).connect() as conn:
+            return float(conn.execute(REPLICA_LAG_QUERY).scalar())
+
+
+@contextmanager
+def on_primary():
+    """
+    Выполнить запросы блока на основном сервере, в том числе внутри
+    обработчика read_only
+    """
+    if not has_request_context():
+        yield
+        return
+    forced = g.get("db_force_primary")
+    g.db_force_primary = True
+    try:
+        yield
+    finally:
+        g.db_force_primary = forced
+
+
+def connection_failed(ex: DBAPIError) -> bool:
+    """
+    Ошибка соединения с сервером, а не выполнения запроса: соединение
+    оборвалось или не удалось подключиться. Отмена запроса по
+    statement_timeout и другие ошибки самого запроса сюда не относятся
+    """
+    return ex.connection_invalidated or ex.statement is None
+
+
+def read_only(fn):
+    """
+    Декоратор для обработчиков, которые только читают данные и могут
+    обслуживаться репликами. Если соединение с репликой оборвалось или не
+    устанавливается, обработчик выполняется повторно на основном сервере.
+    Ошибки самих запросов (например, превышение statement_timeout) не
+    выводят реплику из работы и не повторяются.
+    """
+
+    @wraps(fn)
+    def decorated(*args, **kwargs):
+        g.db_read_only = True
+        g.db_force_primary = False
+        try:
+            return fn(*args, **kwargs)
+        except DBAPIError as ex:
+            replica = g.get("db_replica")
+            if replica is None or not connection_failed(ex):
+                raise
+            replicas.mark_down(replica)
+            current_app.extensions["sqlalchemy"].db.session.rollback()
+            g.db_force_primary = True
+            return fn(*args, **kwargs)
+
+    return decorated
@@ -1,19 +1,28 @@
+import hmac
 from functools import wraps
 from http import HTTPStatus
 
-from db_models import User
+from auth_config import Config
+from flask import request
 from flask.json import jsonify
-from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_jwt_extended import get_jwt, get_jwt_identity, verify_jwt_in_request
+from jwt_claims import claims_are_stale, claims_group_names
 
+ADMIN_GROUP = "admin"
+SERVICE_SECRET_HEADER = "X-Service-Secret"
 
-def admin_required():
+
+def groups_required(*group_names):
     """
-    Декоратор для функций, которые должны выполняться с правами
-    администратора. Благодаря проверке verify_jwt_in_request
-    может применяться без декоратора jwt_required, заменяя его
-    и добавляя еще одну проверку - что обратившийся пользователь
-    входит в группу администраторов. Если не входит - функция
-    не выполняется и возвращается ошибка 403.
+    Декоратор для функций, которые должны выполняться только
+    пользователями, входящими хотя бы в одну из групп group_names.
+    Благодаря проверке verify_jwt_in_request может применяться без
+    декоратора jwt_required, заменяя его. Решение принимается по
+    списку групп из полей access токена, без обращения к базе.
+    Если членство пользователя в группах изменилось после выдачи
+    токена, возвращается ошибка 401 и токен нужно обновить. Если
+    пользователь не входит ни в одну из групп - функция не выполняется
+    и возвращается ошибка 403.
     """
 
     def wrapper(fn):
@@ -26,10 +35,17 @@ def admin_required():
                     jsonify({"msg": f"Bad access token: {ex}"}),
                     HTTPStatus.UNAUTHORIZED,
                 )
-            current_user = User.query.get(get_jwt_identity())
-            if not current_user or not current_user.is_admin():
+            claims = get_jwt()
+            if claims_are_stale(claims, get_jwt_identity()):
                 return (
-                    jsonify({"error": "Only administrators may do it"}),
+                    jsonify({"msg": "Group membership changed, refresh the token"}),
+                    HTTPStatus.UNAUTHORIZED,
+                )
+            if not claims_group_names(claims) & set(group_names):
+                return (
+                    jsonify(
+                        {"error": f"Only members of {', '.join(group_names)} may do it"}
+                    ),
                     HTTPStatus.FORBIDDEN,
                 )
             return fn(*args, **kwargs)
@@ -39,6 +55,44 @@ def admin_required():
     return wrapper
 
 
+def admin_required():
+    """
+    Декоратор для функций, которые должны выполняться с правами
+    администратора. Частный случай groups_required для группы
+    администраторов. Если пользователь не входит в группу
+    администраторов - функция не выполняется и возвращается
+    ошибка 403.
+    """
+    return groups_required(ADMIN_GROUP)
+
+
+def service_or_admin_required():
+    """
+    Декоратор для функций, которые вызываются другими сервисами. Сервис
+    передает общий секрет Config.SERVICE_SECRET в заголовке
+    X-Service-Secret, иначе требуются права администратора, как в
+    admin_required. Неверный секрет - ошибка 401
+    """
+
+    def wrapper(fn):
+        admin_fn = admin_required()(fn)
+
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            secret = request.headers.get(SERVICE_SECRET_HEADER)
+            if secret is None:
+                return admin_fn(*args, **kwargs)
+            if not Config.SERVICE_SECRET or not hmac.compare_digest(
+                secret.encode("utf-8"), Config.SERVICE_SECRET.encode("utf-8")
+            ):
+                return jsonify({"msg": "Bad service secret"}), HTTPStatus.UNAUTHORIZED
+            return fn(*args, **kwargs)
+
+        return decorated
+
+    return wrapper
+
+
 # def user_required( ):
 #     """
 #         Декоратор для функций, которые должны выполняться с правами
@@ -0,0 +1,111 @@
+"""
+Кэш списка групп
+
+Список групп меняется редко, а запрашивается часто. Сериализованный
+список хранится в Redis под номером версии каталога
+(groups_catalog:<версия>) вместе со своим ETag, а каждый рабочий
+процесс дополнительно держит в памяти последнюю полученную версию.
+create_group, update_group и del_group после коммита увеличивают
+номер версии (INCR groups_catalog:version), и следующий запрос
+строит список заново.
+
+Процесс сверяет номер версии с Redis не чаще, чем раз в
+GROUP_CATALOG_CHECK_INTERVAL секунд, в остальное время ответ
+отдается из памяти без обращения к Redis и Postgres. Ответ 304 на
+запрос с совпадающим If-None-Match не требует ни запроса к базе, ни
+сериализации. Если Redis недоступен, список строится из базы.
+
+Список, который сохраняется под номером версии, строится на основном
+сервере базы, даже если обработчик читает с реплик: отстающая реплика
+могла еще не получить изменение, увеличившее версию, и устаревший
+список хранился бы под новой версией GROUP_CATALOG_CACHE_TTL секунд.
+"""
+
+import hashlib
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import redis
+from auth_config import Config, jwt_redis
+from db_routing import on_primary
+from flask.json import dumps
+
+VERSION_KEY = "groups_catalog:version"
+BODY_KEY = "groups_catalog:{version}"
+
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+def make_etag(version: int, body: str) -> str:
+    digest = hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+    return f"{version}-{digest}"
+
+
+class GroupCatalog:
+    """Двухуровневый кэш (память процесса и Redis) списка групп"""
+
+    def __init__(self):
+        # Версия, тело ответа, ETag и время последней сверки с Redis
+        self._version: Optional[int] = None
+        self._body: Optional[str] = None
+        self._etag: Optional[str] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, build: Callable[[], list]) -> Tuple[str, str]:
+        """
+        Тело ответа и ETag текущей версии списка групп, build строит
+        список из базы, если его нет ни в памяти, ни в Redis
+        """
+        now = time.monotonic()
+        if (
+            self._body is not None
+            and now - self._checked < Config.GROUP_CATALOG_CHECK_INTERVAL
+        ):
+            return (self._body, self._etag)
+        try:
+            version = int(jwt_redis.get(VERSION_KEY) or 0)
+            if version == self._version and self._body is not None:
+                self._checked = now
+                return (self._body, self._etag)
+            cached = jwt_redis.hmget(BODY_KEY.format(version=version), "body", "etag")
+        except REDIS_ERRORS:
+            body = dumps(build())
+            return (body, make_etag(0, body))
+        (body, etag) = cached
+        if body is None:
+            with on_primary():
+                body = dumps(build())
+            etag = make_etag(version, body)
+            self._store(version, body, etag)
+        with self._lock:
+            (self._version, self._body, self._etag) = (version, body, etag)
+            self._checked = now
+        return (body, etag)
+
+    @staticmethod
+    def _store(version: int, body: str, etag: str):
+        key = BODY_KEY.format(version=version)
+        try:
+            pipe = jwt_redis.pipeline(transaction=False)
+            pipe.hset(key, mapping={"body": body, "etag": etag})
+            pipe.expire(key, Config.GROUP_CATALOG_CACHE_TTL)
+            pipe.execute()
+        except REDIS_ERRORS:
+            pass
+
+    def invalidate(self):
+        """
+        Сбросить кэш после изменения групп. Вызывается после коммита,
+        чтобы новая версия строилась уже по измененным данным
+        """
+        with self._lock:
+            self._body = None
+        try:
+            jwt_redis.incr(VERSION_KEY)
+        except REDIS_ERRORS:
+            pass
+
+
+group_catalog = GroupCatalog()
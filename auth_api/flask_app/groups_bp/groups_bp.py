@@ -1,29 +1,47 @@
+import uuid
 from http import HTTPStatus
 
-from auth_config import db
-from db_models import Group, User
+import membership_cache
+from auth_config import Config, db
+from bulk import ADDED, TooManyItems, add_group_members, parse_uuid
+from db_models import Group, User, user_group
+from db_routing import read_only
 from decorators import admin_required
 from flasgger.utils import swag_from
-from flask import Blueprint, render_template, request
+from flask import Blueprint, Response, render_template, request
 from flask.json import jsonify
+from group_catalog import group_catalog
+from jwt_claims import bump_groups_version
+from pagination import BadPageParameter, offset_page, page_args
+from schema_validation import validate_body
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
 
 groups_bp = Blueprint("groups_bp", __name__)
 
 
-@swag_from("../schemes/groups_get.yaml")
 @groups_bp.route("/", methods=["GET"])
+@read_only
+@swag_from("../schemes/groups_get.yaml")
 def list_groups():
     """
     Список всех пользовательских групп
+
+    Список берется из кэша, на запрос с совпадающим If-None-Match
+    возвращается 304
     """
-    groups = []
-    for group in Group.query.all():
-        groups.append(group.to_json())
-    return jsonify(groups)
+    (body, etag) = group_catalog.get(
+        lambda: [Group.row_to_json(row) for row in Group.json_query()]
+    )
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @groups_bp.route("/", methods=["POST"])
 @admin_required()
+@validate_body
 @swag_from("../schemes/group_post.yaml")
 def create_group():
     """
@@ -35,19 +53,21 @@ def create_group():
     group = Group.from_json(request.json)
     db.session.add(group)
     db.session.commit()
+    group_catalog.invalidate()
     return jsonify(group.to_json())
 
 
-@swag_from("../schemes/group_get.yaml")
 @groups_bp.route("/<group_id>/", methods=["GET"])
+@read_only
+@swag_from("../schemes/group_get.yaml")
 def get_group(group_id):
     """
     Получить информацию о группе
     """
-    group = Group.query.get(group_id)
+    group = Group.json_query().filter(Group.id == group_id).first()
     if group is None:
         return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
-    return jsonify(group.to_json())
+    return jsonify(Group.row_to_json(group))
 
 
 @groups_bp.route("/<group_id>/", methods=["DELETE"])
@@ -57,17 +77,29 @@ def del_group(group_id):
     """
     Удалить группу
     """
-    group = Group.query.get(group_id)
-    if group is None:
+    if not Group.exists(group_id):
         return jsonify({"result": "Group did not exist"})
-    db.session.delete(group)
+    # Удаляем членство одним запросом, не загружая участников группы
+    member_ids = [
+        row.user_id
+        for row in db.session.execute(
+            user_group.delete()
+            .where(user_group.c.group_id == group_id)
+            .returning(user_group.c.user_id)
+        )
+    ]
+    Group.query.filter(Group.id == group_id).delete(synchronize_session=False)
     db.session.commit()
+    group_catalog.invalidate()
+    bump_groups_version(member_ids)
+    membership_cache.forget_group(group_id)
     return jsonify({"result": "Group deleted"})
 
 
-@swag_from("../schemes/group_put.yaml")
-@admin_required()
 @groups_bp.route("/<group_id>/", methods=["PUT"])
+@admin_required()
+@validate_body
+@swag_from("../schemes/group_put.yaml")
 def update_group(group_id):
     """
     Изменить группу
@@ -81,55 +113,99 @@ def update_group(group_id):
         group.name = request.json["description"]
     db.session.add(group)
     db.session.commit()
+    group_catalog.invalidate()
+    # Имена групп входят в токены участников
+    bump_groups_version(Group.member_ids(group_id))
     return jsonify({})
 
 
-@swag_from("../schemes/group_users_get.yaml", methods=["GET"])
 @groups_bp.route("/<group_id>/users/", methods=["GET"])
+@read_only
+@swag_from("../schemes/group_users_get.yaml", methods=["GET"])
 def list_group_users(group_id):
     """
     Список пользователей, входящих в определенную группу.
     """
-    page_size = request.args.get("page_size", 1)
-    page_number = request.args.get("page_number", 1)
-    group = Group.query.get(group_id)
-    if group is None:
+    try:
+        (page_size, page_number) = page_args(
+            request.args, Config.PAGE_SIZE_MAX, default_size=1
+        )
+    except BadPageParameter as ex:
+        return jsonify({"error": f"bad {ex}"}), HTTPStatus.BAD_REQUEST
+    if not Group.exists(group_id):
         return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
-    users = group.get_all_users()
+    users = Group.members_json_query(group_id)
     answer = []
     if page_size is None:
-        for user in users:
-            answer.append(user.to_json())
+        rows = users.all()
     else:
-        for user in users.paginate(int(page_number), int(page_size), False).items:
-            answer.append(user.to_json())
+        rows = offset_page(users, page_number, page_size)
+    for row in rows:
+        answer.append(User.row_to_json(row))
     return jsonify(answer)
 
 
 @groups_bp.route("/<group_id>/users/", methods=["POST"])
 @admin_required()
+@validate_body
 @swag_from("../schemes/group_user_post.yaml", methods=["POST"])
 def add_group_user(group_id):
     """
     Добавить пользователя в группу
     """
-    group = Group.query.get(group_id)
-    if group is None:
+    if not Group.exists(group_id):
         return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
     # FIXME: Через Swagger не работает
     # user_id = request.args["user_id"]
     user_id = request.json["user_id"]
-    user = User.query.get(user_id)
-    if user is None:
+    if not User.exists(user_id):
         return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
-    group.users.append(user)
-    db.session.add(group)
+    db.session.execute(
+        insert(user_group)
+        .values(user_id=user_id, group_id=group_id)
+        .on_conflict_do_nothing(index_elements=["user_id", "group_id"])
+    )
     db.session.commit()
+    membership_cache.set_member(group_id, user_id, True)
+    bump_groups_version([user_id])
     return jsonify({"result": f"User {user_id} added to group {group_id}"})
 
 
-@swag_from("../schemes/group_user_check_get.yaml", methods=["GET"])
+@groups_bp.route("/<group_id>/users:batch", methods=["POST"])
+@admin_required()
+@validate_body
+@swag_from("../schemes/group_users_batch_post.yaml", methods=["POST"])
+def add_group_users_batch(group_id):
+    """
+    Добавить в группу сразу много пользователей
+
+    Возвращает результат для каждого переданного идентификатора
+    """
+    if not Group.exists(group_id):
+        return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
+    user_ids = (request.get_json(silent=True) or {}).get("user_ids")
+    if not isinstance(user_ids, list):
+        return jsonify({"error": "user_ids list expected"}), HTTPStatus.BAD_REQUEST
+    try:
+        results = add_group_members(group_id, user_ids)
+    except TooManyItems:
+        return (
+            jsonify({"error": "too many users"}),
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+    db.session.commit()
+    # В ответе остаются переданные строки, а ключи кэша и версий групп
+    # строятся по каноническому виду UUID, который читают is_member и
+    # поля токенов
+    added = [str(uuid.UUID(r["user_id"])) for r in results if r["result"] == ADDED]
+    membership_cache.set_members(str(uuid.UUID(group_id)), added, True)
+    bump_groups_version(added)
+    return jsonify({"added": len(added), "items": results})
+
+
 @groups_bp.route("/<group_id>/user/<user_id>", methods=["GET"])
+@read_only
+@swag_from("../schemes/group_user_check_get.yaml", methods=["GET"])
 def get_membership(group_id, user_id):
     """
     Получить информацию о членстве пользователя user_id в группе
@@ -140,34 +216,42 @@ def get_membership(group_id, user_id):
         'group_id': <group_id>
     }
     """
-    group = Group.query.get(group_id)
-    if group is None:
+    # Неверный идентификатор не доходит ни до кэша, ни до базы
+    group_uuid = parse_uuid(group_id)
+    user_uuid = parse_uuid(user_id)
+    if group_uuid is None:
         return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
-    user = User.query.get(user_id)
-    if user is None:
+    if user_uuid is None:
         return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
-    if user not in group.users:
-        return jsonify({"error": "user is not in the group"}), HTTPStatus.NOT_FOUND
-    return jsonify({"user_id": user_id, "group_id": group_id})
+    if membership_cache.is_member(str(group_uuid), str(user_uuid)):
+        return jsonify({"user_id": user_id, "group_id": group_id})
+    if not Group.exists(group_uuid):
+        return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
+    if not User.exists(user_uuid):
+        return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
+    return jsonify({"error": "user is not in the group"}), HTTPStatus.NOT_FOUND
 
 
+@groups_bp.route("/<group_id>/user/<user_id>", methods=["DELETE"])
 @admin_required()
 @swag_from("../schemes/group_user_del.yaml", methods=["DELETE"])
-@groups_bp.route("/<group_id>/user/<user_id>", methods=["DELETE"])
 def del_membership(group_id, user_id):
     """
     Удалить пользователя из группы
     """
-    user = User.query.get(user_id)
-    if user is None:
+    if not User.exists(user_id):
         return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
-    group = Group.query.get(group_id)
-    if group is None:
+    if not Group.exists(group_id):
         return jsonify({"error": "group not found"}), HTTPStatus.NOT_FOUND
-    if user in group.users:
-        group.users.remove(user)
-        db.session.add(group)
-        db.session.commit()
+    result = db.session.execute(
+        user_group.delete().where(
+            and_(user_group.c.user_id == user_id, user_group.c.group_id == group_id)
+        )
+    )
+    db.session.commit()
+    membership_cache.set_member(group_id, user_id, False)
+    if result.rowcount:
+        bump_groups_version([user_id])
         return jsonify({"result": "user removed from the group"}), HTTPStatus.OK
     else:
         return jsonify({"result": "user was not in the group"}), HTTPStatus.NOT_FOUND
@@ -0,0 +1,79 @@
+"""
+Проверки состояния процесса для оркестратора
+
+/healthz (liveness) не обращается к внешним сервисам и отвечает, пока
+процесс способен обрабатывать запросы. /readyz (readiness) проверяет
+получение соединения из пула и выполнение запроса к Postgres, ответ
+Redis на PING и то, что схема базы соответствует последней миграции
+(эта проверка после первого успеха не повторяется). Пока какая-либо
+проверка не проходит, возвращается 503, и трафик на процесс не
+направляется.
+"""
+
+from http import HTTPStatus
+
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from auth_config import Config, db, jwt_redis
+from flasgger.utils import swag_from
+from flask import Blueprint, current_app
+from flask.json import jsonify
+from sqlalchemy import text
+
+health_bp = Blueprint("health_bp", __name__)
+
+OK = "ok"
+
+# Схема базы уже проверена этим процессом
+_schema_ready = False
+
+
+def check_database():
+    with db.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        if not _schema_ready:
+            check_migrations(conn)
+
+
+def check_migrations(conn):
+    global _schema_ready
+    config = current_app.extensions["migrate"].migrate.get_config(
+        Config.MIGRATIONS_PATH
+    )
+    heads = set(ScriptDirectory.from_config(config).get_heads())
+    current = set(MigrationContext.configure(conn).get_current_heads())
+    if current != heads:
+        raise RuntimeError(f"migrations not applied: {sorted(current)}")
+    _schema_ready = True
+
+
+def check_redis():
+    jwt_redis.ping()
+
+
+CHECKS = {"database": check_database, "redis": check_redis}
+
+
+@health_bp.route("/healthz", methods=["GET"])
+@swag_from("../schemes/healthz_get.yaml")
+def healthz():
+    """Процесс жив"""
+    return jsonify({"status": OK})
+
+
+@health_bp.route("/readyz", methods=["GET"])
+@swag_from("../schemes/readyz_get.yaml")
+def readyz():
+    """Процесс готов принимать запросы: база и Redis доступны"""
+    checks = {}
+    for (name, check) in CHECKS.items():
+        try:
+            check()
+            checks[name] = OK
+        except Exception as ex:
+            checks[name] = str(ex) or type(ex).__name__
+    ready = all(result == OK for result in checks.values())
+    return (
+        jsonify({"status": OK if ready else "unavailable", "checks": checks}),
+        HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE,
+    )
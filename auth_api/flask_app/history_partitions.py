@@ -0,0 +1,200 @@
+"""
+Обслуживание секционированной таблицы истории входов auth.history
+
+Таблица секционирована по месяцам (RANGE по timestamp), секция за
+месяц называется history_y<год>m<месяц>. Обслуживание запускается
+командой "flask history maintain" (например, раз в сутки из cron) и
+
+- заранее создает секции на HISTORY_PARTITIONS_AHEAD месяцев вперед,
+  чтобы записи не попадали в секцию по умолчанию history_default
+  (записи, уже попавшие туда, переносятся в созданную секцию);
+- пересчитывает дневную сводку auth.history_daily (число входов
+  пользователя за день) за последние дни;
+- отсоединяет (HISTORY_RETENTION_MODE=detach) или удаляет (drop)
+  секции старше HISTORY_RETENTION_MONTHS месяцев.
+
+Старые записи удаляются вместе с секцией, без DELETE и последующей
+очистки, поэтому автоочистка (vacuum) работает только с секциями
+последних месяцев.
+"""
+
+import datetime
+import re
+from typing import List
+
+import click
+from auth_config import Config, db
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+PARTITION_PREFIX = "history_y"
+PARTITION_NAME = re.compile(r"^history_y(\d{4})m(\d{2})$")
+DEFAULT_PARTITION = "history_default"
+
+ROLLUP_SQL = """
+INSERT INTO auth.history_daily (user_id, day, logins)
+SELECT user_id, CAST(:day AS date), count(*)
+FROM auth.history
+WHERE timestamp >= :day AND timestamp < :next_day AND user_id IS NOT NULL
+GROUP BY user_id
+ON CONFLICT (user_id, day) DO UPDATE SET logins = EXCLUDED.logins
+"""
+
+PARTITIONS_SQL = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+JOIN pg_namespace n ON n.oid = p.relnamespace
+WHERE n.nspname = 'auth' AND p.relname = 'history'
+"""
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return f"{PARTITION_PREFIX}{month.year:04d}m{month.month:02d}"
+
+
+def table_exists(conn, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name)"), name=f"auth.{name}").scalar()
+
+
+def create_partition(conn, month: datetime.date):
+    """
+    Создать секцию истории за месяц month, если ее еще нет
+
+    Если в секции по умолчанию уже есть записи за этот месяц (например,
+    сервис писал историю дольше, чем на HISTORY_PARTITIONS_AHEAD месяцев
+    без обслуживания), PostgreSQL не даст создать секцию. Тогда секция
+    по умолчанию отсоединяется, записи месяца переносятся в новую
+    секцию, и она присоединяется обратно - все в одной транзакции
+    """
+    month = month_start(month)
+    name = partition_name(month)
+    if table_exists(conn, name):
+        return
+    bounds = {"start": month, "end": add_months(month, 1)}
+    move = (
+        table_exists(conn, DEFAULT_PARTITION)
+        and conn.execute(
+            text(
+                f"SELECT EXISTS (SELECT 1 FROM auth.{DEFAULT_PARTITION} "
+                "WHERE timestamp >= :start AND timestamp < :end)"
+            ),
+            **bounds,
+        ).scalar()
+    )
+    if move:
+        conn.execute(
+            text(f"ALTER TABLE auth.history DETACH PARTITION auth.{DEFAULT_PARTITION}")
+        )
+    conn.execute(
+        text(
+            f"CREATE TABLE auth.{name} "
+            "PARTITION OF auth.history "
+            f"FOR VALUES FROM ('{bounds['start'].isoformat()}') "
+            f"TO ('{bounds['end'].isoformat()}')"
+        )
+    )
+    if move:
+        conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM auth.{DEFAULT_PARTITION} "
+                "WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                "INSERT INTO auth.history SELECT * FROM moved"
+            ),
+            **bounds,
+        )
+        conn.execute(
+            text(
+                f"ALTER TABLE auth.history ATTACH PARTITION "
+                f"auth.{DEFAULT_PARTITION} DEFAULT"
+            )
+        )
+
+
+def ensure_partitions(conn, today: datetime.date, ahead: int):
+    """
+    Создать секцию по умолчанию и секции с текущего месяца на ahead
+    месяцев вперед
+    """
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS auth.{DEFAULT_PARTITION} "
+            "PARTITION OF auth.history DEFAULT"
+        )
+    )
+    for offset in range(ahead + 1):
+        create_partition(conn, add_months(month_start(today), offset))
+
+
+def list_partitions(conn) -> List[datetime.date]:
+    """Месяцы, для которых есть секции истории"""
+    months = []
+    for (name,) in conn.execute(text(PARTITIONS_SQL)):
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime.date(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+def apply_retention(
+    conn, today: datetime.date, keep_months: int, mode: str
+) -> List[str]:
+    """
+    Отсоединить от таблицы истории секции старше keep_months месяцев
+    и, если mode равен drop, удалить их. Возвращает имена секций
+    """
+    oldest = add_months(month_start(today), -keep_months)
+    expired = []
+    for month in list_partitions(conn):
+        if add_months(month, 1) > oldest:
+            continue
+        name = partition_name(month)
+        conn.execute(text(f"ALTER TABLE auth.history DETACH PARTITION auth.{name}"))
+        if mode == "drop":
+            conn.execute(text(f"DROP TABLE auth.{name}"))
+        expired.append(name)
+    return expired
+
+
+def rollup_day(conn, day: datetime.date):
+    """
+    Пересчитать число входов пользователей за день day
+
+    Условие на timestamp ограничивает запрос одной секцией
+    """
+    conn.execute(text(ROLLUP_SQL), day=day, next_day=day + datetime.timedelta(days=1))
+
+
+def maintain(conn, today: datetime.date) -> dict:
+    """Все работы по обслуживанию истории на дату today"""
+    ensure_partitions(conn, today, Config.HISTORY_PARTITIONS_AHEAD)
+    for days in range(Config.HISTORY_ROLLUP_DAYS, -1, -1):
+        rollup_day(conn, today - datetime.timedelta(days=days))
+    expired = apply_retention(
+        conn, today, Config.HISTORY_RETENTION_MONTHS, Config.HISTORY_RETENTION_MODE
+    )
+    return {"partitions": len(list_partitions(conn)), "expired": expired}
+
+
+history_cli = AppGroup("history", help="Обслуживание истории входов")
+
+
+@history_cli.command("maintain")
+def maintain_command():
+    """Создать секции заранее, обновить сводку и удалить старые секции"""
+    with db.engine.begin() as conn:
+        result = maintain(conn, datetime.datetime.utcnow().date())
+    click.echo(
+        f"partitions: {result['partitions']}, "
+        f"expired: {', '.join(result['expired']) or 'none'}"
+    )
@@ -0,0 +1,196 @@
+"""
+Пакетная запись истории входов пользователей
+
+Вместо отдельной транзакции на каждый вход записи истории складываются
+в очередь внутри процесса и записываются в базу одним многострочным
+INSERT, когда набирается HISTORY_BATCH_SIZE записей или проходит
+HISTORY_FLUSH_INTERVAL секунд. При остановке процесса очередь
+сбрасывается в базу. В режиме HISTORY_SINK_MODE=sync запись идет
+сразу, в рамках запроса. В пакетном режиме история согласована в
+конечном счете: запись о входе видна при чтении истории не раньше, чем
+ее пакет будет записан, а читающие обработчики очередь не сбрасывают.
+
+Если запись в базу не удалась, пакет возвращается в очередь и
+повторяется при следующем сбросе (в режиме sync - фоновым потоком), не
+более HISTORY_WRITE_ATTEMPTS раз. Записи, которые не удалось записать
+или для которых не нашлось места в очереди за HISTORY_PUT_TIMEOUT
+секунд, отбрасываются с предупреждением в журнале и учитываются в
+метрике auth_history_records_dropped_total.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from auth_config import db
+from db_models import History
+from db_routing import primary_pins
+from metrics import HISTORY_RECORDS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class HistorySink:
+    """Буфер записей истории с фоновым сбросом в базу"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.synchronous = True
+        self.batch_size = 500
+        self.flush_interval = 1.0
+        self.put_timeout = 0.5
+        self.write_attempts = 5
+        # Элементы очереди - пары (число неудачных попыток записи, запись)
+        self._queue: Optional[queue.Queue] = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # После неудачной записи следующая попытка - не раньше, чем через
+        # flush_interval, чтобы запросы не ждали недоступную базу
+        self._retry_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.synchronous = app.config["HISTORY_SINK_MODE"] == "sync"
+        self.batch_size = app.config["HISTORY_BATCH_SIZE"]
+        self.flush_interval = app.config["HISTORY_FLUSH_INTERVAL"]
+        self.put_timeout = app.config["HISTORY_PUT_TIMEOUT"]
+        self.write_attempts = app.config["HISTORY_WRITE_ATTEMPTS"]
+        self._queue = queue.Queue(maxsize=app.config["HISTORY_QUEUE_SIZE"])
+        atexit.register(self.close)
+
+    def add(self, user_id, useragent: str, timestamp: Optional[datetime] = None):
+        """
+        Добавить запись о входе пользователя. Время записи - UTC, как у
+        месячных разделов и дневной сводки (history_partitions)
+        """
+        row = {
+            "id": uuid.uuid4(),
+            "user_id": user_id,
+            "useragent": useragent,
+            "timestamp": timestamp or datetime.utcnow(),
+        }
+        if self.synchronous:
+            if not self._write([row]):
+                self._ensure_worker()
+                self._requeue([(0, row)])
+            return
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((0, row))
+        except queue.Full:
+            # База не успевает за потоком входов - сбрасываем очередь
+            # прямо в запросе, это ограничивает объем буфера. Другие
+            # потоки могут успеть снова заполнить очередь, поэтому место
+            # в ней ждем не дольше put_timeout
+            self.flush()
+            try:
+                self._queue.put((0, row), timeout=self.put_timeout)
+            except queue.Full:
+                self._drop(1, "queue_full")
+                return
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self, force: bool = False):
+        """
+        Записать в базу все накопленные записи. Если запись не удалась,
+        пакет возвращается в очередь, а следующие вызовы в течение
+        flush_interval (кроме force) ничего не делают
+        """
+        if not force and time.monotonic() < self._retry_at:
+            return
+        while True:
+            batch: List[Tuple[int, dict]] = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            if not self._write([row for (_, row) in batch]):
+                self._retry_at = time.monotonic() + self.flush_interval
+                self._requeue(batch)
+                return
+
+    def close(self):
+        """Остановить фоновый поток и сбросить очередь в базу"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 5)
+        if self._queue is None:
+            return
+        for _ in range(self.write_attempts):
+            self.flush(force=True)
+            if self._queue.empty():
+                return
+        self._drop(self._queue.qsize(), "write_failed")
+
+    def _write(self, rows) -> bool:
+        try:
+            with db.get_engine(self.app).begin() as conn:
+                conn.execute(History.__table__.insert(), rows)
+        except Exception as ex:
+            logger.error("could not write %d history records: %s", len(rows), ex)
+            return False
+        # Запись идет мимо сессии, поэтому окно чтения своих изменений
+        # открывается здесь
+        primary_pins.pin({row["user_id"] for row in rows})
+        return True
+
+    def _requeue(self, batch: List[Tuple[int, dict]]):
+        """Вернуть в очередь записи пакета, запись которого не удалась"""
+        exhausted = 0
+        full = 0
+        for (attempts, row) in batch:
+            if attempts + 1 >= self.write_attempts:
+                exhausted += 1
+                continue
+            try:
+                self._queue.put_nowait((attempts + 1, row))
+            except queue.Full:
+                full += 1
+        self._drop(exhausted, "write_failed")
+        self._drop(full, "queue_full")
+
+    @staticmethod
+    def _drop(count: int, reason: str):
+        if count:
+            HISTORY_RECORDS_DROPPED.labels(reason=reason).inc(count)
+            logger.warning("dropped %d history records: %s", count, reason)
+
+    def _ensure_worker(self):
+        # Поток запускается в том процессе, который пишет историю: после
+        # fork рабочих процессов сервера потоки родителя не наследуются
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="history-sink", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+history_sink = HistorySink()
@@ -0,0 +1,110 @@
+"""
+Пакетная проверка токенов (introspection)
+
+Подпись и срок действия всех переданных токенов проверяются локально,
+а их актуальность - одним обращением к Redis: в одном конвейере
+(pipeline) выполняются MGET отметок отзыва по jti, номеров поколения
+токенов и версий членства в группах пользователей, а также HGET
+действующего refresh токена каждого семейства. В отличие от проверки
+в обработчиках запросов, локальный фильтр отозванных токенов и кэш
+поколений не используются: результат отражает состояние Redis на
+момент запроса.
+
+Для каждого токена возвращается {"active": true, "claims": {...}}
+или {"active": false, "reason": ...}, где reason - invalid, expired
+или revoked. У действующего access токена, выданного до изменения
+состава групп пользователя, поле groups_stale равно true.
+"""
+
+from typing import List
+
+from auth_config import Config, jwt_redis
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import ExpiredSignatureError, PyJWTError
+from jwt_claims import (
+    GROUPS_VERSION_CLAIM,
+    GROUPS_VERSION_KEY,
+    TOKEN_GENERATION_CLAIM,
+    TOKEN_GENERATION_KEY,
+)
+from refresh_families import FAMILY_CLAIM, FAMILY_KEY
+
+INVALID = "invalid"
+EXPIRED = "expired"
+REVOKED = "revoked"
+
+
+class TooManyTokens(ValueError):
+    """Передано больше токенов, чем INTROSPECT_MAX_TOKENS"""
+
+
+def _decode(token) -> dict:
+    """Поля токена или {"reason": ...}, если токен не прошел проверку"""
+    if not isinstance(token, str):
+        return {"reason": INVALID}
+    try:
+        return {"claims": decode_token(token)}
+    except ExpiredSignatureError:
+        return {"reason": EXPIRED}
+    except (PyJWTError, JWTExtendedException):
+        return {"reason": INVALID}
+
+
+def introspect(tokens: List) -> List[dict]:
+    """Проверить токены tokens, вернуть результат для каждого"""
+    if len(tokens) > Config.INTROSPECT_MAX_TOKENS:
+        raise TooManyTokens(len(tokens))
+    decoded = [_decode(token) for token in tokens]
+    valid = [item["claims"] for item in decoded if "claims" in item]
+
+    # Ключи для MGET: порядок запоминаем в словаре ключ -> позиция
+    keys = {}
+    families = []
+    for claims in valid:
+        user_id = claims[Config.JWT_IDENTITY_CLAIM]
+        keys.setdefault(TOKEN_GENERATION_KEY.format(user_id=user_id), len(keys))
+        if claims.get("type") == "access":
+            keys.setdefault(claims["jti"], len(keys))
+            keys.setdefault(GROUPS_VERSION_KEY.format(user_id=user_id), len(keys))
+        elif FAMILY_CLAIM in claims:
+            families.append(FAMILY_KEY.format(family_id=claims[FAMILY_CLAIM]))
+    values = []
+    current_jtis = {}
+    if keys or families:
+        pipe = jwt_redis.pipeline(transaction=False)
+        if keys:
+            pipe.mget(list(keys))
+        for family in families:
+            pipe.hget(family, "jti")
+        replies = pipe.execute()
+        if keys:
+            values = replies.pop(0)
+        current_jtis = dict(zip(families, replies))
+
+    def value(key):
+        return values[keys[key]]
+
+    results = []
+    for item in decoded:
+        claims = item.get("claims")
+        if claims is None:
+            results.append({"active": False, "reason": item["reason"]})
+            continue
+        user_id = claims[Config.JWT_IDENTITY_CLAIM]
+        generation = value(TOKEN_GENERATION_KEY.format(user_id=user_id))
+        revoked = claims.get(TOKEN_GENERATION_CLAIM, 0) < int(generation or 0)
+        result = {"active": True, "claims": claims}
+        if claims.get("type") == "access":
+            revoked = revoked or value(claims["jti"]) is not None
+            groups_version = value(GROUPS_VERSION_KEY.format(user_id=user_id))
+            result["groups_stale"] = claims.get(GROUPS_VERSION_CLAIM) != int(
+                groups_version or 0
+            )
+        elif FAMILY_CLAIM in claims:
+            family = FAMILY_KEY.format(family_id=claims[FAMILY_CLAIM])
+            revoked = revoked or current_jtis[family] != claims["jti"]
+        if revoked:
+            result = {"active": False, "reason": REVOKED}
+        results.append(result)
+    return results
@@ -0,0 +1,60 @@
+"""
+Сериализация JSON через orjson
+
+В Flask 2.0 нет подключаемого JSON провайдера, поэтому orjson
+встраивается в обе точки, через которые проходит JSON:
+
+- OrjsonEncoder подключается как app.json_encoder. Его метод encode
+  вызывается из flask.json.dumps, а значит, из jsonify и потоковой
+  выдачи NDJSON. UUID, datetime и dataclass orjson сериализует сам,
+  остальные типы передаются стандартному кодировщику Flask;
+- OrjsonRequest разбирает тело запроса (request.json) через orjson.
+"""
+
+import orjson
+from flask import json
+from flask.json import JSONEncoder
+from flask.wrappers import Request
+
+
+class OrjsonEncoder(JSONEncoder):
+    """Кодировщик JSON для Flask, выполняющий сериализацию через orjson"""
+
+    def encode(self, o) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        # orjson умеет только отступ в два пробела, им и форматируем
+        # ответ в режиме отладки (JSONIFY_PRETTYPRINT_REGULAR)
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode("utf-8")
+
+
+class OrjsonModule:
+    """Модуль JSON для разбора тела запроса"""
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json.dumps(obj, **kwargs)
+
+
+class OrjsonRequest(Request):
+    """Запрос, тело которого разбирается через orjson"""
+
+    json_module = OrjsonModule
+
+
+class JsonProvider:
+    """Подключение orjson к приложению Flask"""
+
+    def init_app(self, app):
+        app.json_encoder = OrjsonEncoder
+        app.request_class = OrjsonRequest
+
+
+json_provider = JsonProvider()
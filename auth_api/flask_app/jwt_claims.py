@@ -0,0 +1,178 @@
+"""
+Дополнительные поля (claims) JWT токенов
+
+В access токен записывается список групп пользователя и номер
+версии его членства в группах. Декораторы авторизации принимают
+решение только по этим полям, не обращаясь к Postgres. Чтобы
+изменения состава групп вступали в силу до истечения токена,
+при каждом изменении членства версия пользователя в Redis
+увеличивается, а токены со старой версией считаются устаревшими.
+
+Кроме того, в access и refresh токены записывается номер поколения
+токенов пользователя. Выход со всех устройств увеличивает номер
+поколения в Redis, и все выданные ранее токены пользователя
+считаются отозванными - без хранения списка этих токенов. При
+проверке токенов номер поколения кэшируется в каждом процессе на
+TOKEN_GENERATION_CACHE_TTL секунд, на это время в других процессах
+старые токены еще действуют. При выдаче токенов номер всегда читается
+из Redis: иначе токен, выданный сразу после выхода со всех устройств,
+мог бы получить старый номер и оказаться отозванным, как только кэш
+процесса обновится. Номер поколения и версия групп читаются одной
+командой MGET, и прочитанный номер записывается в оба токена пары.
+"""
+
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+from auth_config import Config, jwt_redis
+
+GROUPS_CLAIM = "groups"
+GROUPS_VERSION_CLAIM = "groups_ver"
+GROUPS_VERSION_KEY = "groups_version:{user_id}"
+TOKEN_GENERATION_CLAIM = "gen"
+TOKEN_GENERATION_KEY = "token_generation:{user_id}"
+
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def groups_version(user_id) -> int:
+    """Текущая версия членства пользователя в группах"""
+    version = jwt_redis.get(GROUPS_VERSION_KEY.format(user_id=user_id))
+    return int(version) if version is not None else 0
+
+
+def bump_groups_version(user_ids: Iterable) -> None:
+    """
+    Увеличить версию членства в группах для указанных пользователей
+
+    Вызывается при любом изменении состава групп, в которые они входят,
+    после чего выданные им ранее access токены требуют обновления
+    """
+    pipe = jwt_redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.incr(GROUPS_VERSION_KEY.format(user_id=user_id))
+    pipe.execute()
+
+
+def _claims_keys(identity: str) -> list:
+    """Ключи Redis, которые читаются при выдаче токенов: поколение и версия"""
+    return [
+        TOKEN_GENERATION_KEY.format(user_id=identity),
+        GROUPS_VERSION_KEY.format(user_id=identity),
+    ]
+
+
+def _token_claims(identity: str, user, values) -> Tuple[dict, dict]:
+    (generation, version) = values
+    generation = _remember_generation(identity, generation, time.monotonic())
+    groups = user.groups if user is not None else []
+    access_claims = {
+        GROUPS_CLAIM: [{"id": str(g.id), "name": g.name} for g in groups],
+        GROUPS_VERSION_CLAIM: int(version) if version is not None else 0,
+        TOKEN_GENERATION_CLAIM: generation,
+    }
+    return access_claims, {TOKEN_GENERATION_CLAIM: generation}
+
+
+def token_claims(identity: str, user) -> Tuple[dict, dict]:
+    """
+    Дополнительные поля access и refresh токенов пользователя user
+
+    Если пользователь не задан (тестовая учетная запись), то access
+    токен не содержит ни одной группы
+    """
+    identity = str(identity)
+    return _token_claims(identity, user, jwt_redis.mget(_claims_keys(identity)))
+
+
+def claims_group_names(claims: dict) -> set:
+    """Множество имен групп, перечисленных в полях токена"""
+    return {g["name"] for g in claims.get(GROUPS_CLAIM, [])}
+
+
+def claims_are_stale(claims: dict, identity: Optional[str]) -> bool:
+    """
+    Проверить, не изменилось ли членство пользователя в группах
+    после выдачи токена
+    """
+    if GROUPS_VERSION_CLAIM not in claims:
+        return True
+    return claims[GROUPS_VERSION_CLAIM] != groups_version(identity)
+
+
+def _cached_generation(user_id: str, now: float) -> Optional[int]:
+    cached = _generations.get(user_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    return None
+
+
+def _remember_generation(user_id: str, value, now: float) -> int:
+    generation = int(value) if value is not None else 0
+    with _generations_lock:
+        _generations[user_id] = (generation, now + Config.TOKEN_GENERATION_CACHE_TTL)
+        if len(_generations) > Config.TOKEN_GENERATION_CACHE_SIZE:
+            # Кэш переполнен - удаляем устаревшие записи
+            for key, (_, expires) in list(_generations.items()):
+                if expires <= now:
+                    del _generations[key]
+    return generation
+
+
+def token_generation(user_id) -> int:
+    """Текущий номер поколения токенов пользователя (с кэшем в процессе)"""
+    user_id = str(user_id)
+    now = time.monotonic()
+    generation = _cached_generation(user_id, now)
+    if generation is not None:
+        return generation
+    value = jwt_redis.get(TOKEN_GENERATION_KEY.format(user_id=user_id))
+    return _remember_generation(user_id, value, now)
+
+
+def bump_token_generation(user_id) -> int:
+    """
+    Отозвать все выданные пользователю токены, увеличив номер поколения
+    """
+    user_id = str(user_id)
+    generation = jwt_redis.incr(TOKEN_GENERATION_KEY.format(user_id=user_id))
+    with _generations_lock:
+        _generations[user_id] = (
+            generation,
+            time.monotonic() + Config.TOKEN_GENERATION_CACHE_TTL,
+        )
+    return generation
+
+
+def token_generation_revoked(jwt_payload: dict) -> bool:
+    """Выдан ли токен до последнего выхода пользователя со всех устройств"""
+    issued = jwt_payload.get(TOKEN_GENERATION_CLAIM, 0)
+    return issued < token_generation(jwt_payload[Config.JWT_IDENTITY_CLAIM])
+
+
+# Варианты для асинхронного режима (asgi.py): те же ключи и кэш процесса,
+# обращения к Redis через асинхронный клиент redis_client
+
+
+async def token_generation_async(redis_client, user_id) -> int:
+    user_id = str(user_id)
+    now = time.monotonic()
+    generation = _cached_generation(user_id, now)
+    if generation is not None:
+        return generation
+    value = await redis_client.get(TOKEN_GENERATION_KEY.format(user_id=user_id))
+    return _remember_generation(user_id, value, now)
+
+
+async def token_claims_async(redis_client, identity: str, user) -> Tuple[dict, dict]:
+    identity = str(identity)
+    values = await redis_client.mget(_claims_keys(identity))
+    return _token_claims(identity, user, values)
+
+
+async def token_generation_revoked_async(redis_client, jwt_payload: dict) -> bool:
+    issued = jwt_payload.get(TOKEN_GENERATION_CLAIM, 0)
+    user_id = jwt_payload[Config.JWT_IDENTITY_CLAIM]
+    return issued < await token_generation_async(redis_client, user_id)
@@ -0,0 +1,63 @@
+"""
+Кэш членства пользователей в группах
+
+Для каждой группы в Redis хранится хэш group_members:<id группы>,
+в котором для проверенных пользователей записан признак членства
+("1" или "0"). Проверка членства - одно обращение HGET, а при
+промахе - запрос EXISTS к основному серверу базы (реплика может еще не
+получить только что добавленного участника), результат которого
+сохраняется в кэше. Добавление и удаление участников через API сразу
+обновляют кэш, а время жизни MEMBERSHIP_CACHE_TTL ограничивает срок,
+в течение которого видны изменения, сделанные в базе в обход API.
+
+Результат промаха записывается HSETNX: если за время запроса к базе
+признак уже записал обработчик, изменивший состав группы, прочитанное
+раньше значение его не перезапишет.
+"""
+
+from auth_config import Config, jwt_redis
+from db_models import membership_exists
+from db_routing import on_primary
+
+MEMBERS_KEY = "group_members:{group_id}"
+
+
+def is_member(group_id, user_id) -> bool:
+    """Состоит ли пользователь user_id в группе group_id"""
+    key = MEMBERS_KEY.format(group_id=group_id)
+    cached = jwt_redis.hget(key, str(user_id))
+    if cached is not None:
+        return cached == "1"
+    with on_primary():
+        member = membership_exists(user_id, group_id)
+    pipe = jwt_redis.pipeline(transaction=False)
+    pipe.hsetnx(key, str(user_id), "1" if member else "0")
+    pipe.expire(key, Config.MEMBERSHIP_CACHE_TTL)
+    pipe.execute()
+    return member
+
+
+def set_member(group_id, user_id, member: bool):
+    """Записать в кэш признак членства пользователя в группе"""
+    key = MEMBERS_KEY.format(group_id=group_id)
+    pipe = jwt_redis.pipeline(transaction=False)
+    pipe.hset(key, str(user_id), "1" if member else "0")
+    pipe.expire(key, Config.MEMBERSHIP_CACHE_TTL)
+    pipe.execute()
+
+
+def set_members(group_id, user_ids, member: bool):
+    """Записать в кэш признак членства сразу для нескольких пользователей"""
+    if not user_ids:
+        return
+    key = MEMBERS_KEY.format(group_id=group_id)
+    value = "1" if member else "0"
+    pipe = jwt_redis.pipeline(transaction=False)
+    pipe.hset(key, mapping={str(user_id): value for user_id in user_ids})
+    pipe.expire(key, Config.MEMBERSHIP_CACHE_TTL)
+    pipe.execute()
+
+
+def forget_group(group_id):
+    """Удалить из кэша все сведения о группе"""
+    jwt_redis.delete(MEMBERS_KEY.format(group_id=group_id))
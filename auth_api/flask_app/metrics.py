@@ -0,0 +1,241 @@
+"""
+Метрики приложения в формате Prometheus
+
+По адресу /metrics отдаются:
+
+- auth_request_duration_seconds - время обработки запросов по
+  blueprint, обработчику, методу и коду ответа;
+- auth_sql_statements_per_request и auth_sql_duration_per_request_seconds -
+  число SQL запросов и суммарное время их выполнения за HTTP запрос
+  (по событиям engine, см. sql_counter);
+- auth_redis_command_duration_seconds - время команд Redis (конвейер
+  учитывается как одна команда PIPELINE);
+- auth_password_hash_duration_seconds - время вычисления и проверки
+  хэшей паролей вместе с ожиданием в очереди пула;
+- auth_jwt_encode_duration_seconds и
+  auth_token_revocation_check_seconds - подпись токенов и проверка
+  их отзыва;
+- auth_db_pool_* - состояние пула соединений с базой;
+- auth_history_records_dropped_total - записи истории входов, которые
+  не удалось ни записать, ни сохранить в очереди (см. history_sink).
+
+При запуске нескольких рабочих процессов (uwsgi, gunicorn) в
+переменной окружения PROMETHEUS_MULTIPROC_DIR задается каталог, через
+который процессы обмениваются значениями метрик. Переменная должна
+быть задана до запуска сервера, а каталог - очищаться при его
+перезапуске. Показатели пула суммируются по живым процессам, для
+этого сервер при завершении рабочего процесса должен вызывать
+prometheus_client.multiprocess.mark_process_dead(pid).
+"""
+
+import os
+import time
+
+import redis
+import redis.asyncio
+from flask import Response, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy.pool import QueuePool
+
+# Границы интервалов для быстрых операций (Redis, подпись токенов)
+FAST_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    1.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+REQUEST_DURATION = Histogram(
+    "auth_request_duration_seconds",
+    "Время обработки HTTP запроса",
+    ["blueprint", "endpoint", "method", "status"],
+)
+SQL_STATEMENTS = Histogram(
+    "auth_sql_statements_per_request",
+    "Число SQL запросов за HTTP запрос",
+    ["endpoint"],
+    buckets=COUNT_BUCKETS,
+)
+SQL_DURATION = Histogram(
+    "auth_sql_duration_per_request_seconds",
+    "Время выполнения SQL запросов за HTTP запрос",
+    ["endpoint"],
+)
+REDIS_DURATION = Histogram(
+    "auth_redis_command_duration_seconds",
+    "Время выполнения команды Redis",
+    ["command"],
+    buckets=FAST_BUCKETS,
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "auth_password_hash_duration_seconds",
+    "Время вычисления или проверки хэша пароля",
+    ["operation"],
+)
+JWT_ENCODE_DURATION = Histogram(
+    "auth_jwt_encode_duration_seconds",
+    "Время создания и подписи токена",
+    ["token_type"],
+    buckets=FAST_BUCKETS,
+)
+TOKEN_REVOCATION_CHECK_DURATION = Histogram(
+    "auth_token_revocation_check_seconds",
+    "Время проверки отзыва токена",
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "auth_db_pool_connections",
+    "Соединения пула с базой по состоянию",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_CAPACITY = Gauge(
+    "auth_db_pool_capacity",
+    "Наибольшее число соединений пула с базой",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT = Histogram(
+    "auth_db_pool_wait_seconds",
+    "Время ожидания соединения из пула",
+    buckets=FAST_BUCKETS,
+)
+HISTORY_RECORDS_DROPPED = Counter(
+    "auth_history_records_dropped_total",
+    "Потерянные записи истории входов",
+    ["reason"],
+)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Конвейер Redis, выполнение которого попадает в метрики"""
+
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_DURATION.labels(command="PIPELINE").observe(
+                time.perf_counter() - started
+            )
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis, время команд которого попадает в метрики"""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_DURATION.labels(command=str(args[0]).upper()).observe(
+                time.perf_counter() - started
+            )
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedAsyncPipeline(redis.asyncio.client.Pipeline):
+    """Асинхронный конвейер Redis, выполнение которого попадает в метрики"""
+
+    async def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_DURATION.labels(command="PIPELINE").observe(
+                time.perf_counter() - started
+            )
+
+
+class InstrumentedAsyncRedis(redis.asyncio.Redis):
+    """Асинхронный клиент Redis, время команд которого попадает в метрики"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_DURATION.labels(command=str(args[0]).upper()).observe(
+                time.perf_counter() - started
+            )
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+def observe_pool(pool):
+    """Записать состояние пула соединений текущего процесса"""
+    if not isinstance(pool, QueuePool):
+        return
+    DB_POOL_CONNECTIONS.labels(state="checked_out").set(pool.checkedout())
+    DB_POOL_CONNECTIONS.labels(state="checked_in").set(pool.checkedin())
+    DB_POOL_CONNECTIONS.labels(state="overflow").set(max(pool.overflow(), 0))
+    DB_POOL_CAPACITY.set(pool.size() + max(pool._max_overflow, 0))
+
+
+class Metrics:
+    """Сбор метрик HTTP запросов и их выдача по адресу /metrics"""
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._observe)
+        app.add_url_rule("/metrics", "metrics", self.view)
+
+    @staticmethod
+    def _start():
+        g.request_started = time.perf_counter()
+
+    @staticmethod
+    def _observe(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        endpoint = request.endpoint or "none"
+        REQUEST_DURATION.labels(
+            blueprint=request.blueprint or "",
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        ).observe(time.perf_counter() - started)
+        SQL_STATEMENTS.labels(endpoint=endpoint).observe(g.get("sql_statements", 0))
+        SQL_DURATION.labels(endpoint=endpoint).observe(g.get("sql_duration", 0.0))
+        extension = current_app.extensions.get("sqlalchemy")
+        if extension is not None:
+            observe_pool(extension.db.engine.pool)
+        return response
+
+    @staticmethod
+    def view():
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            # Значения всех рабочих процессов из общего каталога
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
@@ -0,0 +1,131 @@
+"""history partitions
+
+Перевод auth.history на секционирование по месяцам (RANGE по
+timestamp) и дневная сводка входов auth.history_daily. Первичный
+ключ секционированной таблицы должен включать ключ секционирования,
+поэтому он становится (id, timestamp). Существующие записи
+переносятся в секции за соответствующие месяцы, секции создаются
+и на несколько месяцев вперед, дальше их создает команда
+"flask history maintain".
+
+Revision ID: 3e7a9c5d1f24
+Revises: 8d3f1c6a2e90
+Create Date: 2026-10-18 15:02:44.610277
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3e7a9c5d1f24'
+down_revision = '8d3f1c6a2e90'
+branch_labels = None
+depends_on = None
+
+# Сколько месяцев вперед создавать секции при миграции
+PARTITIONS_AHEAD = 3
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    op.rename_table('history', 'history_unpartitioned', schema='auth')
+    # Имена индексов уникальны в схеме - освобождаем их для новой таблицы
+    op.execute('ALTER INDEX IF EXISTS auth.history_pkey RENAME TO history_unpartitioned_pkey')
+    op.execute('ALTER INDEX IF EXISTS auth.history_id_key RENAME TO history_unpartitioned_id_key')
+    op.drop_index(
+        'ix_history_user_id_timestamp_id',
+        table_name='history_unpartitioned',
+        schema='auth',
+    )
+    op.create_table('history',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('useragent', sa.String(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['auth.user.id'], ),
+    sa.PrimaryKeyConstraint('id', 'timestamp'),
+    schema='auth',
+    postgresql_partition_by='RANGE (timestamp)'
+    )
+    op.create_index(
+        'ix_history_user_id_timestamp_id',
+        'history',
+        ['user_id', 'timestamp', 'id'],
+        unique=False,
+        schema='auth',
+    )
+    op.execute('CREATE TABLE auth.history_default PARTITION OF auth.history DEFAULT')
+    today = datetime.datetime.utcnow().date()
+    first = op.get_bind().execute(
+        sa.text('SELECT min(timestamp) FROM auth.history_unpartitioned')
+    ).scalar()
+    month = datetime.date((first or today).year, (first or today).month, 1)
+    last = _add_months(datetime.date(today.year, today.month, 1), PARTITIONS_AHEAD)
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE auth.history_y{month.year:04d}m{month.month:02d} "
+            "PARTITION OF auth.history "
+            f"FOR VALUES FROM ('{month.isoformat()}') "
+            f"TO ('{_add_months(month, 1).isoformat()}')"
+        )
+        month = _add_months(month, 1)
+    op.execute(
+        'INSERT INTO auth.history (id, user_id, useragent, timestamp) '
+        'SELECT id, user_id, useragent, timestamp FROM auth.history_unpartitioned'
+    )
+    op.drop_table('history_unpartitioned', schema='auth')
+    op.create_table('history_daily',
+    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('logins', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['auth.user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'day'),
+    schema='auth'
+    )
+    op.execute(
+        'INSERT INTO auth.history_daily (user_id, day, logins) '
+        'SELECT user_id, CAST(timestamp AS date), count(*) FROM auth.history '
+        'WHERE user_id IS NOT NULL GROUP BY user_id, CAST(timestamp AS date)'
+    )
+
+
+def downgrade():
+    op.drop_table('history_daily', schema='auth')
+    op.rename_table('history', 'history_partitioned', schema='auth')
+    op.execute('ALTER INDEX IF EXISTS auth.history_pkey RENAME TO history_partitioned_pkey')
+    op.drop_index(
+        'ix_history_user_id_timestamp_id',
+        table_name='history_partitioned',
+        schema='auth',
+    )
+    op.create_table('history',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('useragent', sa.String(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['auth.user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id'),
+    schema='auth'
+    )
+    op.execute(
+        'INSERT INTO auth.history (id, user_id, useragent, timestamp) '
+        'SELECT id, user_id, useragent, timestamp FROM auth.history_partitioned'
+    )
+    # Секции удаляются вместе с секционированной таблицей
+    op.drop_table('history_partitioned', schema='auth')
+    op.create_index(
+        'ix_history_user_id_timestamp_id',
+        'history',
+        ['user_id', 'timestamp', 'id'],
+        unique=False,
+        schema='auth',
+    )
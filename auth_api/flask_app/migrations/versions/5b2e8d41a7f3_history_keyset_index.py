@@ -0,0 +1,44 @@
+"""history keyset index
+
+Индекс для постраничной выдачи истории входов по ключу
+(user_id, timestamp, id). Для выдачи пользователей по ключу
+login отдельный индекс не нужен: его дает ограничение
+уникальности на auth.user.login.
+
+Revision ID: 5b2e8d41a7f3
+Revises: c9179e686cbe
+Create Date: 2026-10-18 10:12:41.118604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8d41a7f3'
+down_revision = 'c9179e686cbe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблица истории большая, поэтому строим индекс без блокировки записи
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_history_user_id_timestamp_id',
+            'history',
+            ['user_id', 'timestamp', 'id'],
+            unique=False,
+            schema='auth',
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_history_user_id_timestamp_id',
+            table_name='history',
+            schema='auth',
+            postgresql_concurrently=True,
+        )
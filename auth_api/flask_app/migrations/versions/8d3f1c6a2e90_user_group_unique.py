@@ -0,0 +1,43 @@
+"""user group unique
+
+Ограничение уникальности пары (user_id, group_id) в auth.user_group_rel.
+Его индекс обслуживает проверку членства пользователя в группе, а
+добавление участника выполняется через INSERT ... ON CONFLICT DO NOTHING.
+Перед созданием ограничения удаляются повторяющиеся записи.
+
+Revision ID: 8d3f1c6a2e90
+Revises: 5b2e8d41a7f3
+Create Date: 2026-10-18 12:40:07.315902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f1c6a2e90'
+down_revision = '5b2e8d41a7f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        'DELETE FROM auth.user_group_rel a USING auth.user_group_rel b '
+        'WHERE a.user_id = b.user_id AND a.group_id = b.group_id AND a.id > b.id'
+    )
+    op.create_unique_constraint(
+        'uq_user_group_rel_user_id_group_id',
+        'user_group_rel',
+        ['user_id', 'group_id'],
+        schema='auth',
+    )
+
+
+def downgrade():
+    op.drop_constraint(
+        'uq_user_group_rel_user_id_group_id',
+        'user_group_rel',
+        schema='auth',
+        type_='unique',
+    )
@@ -0,0 +1,29 @@
+"""
+Потоковая выдача результатов запроса в формате NDJSON
+
+Строки выбираются серверным курсором Postgres пачками по
+EXPORT_BATCH_SIZE и отправляются клиенту по мере получения, по одному
+JSON объекту в строке. Память процесса не зависит от размера
+таблицы, а первая строка уходит клиенту сразу после первой пачки.
+"""
+
+from typing import Callable
+
+from auth_config import Config
+from flask import Response, stream_with_context
+from flask.json import dumps
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def ndjson_response(query, to_json: Callable) -> Response:
+    """
+    Ответ, в котором строки запроса query, преобразованные функцией
+    to_json, передаются клиенту по мере чтения из базы
+    """
+
+    def generate():
+        for row in query.yield_per(Config.EXPORT_BATCH_SIZE):
+            yield dumps(to_json(row)) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
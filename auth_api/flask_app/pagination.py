@@ -0,0 +1,135 @@
+"""
+Постраничная выдача по ключу (keyset pagination)
+
+Вместо OFFSET следующая страница выбирается условием на значения
+ключа сортировки последней записи предыдущей страницы. Эти значения
+передаются клиенту в виде непрозрачной строки cursor. При наличии
+индекса по ключу сортировки стоимость любой страницы одинакова.
+"""
+
+import base64
+import datetime
+import json
+import uuid
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import DateTime, literal, tuple_
+from sqlalchemy.dialects.postgresql import UUID
+
+
+class BadCursor(ValueError):
+    """Переданный клиентом cursor не удалось разобрать"""
+
+
+class BadPageParameter(ValueError):
+    """Параметр page_size или page_number не является допустимым числом"""
+
+
+def _positive_int(args, name: str, default: Optional[int]) -> Optional[int]:
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError as ex:
+        raise BadPageParameter(name) from ex
+    if number < 1:
+        raise BadPageParameter(name)
+    return number
+
+
+def page_args(
+    args, max_size: int, default_size: Optional[int] = None
+) -> Tuple[Optional[int], int]:
+    """
+    Разобрать параметры page_size и page_number запроса. page_size
+    ограничивается сверху max_size, нечисловые и неположительные
+    значения - BadPageParameter. Если page_size не передан, вместо него
+    возвращается default_size
+    """
+    page_size = _positive_int(args, "page_size", default_size)
+    if page_size is not None:
+        page_size = min(page_size, max_size)
+    return page_size, _positive_int(args, "page_number", 1)
+
+
+def _dump_value(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _load_value(column, value):
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, UUID):
+        return uuid.UUID(value)
+    return value
+
+
+def encode_cursor(values: Sequence) -> str:
+    """Упаковать значения ключа сортировки в непрозрачную строку"""
+    raw = json.dumps([_dump_value(v) for v in values]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str, columns: Sequence) -> list:
+    """Распаковать строку cursor в значения столбцов columns"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise BadCursor(cursor)
+        return [_load_value(c, v) for (c, v) in zip(columns, values)]
+    except (ValueError, TypeError) as ex:
+        raise BadCursor(cursor) from ex
+
+
+def offset_page(query, page_number: int, page_size: int) -> List:
+    """
+    Вернуть страницу page_number (начиная с 1) запроса query
+
+    В отличие от paginate из Flask-SQLAlchemy не выполняет
+    дополнительный запрос COUNT для подсчета общего числа записей
+    """
+    return query.limit(page_size).offset(max(page_number - 1, 0) * page_size).all()
+
+
+def keyset_page(
+    query,
+    columns: Sequence,
+    cursor: Optional[str],
+    page_size: int,
+    *,
+    descending: bool = False,
+) -> Tuple[List, Optional[str]]:
+    """
+    Вернуть одну страницу запроса query и cursor следующей страницы
+
+    Запрос сортируется по столбцам columns (все по возрастанию или все
+    по убыванию), набор столбцов должен однозначно определять запись.
+    Если следующей страницы нет, вместо cursor возвращается None.
+    """
+    if page_size < 1:
+        raise ValueError(f"page_size must be positive, got {page_size}")
+    if descending:
+        query = query.order_by(None).order_by(*[c.desc() for c in columns])
+    else:
+        query = query.order_by(None).order_by(*columns)
+    if cursor:
+        values = decode_cursor(cursor, columns)
+        key = tuple_(*columns)
+        bound = tuple_(*[literal(v, c.type) for (c, v) in zip(columns, values)])
+        query = query.filter(key < bound if descending else key > bound)
+        # Избыточное условие на первый столбец ключа позволяет Postgres
+        # отбросить лишние секции таблицы и сузить поиск по индексу
+        first = literal(values[0], columns[0].type)
+        query = query.filter(columns[0] <= first if descending else columns[0] >= first)
+    # Запрашиваем на одну запись больше, чтобы узнать, есть ли продолжение
+    items = query.limit(page_size + 1).all()
+    if len(items) <= page_size:
+        return items, None
+    items = items[:page_size]
+    last = items[-1]
+    return items, encode_cursor([getattr(last, c.key) for c in columns])
@@ -1,7 +1,313 @@
 """
 Модуль для хэширования и проверки паролей
+
+Все операции с паролями проходят через единый сервис PasswordHasher.
+Алгоритм и стоимость хэширования задаются в настройках. Вычисление
+хэша занимает процессор надолго, поэтому выполняется в ограниченном
+пуле потоков (или процессов): если пул перегружен дольше, чем
+PASSWORD_HASH_QUEUE_TIMEOUT, запрос отклоняется с ошибкой HasherBusy,
+а не занимает обработчик запросов.
 """
+
+import asyncio
+import re
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
 import bcrypt
+from metrics import PASSWORD_HASH_DURATION
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Пул хэширования перегружен, запрос нужно повторить позже"""
+
+
+class BcryptAlgorithm:
+    """bcrypt, стоимость задается как log2 числа раундов"""
+
+    name = "bcrypt"
+    default_rounds = 12
+
+    # $2b$<стоимость 04-31>$<22 символа соли><31 символ хэша>, всего 60
+    pattern = re.compile(r"\$2[abxy]\$(0[4-9]|[12][0-9]|3[01])\$[./A-Za-z0-9]{53}")
+
+    @staticmethod
+    def identify(hashed: str) -> bool:
+        return hashed.startswith("$2")
+
+    @staticmethod
+    def hash(password: str, rounds: int) -> str:
+        salt = bcrypt.gensalt(rounds=rounds)
+        return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+    @staticmethod
+    def verify(password: str, hashed: str) -> bool:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+    @staticmethod
+    def rounds(hashed: str) -> int:
+        # Формат: $2b$<rounds>$<salt+hash>
+        return int(hashed.split("$")[2])
+
+
+class Pbkdf2Algorithm:
+    """
+    PBKDF2-SHA256 в формате werkzeug: pbkdf2:sha256:<итерации>$<соль>$<хэш>
+
+    Этим же алгоритмом проверяются хэши, созданные ранее через
+    werkzeug.security.generate_password_hash
+    """
+
+    name = "pbkdf2"
+    default_rounds = 260000
+
+    pattern = re.compile(r"pbkdf2:sha256:[1-9][0-9]*\$[A-Za-z0-9]+\$[0-9a-f]{64}")
+
+    @staticmethod
+    def identify(hashed: str) -> bool:
+        return not hashed.startswith("$")
+
+    @staticmethod
+    def hash(password: str, rounds: int) -> str:
+        return generate_password_hash(password, method=f"pbkdf2:sha256:{rounds}")
+
+    @staticmethod
+    def verify(password: str, hashed: str) -> bool:
+        return check_password_hash(hashed, password)
+
+    @staticmethod
+    def rounds(hashed: str) -> int:
+        method = hashed.split("$", 1)[0].split(":")
+        if len(method) != 3 or method[:2] != ["pbkdf2", "sha256"]:
+            return 0
+        return int(method[2])
+
+
+ALGORITHMS = {a.name: a for a in (BcryptAlgorithm, Pbkdf2Algorithm)}
+
+
+def identify_algorithm(hashed: str):
+    """Определить алгоритм, которым был получен хэш"""
+    for algorithm in ALGORITHMS.values():
+        if algorithm.identify(hashed):
+            return algorithm
+    raise ValueError("Unknown password hash format")
+
+
+def valid_hash(hashed) -> bool:
+    """Записан ли хэш полностью в формате одного из алгоритмов"""
+    if not isinstance(hashed, str):
+        return False
+    try:
+        algorithm = identify_algorithm(hashed)
+    except ValueError:
+        return False
+    return algorithm.pattern.fullmatch(hashed) is not None
+
+
+# Функции верхнего уровня, чтобы задачи можно было передавать
+# в пул процессов
+def _hash(algorithm_name: str, password: str, rounds: int) -> str:
+    return ALGORITHMS[algorithm_name].hash(password, rounds)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    try:
+        return identify_algorithm(hashed).verify(password, hashed)
+    except ValueError:
+        # Испорченный хэш (например, неверная соль bcrypt) не совпадает
+        # ни с одним паролем
+        return False
+
+
+class PasswordHasher:
+    """Сервис хэширования паролей с ограниченным пулом исполнителей"""
+
+    def __init__(
+        self,
+        algorithm: str = BcryptAlgorithm.name,
+        rounds: Optional[int] = None,
+        workers: int = 4,
+        queue_size: int = 16,
+        queue_timeout: float = 1.0,
+        executor: str = "thread",
+    ):
+        self.configure(algorithm, rounds, workers, queue_size, queue_timeout, executor)
+
+    def init_app(self, app):
+        self.configure(
+            app.config["PASSWORD_HASH_ALGORITHM"],
+            app.config["PASSWORD_HASH_ROUNDS"],
+            app.config["PASSWORD_HASH_WORKERS"],
+            app.config["PASSWORD_HASH_QUEUE_SIZE"],
+            app.config["PASSWORD_HASH_QUEUE_TIMEOUT"],
+            app.config["PASSWORD_HASH_EXECUTOR"],
+        )
+
+    def configure(
+        self, algorithm, rounds, workers, queue_size, queue_timeout, executor
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown password hash algorithm {algorithm}")
+        self.algorithm = ALGORITHMS[algorithm]
+        self.rounds = rounds or self.algorithm.default_rounds
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.executor_kind = executor
+        # Одновременно в пуле (выполняются или ждут) не более
+        # workers + queue_size задач
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        # Асинхронные задачи, ждущие места: (цикл событий, future)
+        self._waiters = deque()
+        self._waiters_lock = threading.Lock()
+        self._executor: Optional[Executor] = None
+        self._executor_lock = threading.Lock()
+
+    def hash(self, password: str) -> str:
+        """Вычислить хэш пароля настроенным алгоритмом"""
+        with PASSWORD_HASH_DURATION.labels(operation="hash").time():
+            return self._run(_hash, self.algorithm.name, password, self.rounds)
+
+    def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        Вычислить хэши нескольких паролей (при массовом импорте)
+
+        Пароли хэшируются порциями не больше половины исполнителей, так
+        что остальные места в пуле остаются свободными для входа
+        пользователей. HasherBusy означает, что место не освободилось
+        за PASSWORD_HASH_QUEUE_TIMEOUT
+        """
+        size = max(1, self.workers // 2)
+        hashes = []
+        for start in range(0, len(passwords), size):
+            futures = [
+                self._submit(_hash, self.algorithm.name, password, self.rounds)
+                for password in passwords[start : start + size]
+            ]
+            hashes.extend(future.result() for future in futures)
+        return hashes
+
+    def verify(self, password: str, hashed: str) -> bool:
+        """Проверить пароль по хэшу, полученному любым известным алгоритмом"""
+        if not password or not hashed:
+            return False
+        with PASSWORD_HASH_DURATION.labels(operation="verify").time():
+            return self._run(_verify, password, hashed)
+
+    async def hash_async(self, password: str) -> str:
+        """hash для асинхронного режима: цикл событий не блокируется"""
+        with PASSWORD_HASH_DURATION.labels(operation="hash").time():
+            return await self._run_async(
+                _hash, self.algorithm.name, password, self.rounds
+            )
+
+    async def verify_async(self, password: str, hashed: str) -> bool:
+        """verify для асинхронного режима: цикл событий не блокируется"""
+        if not password or not hashed:
+            return False
+        with PASSWORD_HASH_DURATION.labels(operation="verify").time():
+            return await self._run_async(_verify, password, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """
+        Нужно ли пересчитать хэш: он получен другим алгоритмом
+        или с другой стоимостью, чем задано в настройках
+        """
+        try:
+            algorithm = identify_algorithm(hashed)
+        except ValueError:
+            return True
+        return (
+            algorithm is not self.algorithm or algorithm.rounds(hashed) != self.rounds
+        )
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.executor_kind == "process":
+                        self._executor = ProcessPoolExecutor(self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            self.workers, thread_name_prefix="password-hash"
+                        )
+        return self._executor
+
+    def _submit(self, fn, *args) -> Future:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy()
+        return self._start(fn, *args)
+
+    def _start(self, fn, *args) -> Future:
+        """Передать задачу в пул, место в котором уже занято"""
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        """Освободить место в пуле и разбудить одну ждущую асинхронную задачу"""
+        with self._waiters_lock:
+            self._slots.release()
+            self._wake_one()
+
+    def _wake_one(self):
+        # Вызывается под self._waiters_lock
+        if self._waiters:
+            (loop, waiter) = self._waiters.popleft()
+            loop.call_soon_threadsafe(_set_done, waiter)
+
+    def _run(self, fn, *args):
+        return self._submit(fn, *args).result()
+
+    async def _acquire_async(self):
+        """
+        Занять место в пуле, ожидая его в цикле событий без отдельного
+        потока. Место освобождает _release, будя одну ждущую задачу
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        while True:
+            waiter = loop.create_future()
+            with self._waiters_lock:
+                if self._slots.acquire(blocking=False):
+                    return
+                self._waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise HasherBusy() from None
+            finally:
+                with self._waiters_lock:
+                    try:
+                        self._waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Задачу уже разбудили: если она отменена или
+                        # не дождалась, освободившееся место достанется
+                        # следующей
+                        if not waiter.done() or waiter.cancelled():
+                            self._wake_one()
+
+    async def _run_async(self, fn, *args):
+        await self._acquire_async()
+        # Между занятием места и передачей задачи в пул нет await, поэтому
+        # отмена не оставляет место занятым: его освобождает завершение
+        # (или отмена) задачи пула
+        return await asyncio.wrap_future(self._start(fn, *args))
+
+
+def _set_done(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+hasher = PasswordHasher()
 
 
 def hash_password(password_str):
@@ -10,9 +316,7 @@ def hash_password(password_str):
     :param password_str: Полученный от пользователя пароль
     :return: Хэшированный и засоленный пароль для хранения в базе
     """
-
-    hash_and_salt = bcrypt.hashpw(password_str.encode("utf-8"), bcrypt.gensalt())
-    return hash_and_salt.decode("utf-8")
+    return hasher.hash(password_str)
 
 
 def check_password(password_str, hash_and_salt):
@@ -22,5 +326,4 @@ def check_password(password_str, hash_and_salt):
     :param hash_and_salt: полученный из базы хэш пароля
     :return: Возврашаем реузльат рповерки
     """
-    valid = bcrypt.checkpw(password_str.encode("utf-8"), hash_and_salt.encode("utf-8"))
-    return valid
+    return hasher.verify(password_str, hash_and_salt)
@@ -0,0 +1,246 @@
+"""
+Ограничение частоты запросов по алгоритму token bucket
+
+Для каждого ограничиваемого маршрута в Config.RATE_LIMITS задаются
+лимиты по измерениям (ip - адрес клиента, login - имя пользователя)
+в виде "<число запросов>/<секунд>". Корзины хранятся в Redis
+(jwt_redis) и проверяются атомарно одним Lua скриптом сразу по всем
+измерениям запроса. Если Redis недоступен, используются корзины в
+памяти процесса - ограничение становится приблизительным, но
+продолжает действовать.
+
+Корзины измерений из Config.RATE_LIMITS_ON_FAILURE перед запросом
+только проверяются, а списываются обработчиком после неудачной
+попытки (charge_failure): успешные входы не расходуют лимит по имени
+пользователя, и чужими запросами с верным паролем учетную запись не
+заблокировать.
+
+Адрес клиента за обратным прокси берется из X-Forwarded-For с учетом
+Config.PROXY_FIX_HOPS доверенных прокси (werkzeug ProxyFix в
+приложении Flask, client_address для асинхронных обработчиков).
+"""
+
+import math
+import threading
+import time
+from functools import wraps
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from auth_config import Config, jwt_redis
+from flask import request
+from flask.json import jsonify
+
+BUCKET_KEY = "rate_limit:{route}:{dimension}:{value}"
+
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+# KEYS - корзины, ARGV[1] - текущее время, далее тройки
+# (емкость, скорость пополнения в секунду, списание) для каждой корзины.
+# Возвращает {1, 0}, если запрос разрешен, иначе {0, через сколько
+# секунд повторить}
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local allowed = 1
+local retry_after = 0
+local state = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        allowed = 0
+        retry_after = math.max(retry_after, (1 - tokens) / rate)
+    end
+    state[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local tokens = state[i]
+    if allowed == 1 then
+        tokens = tokens - tonumber(ARGV[i * 3 + 1])
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(capacity / rate))
+end
+return {allowed, tostring(retry_after)}
+"""
+
+
+def parse_limit(limit: str) -> Tuple[float, float]:
+    """Разобрать лимит "<число>/<секунд>" в емкость и скорость пополнения"""
+    count, _, seconds = limit.partition("/")
+    capacity = float(count)
+    return capacity, capacity / float(seconds)
+
+
+class LocalBuckets:
+    """Корзины в памяти процесса на случай недоступности Redis"""
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets: List[Tuple[str, float, float, int]], now: float):
+        with self._lock:
+            if len(self._buckets) > self.max_size:
+                self._buckets.clear()
+            allowed = True
+            retry_after = 0.0
+            state = []
+            for (key, capacity, rate, cost) in buckets:
+                (tokens, ts) = self._buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+                if tokens < 1:
+                    allowed = False
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                state.append((key, tokens, cost))
+            for (key, tokens, cost) in state:
+                self._buckets[key] = (tokens - cost if allowed else tokens, now)
+            return allowed, retry_after
+
+
+class RateLimiter:
+    """Проверка лимитов запросов по маршрутам"""
+
+    def __init__(self):
+        self._script = jwt_redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self.local = LocalBuckets()
+
+    def take(
+        self, route: str, values: Dict[str, str], check_only=()
+    ) -> Tuple[bool, float]:
+        """
+        Списать по одному токену из корзин маршрута route для значений
+        измерений values. Корзины измерений check_only только
+        проверяются. Возвращает признак того, что запрос разрешен,
+        и через сколько секунд его можно повторить
+        """
+        buckets = self._buckets(route, values, check_only)
+        if not buckets:
+            return True, 0.0
+        now = time.time()
+        try:
+            reply = self._script(**self._script_args(buckets, now))
+        except REDIS_ERRORS:
+            return self.local.take(buckets, now)
+        return self._result(reply)
+
+    async def take_async(
+        self, redis_client, route: str, values: Dict[str, str], check_only=()
+    ) -> Tuple[bool, float]:
+        """take для асинхронного режима с асинхронным клиентом Redis"""
+        buckets = self._buckets(route, values, check_only)
+        if not buckets:
+            return True, 0.0
+        now = time.time()
+        script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        try:
+            reply = await script(**self._script_args(buckets, now))
+        except REDIS_ERRORS:
+            return self.local.take(buckets, now)
+        return self._result(reply)
+
+    @staticmethod
+    def _buckets(
+        route: str, values: Dict[str, str], check_only=()
+    ) -> List[Tuple[str, float, float, int]]:
+        limits = Config.RATE_LIMITS.get(route, {})
+        buckets = []
+        for (dimension, limit) in limits.items():
+            value = values.get(dimension)
+            if value is None:
+                continue
+            (capacity, rate) = parse_limit(limit)
+            key = BUCKET_KEY.format(route=route, dimension=dimension, value=value)
+            buckets.append((key, capacity, rate, 0 if dimension in check_only else 1))
+        return buckets
+
+    @staticmethod
+    def _script_args(buckets, now: float) -> dict:
+        args = [now]
+        for (_, capacity, rate, cost) in buckets:
+            args.extend([capacity, rate, cost])
+        return {"keys": [key for (key, _, _, _) in buckets], "args": args}
+
+    @staticmethod
+    def _result(reply) -> Tuple[bool, float]:
+        (allowed, retry_after) = reply
+        return bool(int(allowed)), float(retry_after)
+
+
+rate_limiter = RateLimiter()
+
+
+def client_address(remote_addr: str, forwarded_for: Optional[str]) -> str:
+    """
+    Адрес клиента за Config.PROXY_FIX_HOPS доверенными прокси - так же,
+    как его определяет werkzeug ProxyFix. Без прокси или при коротком
+    заголовке X-Forwarded-For - адрес соединения
+    """
+    hops = Config.PROXY_FIX_HOPS
+    if not hops or not forwarded_for:
+        return remote_addr
+    addresses = [address.strip() for address in forwarded_for.split(",")]
+    if len(addresses) < hops:
+        return remote_addr
+    return addresses[-hops]
+
+
+def charge_failure(route: str, values: Dict[str, str]):
+    """
+    Списать токены из корзин Config.RATE_LIMITS_ON_FAILURE[route] после
+    неудачной попытки
+    """
+    dimensions = Config.RATE_LIMITS_ON_FAILURE.get(route, ())
+    rate_limiter.take(route, {d: v for (d, v) in values.items() if d in dimensions})
+
+
+async def charge_failure_async(redis_client, route: str, values: Dict[str, str]):
+    """charge_failure для асинхронного режима с асинхронным клиентом Redis"""
+    dimensions = Config.RATE_LIMITS_ON_FAILURE.get(route, ())
+    await rate_limiter.take_async(
+        redis_client, route, {d: v for (d, v) in values.items() if d in dimensions}
+    )
+
+
+def request_login() -> Optional[str]:
+    """Имя пользователя из параметров или тела запроса"""
+    login = request.args.get("login")
+    if login is None:
+        login = (request.get_json(silent=True) or {}).get("login")
+    return login
+
+
+def rate_limited(route: str):
+    """
+    Декоратор для функций, частота вызова которых ограничена лимитами
+    Config.RATE_LIMITS[route]. При превышении лимита функция не
+    выполняется и возвращается ошибка 429 с заголовком Retry-After.
+    Корзины Config.RATE_LIMITS_ON_FAILURE[route] функция списывает сама
+    через charge_failure.
+    """
+
+    def wrapper(fn):
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            (allowed, retry_after) = rate_limiter.take(
+                route,
+                {"ip": request.remote_addr, "login": request_login()},
+                check_only=Config.RATE_LIMITS_ON_FAILURE.get(route, ()),
+            )
+            if not allowed:
+                response = jsonify({"msg": "Too many requests"})
+                response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+                return response, HTTPStatus.TOO_MANY_REQUESTS
+            return fn(*args, **kwargs)
+
+        return decorated
+
+    return wrapper
@@ -0,0 +1,173 @@
+"""
+Ротация refresh токенов с обнаружением повторного использования
+
+Все refresh токены, полученные по цепочке обновлений от одного входа,
+образуют семейство. Для семейства в Redis хранится хэш с jti
+единственного действующего refresh токена. При обновлении токенов
+предъявленный jti сравнивается с действующим и заменяется новым
+атомарно, Lua скриптом за одно обращение к Redis. Если предъявлен
+уже замененный токен, значит, он был похищен или используется
+повторно - семейство удаляется, и ни один его токен больше не
+принимается.
+
+Refresh токен, выданный до введения семейств (без поля fam), при первом
+обновлении начинает новое семейство. Чтобы его нельзя было предъявить
+повторно, его jti одновременно отмечается как использованный до конца
+срока действия токена. Повторное предъявление такого токена тоже
+считается повторным использованием и удаляет начатое им семейство.
+"""
+
+from datetime import timedelta
+
+from auth_config import jwt_redis
+
+FAMILY_CLAIM = "fam"
+FAMILY_KEY = "refresh_family:{family_id}"
+LEGACY_USED_KEY = "refresh_legacy_used:{jti}"
+
+ROTATED = 1
+UNKNOWN_FAMILY = 0
+REUSE_DETECTED = -1
+
+ROTATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'jti')
+if not current then
+    return 0
+end
+if current ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return -1
+end
+redis.call('HSET', KEYS[1], 'jti', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+# KEYS[1] - отметка об использовании старого токена, KEYS[2] - новое
+# семейство. ARGV: id семейства, срок отметки, jti нового токена,
+# пользователь, срок семейства. Если токен уже использован, возвращает
+# id начатого им семейства
+ADOPT_SCRIPT = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return redis.call('GET', KEYS[1]) or ''
+end
+redis.call('HSET', KEYS[2], 'jti', ARGV[3], 'user_id', ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 1
+"""
+_rotate_script = jwt_redis.register_script(ROTATE_SCRIPT)
+_adopt_script = jwt_redis.register_script(ADOPT_SCRIPT)
+
+
+def start_family(family_id: str, jti: str, user_id: str, ttl: timedelta):
+    """Создать семейство с первым refresh токеном jti"""
+    key = FAMILY_KEY.format(family_id=family_id)
+    pipe = jwt_redis.pipeline(transaction=True)
+    pipe.hset(key, mapping={"jti": jti, "user_id": user_id})
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def rotate(family_id: str, old_jti: str, new_jti: str, ttl: timedelta) -> int:
+    """
+    Заменить действующий refresh токен семейства
+
+    Возвращает ROTATED, если old_jti был действующим токеном,
+    REUSE_DETECTED, если предъявлен уже замененный токен (семейство
+    при этом удаляется), и UNKNOWN_FAMILY, если семейства нет
+    """
+    return int(
+        _rotate_script(
+            keys=[FAMILY_KEY.format(family_id=family_id)],
+            args=[old_jti, new_jti, int(ttl.total_seconds())],
+        )
+    )
+
+
+def _adopt_args(
+    old_jti: str, expires_in: int, family_id: str, jti: str, user_id: str, ttl
+) -> dict:
+    return {
+        "keys": [
+            LEGACY_USED_KEY.format(jti=old_jti),
+            FAMILY_KEY.format(family_id=family_id),
+        ],
+        "args": [family_id, max(1, expires_in), jti, user_id, int(ttl.total_seconds())],
+    }
+
+
+def adopt_legacy_token(
+    old_jti: str,
+    expires_in: int,
+    family_id: str,
+    jti: str,
+    user_id: str,
+    ttl: timedelta,
+) -> int:
+    """
+    Начать семейство для refresh токена old_jti, выданного без семейства,
+    и отметить его использованным на expires_in секунд (остаток срока
+    действия). Возвращает ROTATED или, если токен уже предъявлялся,
+    REUSE_DETECTED, удаляя начатое им ранее семейство
+    """
+    result = _adopt_script(
+        **_adopt_args(old_jti, expires_in, family_id, jti, user_id, ttl)
+    )
+    if result == 1:
+        return ROTATED
+    if result:
+        revoke_family(result)
+    return REUSE_DETECTED
+
+
+def revoke_family(family_id: str):
+    """Удалить семейство, отозвав его refresh токен"""
+    jwt_redis.delete(FAMILY_KEY.format(family_id=family_id))
+
+
+# Варианты для асинхронного режима (asgi.py) с асинхронным клиентом Redis
+
+
+async def start_family_async(
+    redis_client, family_id: str, jti: str, user_id: str, ttl: timedelta
+):
+    key = FAMILY_KEY.format(family_id=family_id)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(key, mapping={"jti": jti, "user_id": user_id})
+    pipe.expire(key, ttl)
+    await pipe.execute()
+
+
+async def rotate_async(
+    redis_client, family_id: str, old_jti: str, new_jti: str, ttl: timedelta
+) -> int:
+    script = redis_client.register_script(ROTATE_SCRIPT)
+    return int(
+        await script(
+            keys=[FAMILY_KEY.format(family_id=family_id)],
+            args=[old_jti, new_jti, int(ttl.total_seconds())],
+        )
+    )
+
+
+async def adopt_legacy_token_async(
+    redis_client,
+    old_jti: str,
+    expires_in: int,
+    family_id: str,
+    jti: str,
+    user_id: str,
+    ttl: timedelta,
+) -> int:
+    script = redis_client.register_script(ADOPT_SCRIPT)
+    result = await script(
+        **_adopt_args(old_jti, expires_in, family_id, jti, user_id, ttl)
+    )
+    if result == 1:
+        return ROTATED
+    if result:
+        await revoke_family_async(redis_client, result)
+    return REUSE_DETECTED
+
+
+async def revoke_family_async(redis_client, family_id: str):
+    await redis_client.delete(FAMILY_KEY.format(family_id=family_id))
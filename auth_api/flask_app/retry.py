@@ -0,0 +1,54 @@
+"""
+Повтор операций при временной недоступности зависимостей
+
+Используется при подготовке базы (flask bootstrap), когда Postgres и
+Redis могут запускаться одновременно с приложением. Число попыток
+ограничено, пауза между ними растет экспоненциально и выбирается
+случайно от нуля до текущего предела (full jitter), чтобы несколько
+процессов не обращались к зависимости одновременно.
+"""
+
+import logging
+import random
+import time
+from typing import Callable, Tuple, Type, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Пауза перед попыткой attempt + 1 (попытки нумеруются с 1)"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def retry(
+    operation: Callable[[], T],
+    exceptions: Tuple[Type[BaseException], ...],
+    *,
+    attempts: int,
+    base_delay: float,
+    max_delay: float,
+    description: str = "operation",
+) -> T:
+    """
+    Выполнить operation, повторяя при исключениях exceptions не более
+    attempts раз. Исключение последней попытки передается вызывающему
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return operation()
+        except exceptions as ex:
+            if attempt >= attempts:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logger.warning(
+                "%s failed (attempt %d of %d), retrying in %.2f s: %s",
+                description,
+                attempt,
+                attempts,
+                delay,
+                ex,
+            )
+            time.sleep(delay)
@@ -0,0 +1,247 @@
+"""
+Локальный фильтр отозванных токенов
+
+Каждый рабочий процесс держит фильтр Блума с идентификаторами (jti)
+отозванных токенов. Токен, которого нет в фильтре, гарантированно
+не отозван, и проверка обходится без обращения к Redis. Только при
+попадании в фильтр наличие токена в списке отзыва подтверждается
+запросом к Redis.
+
+Отзывы из других процессов попадают в фильтр из ленты REVOKED_SET_KEY -
+сортированного множества, в котором каждому отзыву сервер Redis
+присваивает очередной номер счетчика REVOKED_SEQ_KEY (запись и номер
+выдаются одним Lua скриптом). Не реже раза в REVOKED_FILTER_SYNC_INTERVAL
+секунд процесс забирает из ленты записи с номерами больше последнего
+полученного. Порядок ленты не зависит от часов процессов, поэтому
+отзыв из процесса с отстающими часами не пропускается. Токен,
+отозванный в другом процессе, может приниматься еще до
+REVOKED_FILTER_SYNC_INTERVAL секунд. Если счетчик оказался меньше
+последнего полученного номера (данные Redis потеряны), лента
+перечитывается с начала.
+
+В ленте хранится не больше REVOKED_FILTER_CAPACITY последних отзывов -
+столько, на сколько рассчитан фильтр.
+
+Отозванный токен нужно помнить только до истечения его срока
+действия, поэтому фильтр состоит из двух поколений, которые
+сменяются каждые ACCESS_EXPIRES: запись живет в фильтре от одного
+до двух сроков действия токена.
+
+Отзывы, сделанные до появления ленты, записаны в Redis только ключом
+jti. Поэтому время появления ленты хранится в REVOKED_SINCE_KEY (его
+записывает первый запустившийся процесс), и токены, выданные не позже
+этого времени, проверяются в Redis независимо от фильтра. Такие токены
+перестают встречаться через ACCESS_EXPIRES после обновления. При
+поэтапном обновлении отзыв, сделанный еще не обновленным процессом,
+виден остальным только для токенов, выданных до этого времени.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from auth_config import jwt_redis
+
+REVOKED_SET_KEY = "revoked_jtis"
+REVOKED_SEQ_KEY = "revoked_jtis:seq"
+REVOKED_SINCE_KEY = "revoked_jtis:since"
+
+# KEYS[1] - jti, KEYS[2] - лента отзывов, KEYS[3] - счетчик ленты
+# ARGV[1] - время жизни записи о токене (с), ARGV[2] - размер ленты
+REVOKE_SCRIPT = """
+redis.call('SET', KEYS[1], '', 'EX', ARGV[1])
+local seq = redis.call('INCR', KEYS[3])
+redis.call('ZADD', KEYS[2], seq, KEYS[1])
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+return seq
+"""
+
+
+class BloomFilter:
+    """Фильтр Блума на заданное число элементов и долю ложных срабатываний"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item)
+        )
+
+
+class RevokedTokenFilter:
+    """Список отозванных токенов с локальным фильтром перед Redis"""
+
+    def __init__(self, app=None):
+        self.redis = None
+        self.hits = 0
+        self.misses = 0
+        self.false_positives = 0
+        self.syncs = 0
+        self.legacy_checks = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = jwt_redis
+        self.ttl = app.config["ACCESS_EXPIRES"]
+        self.capacity = app.config["REVOKED_FILTER_CAPACITY"]
+        self.error_rate = app.config["REVOKED_FILTER_ERROR_RATE"]
+        self.sync_interval = app.config["REVOKED_FILTER_SYNC_INTERVAL"]
+        self._current = BloomFilter(self.capacity, self.error_rate)
+        self._previous = BloomFilter(self.capacity, self.error_rate)
+        self._rotated_at = time.time()
+        self._synced_at = 0.0
+        self._last_seq = 0
+        # Время появления ленты отзывов (unix time), читается при
+        # первой синхронизации
+        self._legacy_before = None
+        self._revoke_script = jwt_redis.register_script(REVOKE_SCRIPT)
+
+    def revoke(self, jti: str, expires: timedelta = None):
+        """Отозвать токен: записать его в Redis и в локальный фильтр"""
+        self._revoke_script(**self._revoke_args(jti, expires))
+        with self._lock:
+            self._current.add(jti)
+
+    def is_revoked(self, jti: str, issued_at: float = None) -> bool:
+        """Проверить, отозван ли токен, выданный в issued_at (поле iat)"""
+        if self._sync_due():
+            self._apply_sync(*self._sync_pipeline(self.redis).execute())
+        if self._maybe_revoked(jti):
+            return self._confirm(self.redis.get(jti))
+        if self._legacy(issued_at):
+            return self.redis.get(jti) is not None
+        return False
+
+    async def revoke_async(self, redis_client, jti: str, expires: timedelta = None):
+        """revoke для асинхронного режима с асинхронным клиентом Redis"""
+        script = redis_client.register_script(REVOKE_SCRIPT)
+        await script(**self._revoke_args(jti, expires))
+        with self._lock:
+            self._current.add(jti)
+
+    async def is_revoked_async(
+        self, redis_client, jti: str, issued_at: float = None
+    ) -> bool:
+        """is_revoked для асинхронного режима с асинхронным клиентом Redis"""
+        if self._sync_due():
+            self._apply_sync(*await self._sync_pipeline(redis_client).execute())
+        if self._maybe_revoked(jti):
+            return self._confirm(await redis_client.get(jti))
+        if self._legacy(issued_at):
+            return await redis_client.get(jti) is not None
+        return False
+
+    def _revoke_args(self, jti: str, expires: timedelta) -> dict:
+        expires = expires or self.ttl
+        return {
+            "keys": [jti, REVOKED_SET_KEY, REVOKED_SEQ_KEY],
+            "args": [int(expires.total_seconds()), self.capacity],
+        }
+
+    def _maybe_revoked(self, jti: str) -> bool:
+        with self._lock:
+            maybe_revoked = jti in self._current or jti in self._previous
+        if maybe_revoked:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return maybe_revoked
+
+    def _legacy(self, issued_at) -> bool:
+        """
+        Выдан ли токен до появления ленты: его отзыв мог попасть только
+        в Redis
+        """
+        legacy_before = self._legacy_before
+        if issued_at is not None and legacy_before is not None:
+            if issued_at > legacy_before:
+                return False
+        self.legacy_checks += 1
+        return True
+
+    def _confirm(self, value) -> bool:
+        """Результат проверки токена, попавшего в фильтр, по ответу Redis"""
+        if value is None:
+            self.false_positives += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        """Счетчики работы фильтра"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "false_positives": self.false_positives,
+            "syncs": self.syncs,
+            "legacy_checks": self.legacy_checks,
+            "size_bits": self._current.size,
+            "hashes": self._current.hashes,
+        }
+
+    def _sync_due(self) -> bool:
+        """
+        Пора ли забрать новые отзывы из Redis. Заодно сменяет поколения
+        фильтра
+        """
+        now = time.time()
+        if now - self._synced_at < self.sync_interval:
+            return False
+        with self._lock:
+            if now - self._synced_at < self.sync_interval:
+                return False
+            self._synced_at = now
+            if now - self._rotated_at >= self.ttl.total_seconds():
+                self._previous = self._current
+                self._current = BloomFilter(self.capacity, self.error_rate)
+                self._rotated_at = now
+        return True
+
+    def _sync_pipeline(self, redis_client):
+        """
+        Номер последнего отзыва и отзывы после последнего полученного, а
+        при первой синхронизации - еще и время появления ленты
+        """
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(REVOKED_SEQ_KEY)
+        pipe.zrangebyscore(
+            REVOKED_SET_KEY, f"({self._last_seq}", "+inf", withscores=True
+        )
+        if self._legacy_before is None:
+            pipe.set(REVOKED_SINCE_KEY, int(time.time()), nx=True)
+            pipe.get(REVOKED_SINCE_KEY)
+        return pipe
+
+    def _apply_sync(self, seq, entries, *since):
+        with self._lock:
+            if since:
+                self._legacy_before = float(since[-1])
+            if int(seq or 0) < self._last_seq:
+                # Счетчик начался заново: перечитать ленту при следующей
+                # проверке
+                self._last_seq = 0
+                self._synced_at = 0.0
+                return
+            for jti, score in entries:
+                self._current.add(jti)
+                self._last_seq = max(self._last_seq, int(score))
+            self.syncs += 1
+
+
+revoked_filter = RevokedTokenFilter()
@@ -0,0 +1,340 @@
+"""
+Подпись JWT токенов асимметричными ключами и публикация JWKS
+
+Токены подписываются закрытым ключом RS256 или EdDSA (Ed25519), а
+открытые ключи публикуются по адресу /.well-known/jwks.json. Другие
+сервисы проверяют токены сами, по открытым ключам, без обращения к
+сервису авторизации и без общего секрета (см. пакет jwt_verifier).
+Каждый токен содержит в заголовке идентификатор ключа kid.
+
+Ключи хранятся в каталоге JWT_KEYS_PATH:
+
+- <kid>.pem - закрытый ключ, которым можно подписывать токены;
+- <kid>.pub.pem - открытый ключ выведенного из оборота ключа, он
+  только публикуется, пока не истекут подписанные им токены.
+
+Смена ключа выполняется командой "flask keys rotate": новый ключ
+сразу публикуется в JWKS, но подписывать токены начинает только через
+JWT_KEY_ACTIVATION_DELAY секунд, когда закэшированные другими
+сервисами наборы ключей уже обновились. Старый ключ выводится из
+оборота командой "flask keys retire <kid>", а файл его открытого
+ключа удаляется вручную после JWT_REFRESH_TOKEN_EXPIRES.
+
+Каждый процесс перечитывает каталог ключей не чаще, чем раз в
+JWT_KEYS_RELOAD_INTERVAL секунд, и только если каталог изменился.
+
+Ключи не создаются при запуске: все процессы и реплики должны
+подписывать токены одними ключами, поэтому каталог заранее готовится
+командой "python -m signing_keys init" и подключается ко всем
+процессам общим томом. Без ключей приложение не запускается. Команды
+работы с ключами не требуют загрузки приложения и доступны также как
+"python -m signing_keys ...".
+
+При JWT_ALGORITHM=HS256 (по умолчанию) токены, как и прежде,
+подписываются общим секретом JWT_SECRET_KEY.
+"""
+
+import base64
+import datetime
+import hashlib
+import os
+import secrets
+import threading
+import time
+from typing import Optional
+
+import click
+from auth_config import Config, jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from flasgger.utils import swag_from
+from flask import Response, json, request
+from jwt.exceptions import InvalidTokenError
+
+JWKS_PATH = "/.well-known/jwks.json"
+PRIVATE_SUFFIX = ".pem"
+PUBLIC_SUFFIX = ".pub.pem"
+# Идентификатор ключа начинается с времени его создания (UTC)
+KID_TIME_FORMAT = "%Y%m%d%H%M%S"
+KEY_TYPES = {"RS256": rsa.RSAPrivateKey, "EdDSA": ed25519.Ed25519PrivateKey}
+
+
+def generate_private_key(algorithm: str):
+    if algorithm == "EdDSA":
+        return ed25519.Ed25519PrivateKey.generate()
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def new_kid(now: datetime.datetime) -> str:
+    return f"{now.strftime(KID_TIME_FORMAT)}-{secrets.token_hex(4)}"
+
+
+def kid_created(kid: str) -> float:
+    """Время создания ключа (unix time) по его идентификатору"""
+    created = datetime.datetime.strptime(kid.split("-", 1)[0], KID_TIME_FORMAT)
+    return created.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _write_exclusive(path: str, data: bytes, mode: int):
+    """Записать новый файл, не перезаписывая существующий"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _int_b64(value: int) -> str:
+    return _b64(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+
+def public_jwk(kid: str, public_key) -> dict:
+    """Открытый ключ в формате JWK (RFC 7517)"""
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        raw = public_key.public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        return {
+            "kty": "OKP",
+            "crv": "Ed25519",
+            "x": _b64(raw),
+            "alg": "EdDSA",
+            "use": "sig",
+            "kid": kid,
+        }
+    numbers = public_key.public_numbers()
+    return {
+        "kty": "RSA",
+        "n": _int_b64(numbers.n),
+        "e": _int_b64(numbers.e),
+        "alg": "RS256",
+        "use": "sig",
+        "kid": kid,
+    }
+
+
+class KeySet:
+    """Прочитанное из каталога состояние ключей"""
+
+    def __init__(self, private_keys: dict, public_keys: dict):
+        # Закрытые ключи, которыми можно подписывать, по kid
+        self.private_keys = private_keys
+        # Открытые ключи всех опубликованных ключей по kid
+        self.public_keys = public_keys
+        self.jwks = json.dumps(
+            {
+                "keys": [
+                    public_jwk(kid, key)
+                    for (kid, key) in sorted(public_keys.items(), reverse=True)
+                ]
+            }
+        )
+        self.etag = hashlib.sha256(self.jwks.encode("utf-8")).hexdigest()[:32]
+
+    def signing_kid(self, now: float, activation_delay: float) -> str:
+        """
+        Ключ для подписи: самый новый из ключей, опубликованных не
+        менее activation_delay секунд назад, а если таких нет - самый
+        новый из имеющихся
+        """
+        kids = sorted(self.private_keys, reverse=True)
+        for kid in kids:
+            if kid_created(kid) <= now - activation_delay:
+                return kid
+        return kids[0]
+
+
+def load_keys(path: str, algorithm: str) -> KeySet:
+    """Прочитать ключи алгоритма algorithm из каталога path"""
+    private_keys = {}
+    public_keys = {}
+    for name in os.listdir(path):
+        filepath = os.path.join(path, name)
+        with open(filepath, "rb") as f:
+            data = f.read()
+        if name.endswith(PUBLIC_SUFFIX):
+            kid = name[: -len(PUBLIC_SUFFIX)]
+            public_keys[kid] = serialization.load_pem_public_key(data)
+        elif name.endswith(PRIVATE_SUFFIX):
+            kid = name[: -len(PRIVATE_SUFFIX)]
+            key = serialization.load_pem_private_key(data, password=None)
+            if not isinstance(key, KEY_TYPES[algorithm]):
+                continue
+            private_keys[kid] = key
+            public_keys[kid] = key.public_key()
+    return KeySet(private_keys, public_keys)
+
+
+def create_key(path: str, algorithm: str) -> str:
+    """Создать в каталоге path новый закрытый ключ, вернуть его kid"""
+    kid = new_kid(datetime.datetime.utcnow())
+    pem = generate_private_key(algorithm).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    _write_exclusive(os.path.join(path, kid + PRIVATE_SUFFIX), pem, 0o600)
+    return kid
+
+
+def retire_key(path: str, kid: str):
+    """
+    Вывести ключ из оборота: оставить только открытый ключ, чтобы
+    подписанные им токены проверялись до истечения их срока
+    """
+    private_path = os.path.join(path, kid + PRIVATE_SUFFIX)
+    with open(private_path, "rb") as f:
+        key = serialization.load_pem_private_key(f.read(), password=None)
+    pem = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    _write_exclusive(os.path.join(path, kid + PUBLIC_SUFFIX), pem, 0o644)
+    os.remove(private_path)
+
+
+class SigningKeys:
+    """Ключи подписи токенов приложения"""
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.algorithm: Optional[str] = None
+        self.keys: Optional[KeySet] = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def init_app(self, app):
+        self.algorithm = app.config["JWT_ALGORITHM"]
+        if self.algorithm not in KEY_TYPES:
+            return
+        self.path = Config.JWT_KEYS_PATH
+        if not os.path.isdir(self.path):
+            raise RuntimeError(f"Signing keys directory {self.path} does not exist")
+        self.reload()
+        if not self.keys.private_keys:
+            raise RuntimeError(
+                f"No {self.algorithm} signing keys in {self.path}: "
+                "create one with 'python -m signing_keys init'"
+            )
+        jwt.encode_key_loader(self.encode_key)
+        jwt.decode_key_loader(self.decode_key)
+        jwt.additional_headers_loader(self.headers)
+        app.add_url_rule(JWKS_PATH, "jwks", jwks)
+
+    def reload(self):
+        """Перечитать каталог ключей"""
+        with self._lock:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            self._checked = time.monotonic()
+            self.keys = load_keys(self.path, self.algorithm)
+
+    def current(self, force: bool = False) -> KeySet:
+        """Ключи с учетом изменений каталога"""
+        now = time.monotonic()
+        if force or now - self._checked >= Config.JWT_KEYS_RELOAD_INTERVAL:
+            self._checked = now
+            if os.stat(self.path).st_mtime_ns != self._mtime:
+                self.reload()
+        return self.keys
+
+    def headers(self, identity) -> dict:
+        # Ключ выбирается один раз на токен: flask_jwt_extended сначала
+        # запрашивает заголовки, затем ключ подписи
+        keys = self.current()
+        kid = keys.signing_kid(time.time(), Config.JWT_KEY_ACTIVATION_DELAY)
+        self._local.key = keys.private_keys[kid]
+        return {"kid": kid}
+
+    def encode_key(self, identity):
+        key = self._local.key
+        self._local.key = None
+        return key
+
+    def decode_key(self, jwt_header: dict, jwt_payload: dict):
+        kid = jwt_header.get("kid")
+        key = self.current().public_keys.get(kid)
+        if key is None and kid is not None:
+            # Ключ мог появиться в другом процессе после последней проверки
+            key = self.current(force=True).public_keys.get(kid)
+        if key is None:
+            raise InvalidTokenError(f"Unknown signing key: {kid}")
+        return key
+
+
+signing_keys = SigningKeys()
+
+
+@swag_from("schemes/jwks_get.yaml")
+def jwks():
+    """
+    Открытые ключи для проверки подписи токенов (JWKS)
+    """
+    keys = signing_keys.current()
+    response = Response(keys.jwks, mimetype="application/json")
+    response.set_etag(keys.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = Config.JWKS_MAX_AGE
+    return response.make_conditional(request)
+
+
+# Команды не используют приложение: первый ключ создается до того, как
+# приложение сможет запуститься
+keys_cli = click.Group("keys", help="Ключи подписи токенов")
+
+
+@keys_cli.command("init")
+def init_command():
+    """Создать первый ключ подписи, если ключей еще нет"""
+    os.makedirs(Config.JWT_KEYS_PATH, mode=0o700, exist_ok=True)
+    keys = load_keys(Config.JWT_KEYS_PATH, Config.JWT_ALGORITHM)
+    if keys.private_keys:
+        click.echo(f"keys exist: {', '.join(sorted(keys.private_keys))}")
+        return
+    kid = create_key(Config.JWT_KEYS_PATH, Config.JWT_ALGORITHM)
+    click.echo(f"created: {kid}")
+
+
+@keys_cli.command("rotate")
+def rotate_command():
+    """Создать новый ключ подписи"""
+    os.makedirs(Config.JWT_KEYS_PATH, mode=0o700, exist_ok=True)
+    kid = create_key(Config.JWT_KEYS_PATH, Config.JWT_ALGORITHM)
+    click.echo(
+        f"created: {kid}, signing starts in {Config.JWT_KEY_ACTIVATION_DELAY:g}s"
+    )
+
+
+@keys_cli.command("retire")
+@click.argument("kid")
+def retire_command(kid):
+    """Вывести ключ из оборота, оставив только открытый ключ"""
+    keys = load_keys(Config.JWT_KEYS_PATH, Config.JWT_ALGORITHM)
+    if kid not in keys.private_keys:
+        raise click.ClickException(f"no private key {kid}")
+    if len(keys.private_keys) == 1:
+        raise click.ClickException("cannot retire the only signing key")
+    retire_key(Config.JWT_KEYS_PATH, kid)
+    click.echo(f"retired: {kid}")
+
+
+@keys_cli.command("list")
+def list_command():
+    """Список ключей"""
+    keys = load_keys(Config.JWT_KEYS_PATH, Config.JWT_ALGORITHM)
+    active = keys.signing_kid(time.time(), Config.JWT_KEY_ACTIVATION_DELAY)
+    for kid in sorted(keys.public_keys, reverse=True):
+        if kid == active:
+            state = "signing"
+        elif kid in keys.private_keys:
+            state = "published"
+        else:
+            state = "retired"
+        click.echo(f"{kid} {state}")
+
+
+if __name__ == "__main__":
+    keys_cli()
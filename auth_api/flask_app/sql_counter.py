@@ -0,0 +1,61 @@
+"""
+Подсчет SQL запросов, выполненных при обработке HTTP запроса
+
+Счетчик увеличивается при каждом обращении к базе через любой engine
+приложения (основной сервер и реплики), а время выполнения запросов
+суммируется в g.sql_duration для метрик (см. metrics). Если включен параметр
+SQL_COUNT_HEADER, число запросов возвращается клиенту в заголовке
+X-SQL-Statements: по нему тесты проверяют, что обработчики укладываются
+в заданное число запросов (бюджет) независимо от объема данных.
+"""
+
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SQL_STATEMENTS_HEADER = "X-SQL-Statements"
+
+
+class SqlCounter:
+    """Счетчик SQL запросов текущего HTTP запроса"""
+
+    def __init__(self):
+        self.header = False
+        self._listening = False
+
+    def init_app(self, app):
+        self.header = app.config["SQL_COUNT_HEADER"]
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._count)
+            event.listen(Engine, "after_cursor_execute", self._measure)
+            self._listening = True
+        app.after_request(self._add_header)
+
+    @staticmethod
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.sql_statements = g.get("sql_statements", 0) + 1
+            context._sql_started = time.perf_counter()
+
+    @staticmethod
+    def _measure(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_sql_started", None)
+        if started is not None and has_request_context():
+            g.sql_duration = g.get("sql_duration", 0.0) + (
+                time.perf_counter() - started
+            )
+
+    @staticmethod
+    def statements() -> int:
+        """Сколько SQL запросов выполнено с начала HTTP запроса"""
+        return g.get("sql_statements", 0)
+
+    def _add_header(self, response):
+        if self.header:
+            response.headers[SQL_STATEMENTS_HEADER] = str(self.statements())
+        return response
+
+
+sql_counter = SqlCounter()
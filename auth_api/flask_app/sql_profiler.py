@@ -0,0 +1,214 @@
+"""
+Профилирование SQL запросов, выполненных при обработке HTTP запроса
+
+Включается для всех запросов (SQL_PROFILE=true) или для случайной
+доли запросов SQL_PROFILE_SAMPLE_RATE (от 0 до 1). Для профилируемого
+запроса записывается каждый SQL запрос и время его выполнения, а
+после обработки
+
+- в журнал пишется предупреждение, если запрос одного вида (текст
+  с отброшенными значениями параметров) выполнен не менее
+  SQL_PROFILE_REPEAT_THRESHOLD раз - признак N+1;
+- если обработка заняла больше SQL_PROFILE_SLOW_MS миллисекунд, в
+  журнал пишется самый долгий SQL запрос, а затем его план EXPLAIN
+  ANALYZE (для запросов, изменяющих данные, - EXPLAIN без выполнения).
+  План получается повторным выполнением запроса в отдельной
+  транзакции, которая затем откатывается. Это делается в фоновом
+  потоке, не чаще раза в SQL_PROFILE_EXPLAIN_INTERVAL секунд и не
+  больше одного плана одновременно, чтобы ответ не ждал EXPLAIN и не
+  занимал второе соединение пула. Запросы с блокировкой строк
+  (SELECT ... FOR UPDATE/SHARE) повторно не выполняются: повтор снова
+  захватил бы блокировки;
+- в ответ добавляется заголовок Server-Timing с временем обработки,
+  временем и числом SQL запросов.
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+PARAMETER = re.compile(r"%\(\w+\)s|%s|\?")
+PARAMETER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+SPACES = re.compile(r"\s+")
+LOCKING = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.I)
+MODIFYING = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.I)
+
+
+def statement_shape(statement: str) -> str:
+    """Вид SQL запроса: текст без значений и числа параметров списков IN"""
+    shape = PARAMETER.sub("?", statement)
+    shape = PARAMETER_LIST.sub("?, ...", shape)
+    return SPACES.sub(" ", shape).strip()
+
+
+class ProfiledStatement:
+    """Выполненный SQL запрос"""
+
+    def __init__(self, engine, statement: str, parameters, executemany: bool):
+        self.engine = engine
+        self.statement = statement
+        self.parameters = parameters
+        self.executemany = executemany
+        self.duration = 0.0
+
+
+class SqlProfiler:
+    """Профилирование SQL запросов выбранных HTTP запросов"""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_ms = 0.0
+        self.repeat_threshold = 0
+        self.explain_interval = 0.0
+        self._listening = False
+        self._explain_lock = threading.Lock()
+        self._explaining = False
+        self._explained_at = None
+
+    def init_app(self, app):
+        self.sample_rate = (
+            1.0 if app.config["SQL_PROFILE"] else app.config["SQL_PROFILE_SAMPLE_RATE"]
+        )
+        self.slow_ms = app.config["SQL_PROFILE_SLOW_MS"]
+        self.repeat_threshold = app.config["SQL_PROFILE_REPEAT_THRESHOLD"]
+        self.explain_interval = app.config["SQL_PROFILE_EXPLAIN_INTERVAL"]
+        if self.sample_rate <= 0:
+            return
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._before)
+            event.listen(Engine, "after_cursor_execute", self._after)
+            self._listening = True
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _start(self):
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            g.sql_profile = []
+            g.sql_profile_started = time.perf_counter()
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context() or g.get("sql_profile") is None:
+            return
+        item = ProfiledStatement(conn.engine, statement, parameters, executemany)
+        g.sql_profile.append(item)
+        context._profiled = (item, time.perf_counter())
+
+    @staticmethod
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        profiled = getattr(context, "_profiled", None)
+        if profiled is not None:
+            (item, started) = profiled
+            item.duration = time.perf_counter() - started
+
+    def _finish(self, response):
+        statements: Optional[List[ProfiledStatement]] = g.get("sql_profile")
+        if statements is None:
+            return response
+        g.sql_profile = None
+        elapsed_ms = (time.perf_counter() - g.sql_profile_started) * 1000
+        sql_ms = sum(item.duration for item in statements) * 1000
+        response.headers.add(
+            "Server-Timing",
+            f'sql;dur={sql_ms:.1f};desc="{len(statements)} queries", '
+            f"app;dur={elapsed_ms:.1f}",
+        )
+        self._report_repeats(statements)
+        if statements and elapsed_ms >= self.slow_ms:
+            self._report_slow(statements, elapsed_ms, sql_ms)
+        return response
+
+    def _report_repeats(self, statements: List[ProfiledStatement]):
+        shapes = Counter(statement_shape(item.statement) for item in statements)
+        for (shape, count) in shapes.items():
+            if count >= self.repeat_threshold:
+                logger.warning(
+                    "Repeated SQL (%d times) in %s: %s", count, _endpoint(), shape
+                )
+
+    def _report_slow(self, statements, elapsed_ms: float, sql_ms: float):
+        worst = max(statements, key=lambda item: item.duration)
+        statement = SPACES.sub(" ", worst.statement).strip()
+        logger.warning(
+            "Slow request %s: %.1f ms, SQL %.1f ms in %d queries, "
+            "slowest %.1f ms: %s",
+            _endpoint(),
+            elapsed_ms,
+            sql_ms,
+            len(statements),
+            worst.duration * 1000,
+            statement,
+        )
+        if self._claim_explain():
+            threading.Thread(
+                target=self._explain_in_background,
+                args=(worst, _endpoint(), statement),
+                name="sql-explain",
+                daemon=True,
+            ).start()
+
+    def _claim_explain(self) -> bool:
+        """Можно ли сейчас получить план: не чаще explain_interval и по одному"""
+        now = time.monotonic()
+        with self._explain_lock:
+            if self._explaining or (
+                self._explained_at is not None
+                and now - self._explained_at < self.explain_interval
+            ):
+                return False
+            self._explaining = True
+            self._explained_at = now
+        return True
+
+    def _explain_in_background(self, item, endpoint: str, statement: str):
+        try:
+            logger.warning(
+                "Plan of %s slowest SQL %s\n%s", endpoint, statement, explain(item)
+            )
+        finally:
+            with self._explain_lock:
+                self._explaining = False
+
+
+def explain(item: ProfiledStatement) -> str:
+    """
+    План выполнения запроса. Запрос выполняется повторно в отдельной
+    транзакции, которая откатывается
+    """
+    if item.executemany:
+        return "(executemany, no plan)"
+    if LOCKING.search(item.statement):
+        return "(locking statement, no plan)"
+    analyze = item.statement.lstrip().upper().startswith(
+        ("SELECT", "WITH")
+    ) and not MODIFYING.search(item.statement)
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    try:
+        with item.engine.connect() as conn:
+            transaction = conn.begin()
+            try:
+                rows = conn.exec_driver_sql(
+                    prefix + item.statement, item.parameters or {}
+                ).fetchall()
+            finally:
+                transaction.rollback()
+    except Exception as ex:
+        return f"(no plan: {ex})"
+    return "\n".join(row[0] for row in rows)
+
+
+def _endpoint() -> str:
+    return f"{request.method} {request.path}"
+
+
+sql_profiler = SqlProfiler()
@@ -1,4 +1,8 @@
+from auth_config import db
+from db_pool import pool_status
 from flask import Blueprint
+from flask.json import jsonify
+from revoked_filter import revoked_filter
 
 test_bp = Blueprint("test_bp", __name__)
 
@@ -6,3 +10,15 @@ test_bp = Blueprint("test_bp", __name__)
 @test_bp.route("/", methods=["GET"])
 def test():
     return "It works!"
+
+
+@test_bp.route("/revoked_filter", methods=["GET"])
+def revoked_filter_stats():
+    """Счетчики локального фильтра отозванных токенов этого процесса"""
+    return jsonify(revoked_filter.stats())
+
+
+@test_bp.route("/pool", methods=["GET"])
+def pool_stats():
+    """Состояние пула соединений с базой этого процесса"""
+    return jsonify(pool_status(db.engine))
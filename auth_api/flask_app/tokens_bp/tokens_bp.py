@@ -0,0 +1,34 @@
+from http import HTTPStatus
+
+from decorators import service_or_admin_required
+from flasgger.utils import swag_from
+from flask import Blueprint, request
+from flask.json import jsonify
+from introspection import TooManyTokens, introspect
+from schema_validation import validate_body
+
+tokens_bp = Blueprint("tokens_bp", __name__)
+
+
+@tokens_bp.route("/introspect", methods=["POST"])
+@service_or_admin_required()
+@validate_body
+@swag_from("../schemes/tokens_introspect_post.yaml", methods=["POST"])
+def introspect_tokens():
+    """
+    Проверить сразу много токенов: подпись, срок действия и отзыв.
+    Доступно сервисам с общим секретом и администраторам
+
+    Результаты возвращаются в порядке переданных токенов
+    """
+    tokens = (request.get_json(silent=True) or {}).get("tokens")
+    if not isinstance(tokens, list):
+        return jsonify({"error": "tokens list expected"}), HTTPStatus.BAD_REQUEST
+    try:
+        results = introspect(tokens)
+    except TooManyTokens:
+        return (
+            jsonify({"error": "too many tokens"}),
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+    return jsonify({"items": results})
@@ -0,0 +1,308 @@
+"""
+Асинхронные обработчики выдачи и отзыва токенов (режим ASGI)
+
+login, refresh и logout из users_bp почти все время ждут ответов
+Postgres и Redis. В режиме ASGI (asgi.py) они выполняются в цикле
+событий: база - через asyncpg (aio.session), Redis - через асинхронный
+клиент (aio.redis), а проверка и хэширование паролей - в пуле
+password_hash без блокировки цикла. Модели, настройки, ключи Redis,
+проверка отзыва токенов и формат ответов те же, что у синхронных
+обработчиков. Соединение с базой занято только на время запроса, а
+не на время проверки пароля.
+"""
+
+import math
+import time
+import uuid
+from functools import wraps
+from http import HTTPStatus
+from typing import Optional
+
+from aio import aio
+from auth_config import Config
+from db_models import User
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from history_sink import history_sink
+from jwt.exceptions import InvalidTokenError
+from jwt_claims import token_claims_async, token_generation_revoked_async
+from metrics import REQUEST_DURATION, TOKEN_REVOCATION_CHECK_DURATION
+from password_hash import HasherBusy, hasher
+from rate_limit import charge_failure_async, client_address, rate_limiter
+from refresh_families import (
+    FAMILY_CLAIM,
+    REUSE_DETECTED,
+    ROTATED,
+    adopt_legacy_token_async,
+    revoke_family_async,
+    rotate_async,
+    start_family_async,
+)
+from revoked_filter import revoked_filter
+from sqlalchemy import select, update
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from users_bp.users_bp import sign_tokens
+
+
+class BadToken(Exception):
+    """Токен не прошел проверку"""
+
+
+# Ошибки проверки самого токена - ответ 401. Ошибки Redis и базы при
+# проверке отзыва сюда не входят и приводят к ответу 500
+TOKEN_ERRORS = (BadToken, InvalidTokenError, JWTExtendedException)
+
+
+def json_response(body, status: int = HTTPStatus.OK, headers: dict = None):
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+def server_busy():
+    """Ответ на запрос, для которого не нашлось свободного обработчика паролей"""
+    return json_response(
+        {"msg": "Server is busy, try again later"},
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        {"Retry-After": "1"},
+    )
+
+
+def observed(fn):
+    """
+    Время обработки запроса в метриках под именем синхронного
+    обработчика users_bp
+    """
+    endpoint = f"users_bp.{fn.__name__}"
+
+    @wraps(fn)
+    async def decorated(request: Request):
+        started = time.perf_counter()
+        response = await fn(request)
+        REQUEST_DURATION.labels(
+            blueprint="users_bp",
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        ).observe(time.perf_counter() - started)
+        return response
+
+    return decorated
+
+
+async def rate_limit_exceeded(
+    request: Request, route: str, login
+) -> Optional[JSONResponse]:
+    """Ответ 429, если исчерпан лимит Config.RATE_LIMITS[route]"""
+    address = client_address(
+        request.client.host, request.headers.get("X-Forwarded-For")
+    )
+    (allowed, retry_after) = await rate_limiter.take_async(
+        aio.redis,
+        route,
+        {"ip": address, "login": login},
+        check_only=Config.RATE_LIMITS_ON_FAILURE.get(route, ()),
+    )
+    if allowed:
+        return None
+    return json_response(
+        {"msg": "Too many requests"},
+        HTTPStatus.TOO_MANY_REQUESTS,
+        {"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+async def token_is_revoked(claims: dict) -> bool:
+    """То же, что users_bp.check_if_token_is_revoked"""
+    with TOKEN_REVOCATION_CHECK_DURATION.time():
+        if await token_generation_revoked_async(aio.redis, claims):
+            return True
+        return await revoked_filter.is_revoked_async(
+            aio.redis, claims["jti"], claims.get("iat")
+        )
+
+
+async def verified_claims(request: Request, refresh: bool) -> dict:
+    """
+    Поля токена из заголовка Authorization. Подпись и срок действия
+    проверяются так же, как в verify_jwt_in_request, отзыв - через
+    асинхронный клиент Redis
+    """
+    (scheme, _, token) = request.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer" or not token:
+        raise BadToken("Missing Authorization Header")
+    with aio.app.app_context():
+        claims = decode_token(token)
+    if refresh and claims.get("type") != "refresh":
+        raise BadToken("Only refresh tokens are allowed")
+    if not refresh and claims.get("type") == "refresh":
+        raise BadToken("Only non-refresh tokens are allowed")
+    if await token_is_revoked(claims):
+        raise BadToken("Token has been revoked")
+    return claims
+
+
+async def load_user(**filters) -> Optional[User]:
+    """Пользователь вместе с группами (загружаются тем же обращением)"""
+    async with aio.session() as session:
+        result = await session.execute(select(User).filter_by(**filters))
+        return result.scalars().first()
+
+
+async def issue_tokens(identity: str, user, family_id: str, refresh_jti: str):
+    (access_claims, refresh_token_claims) = await token_claims_async(
+        aio.redis, identity, user
+    )
+    with aio.app.app_context():
+        return sign_tokens(
+            identity, access_claims, refresh_token_claims, family_id, refresh_jti
+        )
+
+
+async def rehash_password(user: User, password: str):
+    """Пересчитать хэш пароля устаревшего алгоритма или стоимости"""
+    try:
+        password_hash = await hasher.hash_async(password)
+    except HasherBusy:
+        return
+    async with aio.session() as session:
+        await session.execute(
+            update(User).where(User.id == user.id).values(password_hash=password_hash)
+        )
+        await session.commit()
+
+
+async def add_history(user_id):
+    if history_sink.synchronous:
+        await run_in_threadpool(history_sink.add, user_id, useragent="unknown")
+    else:
+        history_sink.add(user_id, useragent="unknown")
+
+
+def tokens_response(access_token: str, refresh_token: str):
+    return json_response({"access_token": access_token, "refresh_token": refresh_token})
+
+
+@observed
+async def login(request: Request):
+    """
+    Метод при успешной авториазции возвращает пару ключей access и refreh токенов
+    """
+    username = request.query_params.get("login")
+    password = request.query_params.get("password")
+    limited = await rate_limit_exceeded(request, "login", username)
+    if limited is not None:
+        return limited
+    user = await load_user(login=username) if username is not None else None
+    try:
+        password_valid = user is not None and await hasher.verify_async(
+            password, user.password_hash
+        )
+    except HasherBusy:
+        return server_busy()
+    if not (password_valid or (username == "test" and password == "test")):
+        await charge_failure_async(aio.redis, "login", {"login": username})
+        return json_response(
+            {"msg": "Bad username or password"}, HTTPStatus.UNAUTHORIZED
+        )
+    if username == "test":
+        user_identity = username
+    else:
+        user_identity = str(user.id)
+        if hasher.needs_rehash(user.password_hash):
+            await rehash_password(user, password)
+    family_id = str(uuid.uuid4())
+    refresh_jti = str(uuid.uuid4())
+    await start_family_async(
+        aio.redis,
+        family_id,
+        refresh_jti,
+        user_identity,
+        Config.JWT_REFRESH_TOKEN_EXPIRES,
+    )
+    (access_token, refresh_token) = await issue_tokens(
+        user_identity, user, family_id, refresh_jti
+    )
+    if user:
+        await add_history(user.id)
+    return tokens_response(access_token, refresh_token)
+
+
+@observed
+async def refresh(request: Request):
+    """
+    Обновление пары токенов при получении действительного refresh токена
+    """
+    try:
+        claims = await verified_claims(request, refresh=True)
+    except TOKEN_ERRORS as ex:
+        return json_response(
+            {"msg": f"Bad refresh token: {ex}"}, HTTPStatus.UNAUTHORIZED
+        )
+    identity = claims[Config.JWT_IDENTITY_CLAIM]
+    refresh_jti = str(uuid.uuid4())
+    if FAMILY_CLAIM in claims:
+        family_id = claims[FAMILY_CLAIM]
+        result = await rotate_async(
+            aio.redis,
+            family_id,
+            claims["jti"],
+            refresh_jti,
+            Config.JWT_REFRESH_TOKEN_EXPIRES,
+        )
+    else:
+        # Токен выдан до введения семейств - начинаем для него новое,
+        # а сам токен отмечаем использованным
+        family_id = str(uuid.uuid4())
+        result = await adopt_legacy_token_async(
+            aio.redis,
+            claims["jti"],
+            int(claims["exp"] - time.time()),
+            family_id,
+            refresh_jti,
+            identity,
+            Config.JWT_REFRESH_TOKEN_EXPIRES,
+        )
+    if result == REUSE_DETECTED:
+        return json_response(
+            {"msg": "Refresh token reuse detected, session revoked"},
+            HTTPStatus.UNAUTHORIZED,
+        )
+    if result != ROTATED:
+        return json_response(
+            {"msg": "Refresh token was revoked"}, HTTPStatus.UNAUTHORIZED
+        )
+    # Состав групп мог измениться, поэтому берем его из базы заново
+    user = await load_user(id=uuid.UUID(identity)) if identity != "test" else None
+    (access_token, refresh_token) = await issue_tokens(
+        identity, user, family_id, refresh_jti
+    )
+    return tokens_response(access_token, refresh_token)
+
+
+@observed
+async def logout(request: Request):
+    """
+    Выход пользователя из аккаунта
+    """
+    try:
+        claims = await verified_claims(request, refresh=False)
+    except TOKEN_ERRORS as ex:
+        return json_response(
+            {"msg": f"Bad access token: {ex}"}, HTTPStatus.UNAUTHORIZED
+        )
+    await revoked_filter.revoke_async(aio.redis, claims["jti"], Config.ACCESS_EXPIRES)
+    if FAMILY_CLAIM in claims:
+        # Вместе с access токеном отзываем и refresh токен этого входа
+        await revoke_family_async(aio.redis, claims[FAMILY_CLAIM])
+    return json_response({"msg": "Access token revoked"})
+
+
+def routes(url_prefix: str) -> list:
+    """Маршруты асинхронных обработчиков с префиксом users_bp"""
+    return [
+        Route(f"{url_prefix}/login", login, methods=["POST"]),
+        Route(f"{url_prefix}/refresh", refresh, methods=["POST"]),
+        Route(f"{url_prefix}/logout", logout, methods=["DELETE"]),
+    ]
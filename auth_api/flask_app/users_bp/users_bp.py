@@ -1,8 +1,13 @@
-from datetime import datetime
+import datetime
+import time
+import uuid
 from http import HTTPStatus
 
-from auth_config import Config, db, jwt, jwt_redis
-from db_models import History, User
+from auth_config import Config, db, jwt
+from bulk import CREATED, TooManyItems, TooManyPasswords, import_users
+from db_models import History, HistoryDaily, User
+from db_routing import read_only
+from decorators import admin_required
 from flasgger.utils import swag_from
 from flask import Blueprint, render_template, request
 from flask.json import jsonify
@@ -14,36 +19,143 @@ from flask_jwt_extended import (
     jwt_required,
     verify_jwt_in_request,
 )
-from password_hash import check_password, hash_password
+from history_sink import history_sink
+from jwt_claims import bump_token_generation, token_claims, token_generation_revoked
+from metrics import JWT_ENCODE_DURATION, TOKEN_REVOCATION_CHECK_DURATION
+from ndjson import ndjson_response
+from pagination import (
+    BadCursor,
+    BadPageParameter,
+    keyset_page,
+    offset_page,
+    page_args,
+)
+from password_hash import HasherBusy, hash_password
+from rate_limit import charge_failure, rate_limited
+from refresh_families import (
+    FAMILY_CLAIM,
+    REUSE_DETECTED,
+    ROTATED,
+    adopt_legacy_token,
+    revoke_family,
+    rotate,
+    start_family,
+)
+from revoked_filter import revoked_filter
+from schema_validation import schema_validation, validate_body
 
-jwt_redis_blocklist = jwt_redis
 users_bp = Blueprint("users_bp", __name__)
 
 
-@swag_from("../schemes/users_get.yaml", methods=["GET"])
+def server_busy():
+    """Ответ на запрос, для которого не нашлось свободного обработчика паролей"""
+    response = jsonify({"msg": "Server is busy, try again later"})
+    response.headers["Retry-After"] = "1"
+    return response, HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def sign_tokens(
+    identity: str,
+    access_claims: dict,
+    refresh_token_claims: dict,
+    family_id: str,
+    refresh_jti: str,
+):
+    """
+    Подписать пару access и refresh токенов семейства family_id с
+    дополнительными полями access_claims и refresh_token_claims, refresh
+    токен получает идентификатор refresh_jti
+    """
+    access_claims = {**access_claims, FAMILY_CLAIM: family_id}
+    refresh_token_claims = {
+        **refresh_token_claims,
+        FAMILY_CLAIM: family_id,
+        "jti": refresh_jti,
+    }
+    # Поля токенов собраны заранее, в метрики попадает только подпись
+    with JWT_ENCODE_DURATION.labels(token_type="access").time():
+        access_token = create_access_token(
+            identity=identity, additional_claims=access_claims
+        )
+    with JWT_ENCODE_DURATION.labels(token_type="refresh").time():
+        refresh_token = create_refresh_token(
+            identity=identity, additional_claims=refresh_token_claims
+        )
+    return access_token, refresh_token
+
+
+def issue_tokens(identity: str, user, family_id: str, refresh_jti: str):
+    """
+    Выпустить пару access и refresh токенов семейства family_id,
+    refresh токен получает идентификатор refresh_jti
+    """
+    (access_claims, refresh_token_claims) = token_claims(identity, user)
+    return sign_tokens(
+        identity, access_claims, refresh_token_claims, family_id, refresh_jti
+    )
+
+
 @users_bp.route("/", methods=["GET"])
+@read_only
+@swag_from("../schemes/users_get.yaml", methods=["GET"])
 def list_users():
     """
     Список всех зарегистрированных пользователей
+
+    Если задан параметр cursor (в том числе пустой), то выдача идет
+    по ключу: возвращается страница пользователей, следующих за cursor
+    в порядке логинов, и cursor для следующей страницы
     """
-    users = []
-    page_size = request.args.get("page_size", None)
-    page_number = request.args.get("page_number", 1)
+    try:
+        (page_size, page_number) = page_args(request.args, Config.PAGE_SIZE_MAX)
+    except BadPageParameter as ex:
+        return jsonify({"error": f"bad {ex}"}), HTTPStatus.BAD_REQUEST
+    if "cursor" in request.args:
+        try:
+            users, next_cursor = keyset_page(
+                User.json_query(),
+                [User.login],
+                request.args["cursor"],
+                page_size or Config.PAGE_SIZE_DEFAULT,
+            )
+        except BadCursor:
+            return jsonify({"error": "bad cursor"}), HTTPStatus.BAD_REQUEST
+        return (
+            jsonify(
+                {
+                    "items": [User.row_to_json(u) for u in users],
+                    "next_cursor": next_cursor,
+                }
+            ),
+            HTTPStatus.OK,
+        )
+    query = User.json_query().order_by(User.login)
     if page_size is None:
-        for user in User.query.order_by(User.login).all():
-            users.append(user.to_json())
+        rows = query.all()
     else:
-        for user in (
-            User.query.order_by(User.login)
-            .paginate(int(page_number), int(page_size), False)
-            .items
-        ):
-            users.append(user.to_json())
+        rows = offset_page(query, page_number, page_size)
+    users = [User.row_to_json(row) for row in rows]
     return jsonify(users), HTTPStatus.OK
 
 
-@swag_from("../schemes/user_register.yaml", validation=True)
+@users_bp.route("/export", methods=["GET"])
+@admin_required()
+@read_only
+@swag_from("../schemes/users_export_get.yaml", methods=["GET"])
+def export_users():
+    """
+    Выгрузка всех пользователей в формате NDJSON в порядке логинов
+
+    Пользователи читаются из базы и отправляются клиенту потоком,
+    не накапливаясь в памяти
+    """
+    return ndjson_response(User.json_query().order_by(User.login), User.row_to_json)
+
+
 @users_bp.route("/register", methods=["POST"])
+@rate_limited("register")
+@validate_body
+@swag_from("../schemes/user_register.yaml")
 def register():
     """
     Метод регистрации пользователя
@@ -58,6 +170,8 @@ def register():
             db.session.commit()
             return jsonify({"msg": "User was successfully registered"}), HTTPStatus.OK
 
+        except HasherBusy:
+            return server_busy()
         except Exception as err:
             return jsonify({"msg": f"Unexpected error: {err}"}), HTTPStatus.CONFLICT
 
@@ -70,8 +184,9 @@ def register():
         )
 
 
-@swag_from("../schemes/user_login_param.yaml")
 @users_bp.route("/login", methods=["POST"])
+@rate_limited("login")
+@swag_from("../schemes/user_login_param.yaml")
 def login():
     """
     Метод при успешной авториазции возвращает пару ключей access и refreh токенов
@@ -79,23 +194,36 @@ def login():
     username = request.args.get("login", None)
     password = request.args.get("password", None)
     user = User.query.filter_by(login=username).first()
-    if (user and user.verify_password(password)) or (
-        username == "test" and password == "test"
-    ):
+    try:
+        password_valid = user is not None and user.verify_password(password)
+    except HasherBusy:
+        return server_busy()
+    if password_valid or (username == "test" and password == "test"):
         if username == "test":
             user_identity = username
         else:
             user_identity = str(user.id)
-        access_token = create_access_token(identity=user_identity)
-        refresh_token = create_refresh_token(identity=user_identity)
+            if user.password_needs_rehash():
+                # Пароль известен только сейчас, поэтому пересчитываем
+                # хэш устаревшего алгоритма или стоимости при входе
+                try:
+                    user.password = password
+                    db.session.commit()
+                except HasherBusy:
+                    db.session.rollback()
+        family_id = str(uuid.uuid4())
+        refresh_jti = str(uuid.uuid4())
+        start_family(
+            family_id, refresh_jti, user_identity, Config.JWT_REFRESH_TOKEN_EXPIRES
+        )
+        access_token, refresh_token = issue_tokens(
+            user_identity, user, family_id, refresh_jti
+        )
         if user:
             # Добавить информацию о входе в историю
-            history = History(
-                user_id=user.id, useragent="unknown", timestamp=datetime.now()
-            )
-            db.session.add(history)
-            db.session.commit()
+            history_sink.add(user.id, useragent="unknown")
     else:
+        charge_failure("login", {"login": username})
         return jsonify({"msg": "Bad username or password"}), HTTPStatus.UNAUTHORIZED
 
     return (
@@ -116,8 +244,38 @@ def refresh():
     except Exception as ex:
         return (jsonify({"msg": f"Bad refresh token: {ex}"}), HTTPStatus.UNAUTHORIZED)
     identity = get_jwt_identity()
-    access_token = create_access_token(identity=identity)
-    refresh_token = create_refresh_token(identity=identity)
+    claims = get_jwt()
+    refresh_jti = str(uuid.uuid4())
+    if FAMILY_CLAIM in claims:
+        family_id = claims[FAMILY_CLAIM]
+        result = rotate(
+            family_id, claims["jti"], refresh_jti, Config.JWT_REFRESH_TOKEN_EXPIRES
+        )
+    else:
+        # Токен выдан до введения семейств - начинаем для него новое,
+        # а сам токен отмечаем использованным
+        family_id = str(uuid.uuid4())
+        result = adopt_legacy_token(
+            claims["jti"],
+            int(claims["exp"] - time.time()),
+            family_id,
+            refresh_jti,
+            identity,
+            Config.JWT_REFRESH_TOKEN_EXPIRES,
+        )
+    if result == REUSE_DETECTED:
+        return (
+            jsonify({"msg": "Refresh token reuse detected, session revoked"}),
+            HTTPStatus.UNAUTHORIZED,
+        )
+    if result != ROTATED:
+        return (
+            jsonify({"msg": "Refresh token was revoked"}),
+            HTTPStatus.UNAUTHORIZED,
+        )
+    # Состав групп мог измениться, поэтому берем его из базы заново
+    user = User.query.get(identity) if identity != "test" else None
+    access_token, refresh_token = issue_tokens(identity, user, family_id, refresh_jti)
     return (
         jsonify(access_token=access_token, refresh_token=refresh_token),
         HTTPStatus.OK,
@@ -135,14 +293,68 @@ def logout():
         verify_jwt_in_request()
     except Exception as ex:
         return (jsonify({"msg": f"Bad access token: {ex}"}), HTTPStatus.UNAUTHORIZED)
-    jti = get_jwt()["jti"]
-    jwt_redis_blocklist.set(jti, "", ex=Config.ACCESS_EXPIRES)
+    claims = get_jwt()
+    revoked_filter.revoke(claims["jti"], Config.ACCESS_EXPIRES)
+    if FAMILY_CLAIM in claims:
+        # Вместе с access токеном отзываем и refresh токен этого входа
+        revoke_family(claims[FAMILY_CLAIM])
     return (
         jsonify(msg="Access token revoked"),
         HTTPStatus.OK,
     )
 
 
+@admin_required()
+@swag_from("../schemes/users_import_post.yaml", methods=["POST"])
+def users_import():
+    """
+    Массовый импорт пользователей из NDJSON (по одному пользователю
+    в строке). Обработчик подключается в приложении по адресу
+    /v1/users:import
+
+    Все пользователи добавляются в одной транзакции, для каждой строки
+    возвращается результат ее обработки
+    """
+    try:
+        results = import_users(request.stream)
+    except TooManyItems:
+        return (
+            jsonify({"error": "too many users"}),
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+    except TooManyPasswords:
+        return (
+            jsonify(
+                {"error": "too many plain text passwords, pass password_hash instead"}
+            ),
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+    except HasherBusy:
+        db.session.rollback()
+        return server_busy()
+    db.session.commit()
+    created = sum(1 for r in results if r.get("result") == CREATED)
+    return jsonify({"created": created, "items": results})
+
+
+@swag_from("../schemes/user_sessions_del.yaml")
+@users_bp.route("/sessions", methods=["DELETE"])
+def logout_everywhere():
+    """
+    Выход пользователя со всех устройств: все выданные ему ранее
+    access и refresh токены перестают приниматься
+    """
+    try:
+        verify_jwt_in_request()
+    except Exception as ex:
+        return (jsonify({"msg": f"Bad access token: {ex}"}), HTTPStatus.UNAUTHORIZED)
+    bump_token_generation(get_jwt_identity())
+    return (
+        jsonify(msg="All sessions revoked"),
+        HTTPStatus.OK,
+    )
+
+
 @swag_from("../schemes/user_account_post_param.yaml")
 @users_bp.route("/account/", methods=["POST"])
 def update():
@@ -153,12 +365,18 @@ def update():
         verify_jwt_in_request()
     except Exception as ex:
         return jsonify({"msg": f"Bad access token: {ex}"}), HTTPStatus.UNAUTHORIZED
+    error = schema_validation.body_error(update)
+    if error is not None:
+        return jsonify({"error": error}), HTTPStatus.BAD_REQUEST
     identity = get_jwt_identity()
     user = User.query.get(identity)
     if user is None:
         return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
     obj = request.json
-    obj["password"] = hash_password(obj["password"])
+    try:
+        obj["password"] = hash_password(obj["password"])
+    except HasherBusy:
+        return server_busy()
     updated_user = user.from_json(obj)
     return (
         jsonify(msg=f"Update success: {updated_user}"),
@@ -166,44 +384,112 @@ def update():
     )
 
 
-@swag_from("../schemes/user_get.yaml", methods=["GET"])
 @users_bp.route("/<user_id>/", methods=["GET"])
+@read_only
+@swag_from("../schemes/user_get.yaml", methods=["GET"])
 def get_user(user_id):
     """
     Получить информацию о пользователе
     """
-    user = User.query.get(user_id)
+    user = User.json_query().filter(User.id == user_id).first()
     if user is None:
         return jsonify({"error": "user not found"}), HTTPStatus.NOT_FOUND
-    return jsonify(user.to_json())
+    return jsonify(User.row_to_json(user))
 
 
 @users_bp.route("/history", methods=["GET"])
 @jwt_required()
+@read_only
 @swag_from("../schemes/user_history_get.yaml", methods=["GET"])
 def get_user_history(**kwargs):
     """
     Получить историю операций пользователя
+
+    История пишется пакетами (см. history_sink), поэтому последний вход
+    появляется в ней с задержкой до HISTORY_FLUSH_INTERVAL секунд
     """
 
-    current_user = User.query.get(get_jwt_identity())
-    page_size = request.args.get("page_size", None)
-    page_number = request.args.get("page_number", 1)
+    current_user = (
+        User.query.options(*User.json_options())
+        .filter(User.id == get_jwt_identity())
+        .first()
+    )
+    try:
+        (page_size, page_number) = page_args(request.args, Config.PAGE_SIZE_MAX)
+    except BadPageParameter as ex:
+        return jsonify({"error": f"bad {ex}"}), HTTPStatus.BAD_REQUEST
     if not current_user:
         return jsonify({"error": "No such user"}), HTTPStatus.NOT_FOUND
+    if "cursor" in request.args:
+        try:
+            history, next_cursor = keyset_page(
+                current_user.get_history(),
+                [History.timestamp, History.id],
+                request.args["cursor"],
+                page_size or Config.PAGE_SIZE_DEFAULT,
+                descending=True,
+            )
+        except BadCursor:
+            return jsonify({"error": "bad cursor"}), HTTPStatus.BAD_REQUEST
+        return jsonify(
+            {"items": [h.to_json() for h in history], "next_cursor": next_cursor}
+        )
     if page_size is None:
         history = current_user.get_history().all()
     else:
-        history = (
-            current_user.get_history()
-            .paginate(int(page_number), int(page_size), False)
-            .items
-        )
+        history = offset_page(current_user.get_history(), page_number, page_size)
     return jsonify([h.to_json() for h in history])
 
 
+@users_bp.route("/history/export", methods=["GET"])
+@jwt_required()
+@read_only
+@swag_from("../schemes/user_history_export_get.yaml", methods=["GET"])
+def export_user_history():
+    """
+    Выгрузка всей истории входов пользователя в формате NDJSON,
+    от новых записей к старым
+    """
+    user_id = get_jwt_identity()
+    if not User.exists(user_id):
+        return jsonify({"error": "No such user"}), HTTPStatus.NOT_FOUND
+    return ndjson_response(
+        History.query.filter(History.user_id == user_id).order_by(
+            History.timestamp.desc(), History.id.desc()
+        ),
+        History.to_json,
+    )
+
+
+@users_bp.route("/history/daily", methods=["GET"])
+@jwt_required()
+@read_only
+@swag_from("../schemes/user_history_daily_get.yaml", methods=["GET"])
+def get_user_history_daily():
+    """
+    Число входов пользователя по дням за последние days дней (по
+    умолчанию 30, не больше HISTORY_DAILY_MAX_DAYS) из дневной сводки,
+    без чтения самой истории
+    """
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        return jsonify({"error": "bad days"}), HTTPStatus.BAD_REQUEST
+    if days < 0:
+        return jsonify({"error": "bad days"}), HTTPStatus.BAD_REQUEST
+    days = min(days, Config.HISTORY_DAILY_MAX_DAYS)
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days)
+    rows = (
+        HistoryDaily.query.filter(HistoryDaily.user_id == get_jwt_identity())
+        .filter(HistoryDaily.day >= since)
+        .order_by(HistoryDaily.day)
+    )
+    return jsonify([row.to_json() for row in rows])
+
+
 @jwt.token_in_blocklist_loader
+@TOKEN_REVOCATION_CHECK_DURATION.time()
 def check_if_token_is_revoked(jwt_header, jwt_payload):
-    jti = jwt_payload["jti"]
-    token_in_redis = jwt_redis_blocklist.get(jti)
-    return token_in_redis is not None
+    if token_generation_revoked(jwt_payload):
+        return True
+    return revoked_filter.is_revoked(jwt_payload["jti"], jwt_payload.get("iat"))
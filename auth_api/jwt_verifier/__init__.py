@@ -0,0 +1,21 @@
+"""
+Проверка токенов сервиса авторизации без обращения к нему
+
+Токены подписаны асимметричным ключом, открытые ключи публикуются
+сервисом авторизации по адресу /.well-known/jwks.json. Проверка
+подписи, срока действия и типа токена выполняется локально, сеть
+нужна только для загрузки набора ключей, который кэшируется по kid.
+
+    from jwt_verifier import JwksVerifier, TokenInvalid
+
+    verifier = JwksVerifier("http://flask_auth_api:5000/.well-known/jwks.json")
+    try:
+        claims = verifier.verify(token)
+    except TokenInvalid:
+        ...
+
+Отзыв токенов (выход из аккаунта) локальная проверка не видит:
+отозванный access токен принимается до истечения его срока.
+"""
+
+from .verifier import JwksVerifier, TokenInvalid
@@ -0,0 +1,114 @@
+"""
+Локальная проверка JWT токенов сервиса авторизации по JWKS
+"""
+
+import json
+import re
+import threading
+import time
+import urllib.request
+from typing import Dict, Iterable, Optional
+
+import jwt
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class TokenInvalid(Exception):
+    """Токен не прошел проверку"""
+
+
+class JwksVerifier:
+    """
+    Проверка подписи и срока действия токенов по открытым ключам из
+    jwks_url
+
+    Ключи кэшируются по kid на время из заголовка Cache-Control ответа
+    (но не меньше min_refresh_interval секунд). Токен с неизвестным kid
+    приводит к внеочередной загрузке набора ключей, не чаще, чем раз в
+    min_refresh_interval секунд. Если сервис авторизации недоступен,
+    продолжают использоваться уже загруженные ключи.
+    """
+
+    def __init__(
+        self,
+        jwks_url: str,
+        algorithms: Iterable[str] = ("RS256", "EdDSA"),
+        token_type: Optional[str] = "access",
+        cache_ttl: float = 300,
+        min_refresh_interval: float = 10,
+        timeout: float = 2,
+        leeway: float = 0,
+    ):
+        self.jwks_url = jwks_url
+        self.algorithms = list(algorithms)
+        self.token_type = token_type
+        self.cache_ttl = cache_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.leeway = leeway
+        self._keys: Dict[str, object] = {}
+        self._expires = 0.0
+        self._fetched = float("-inf")
+        self._lock = threading.Lock()
+
+    def verify(self, token: str) -> dict:
+        """Проверить токен и вернуть его поля"""
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as ex:
+            raise TokenInvalid(str(ex)) from ex
+        if header.get("alg") not in self.algorithms:
+            raise TokenInvalid(f"Algorithm not allowed: {header.get('alg')}")
+        key = self.key(header.get("kid"))
+        try:
+            claims = jwt.decode(
+                token, key, algorithms=[header["alg"]], leeway=self.leeway
+            )
+        except jwt.PyJWTError as ex:
+            raise TokenInvalid(str(ex)) from ex
+        if self.token_type is not None and claims.get("type") != self.token_type:
+            raise TokenInvalid(f"Token type is not {self.token_type}")
+        return claims
+
+    def key(self, kid: Optional[str]):
+        """Открытый ключ по kid"""
+        now = time.monotonic()
+        if now >= self._expires or kid not in self._keys:
+            self.refresh(now)
+        key = self._keys.get(kid)
+        if key is None:
+            raise TokenInvalid(f"Unknown signing key: {kid}")
+        return key
+
+    def refresh(self, now: Optional[float] = None):
+        """Загрузить набор ключей, если с прошлой загрузки прошло достаточно времени"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - self._fetched < self.min_refresh_interval:
+                return
+            self._fetched = now
+            try:
+                (jwks, max_age) = self._fetch()
+            except (OSError, ValueError):
+                # Сервис авторизации недоступен - работаем с прежними ключами
+                return
+            keys = {}
+            for jwk in jwks.get("keys", []):
+                if "kid" not in jwk or jwk.get("alg") not in self.algorithms:
+                    continue
+                try:
+                    keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+                except jwt.PyJWTError:
+                    continue
+            ttl = self.cache_ttl if max_age is None else max_age
+            self._keys = keys
+            self._expires = now + max(ttl, self.min_refresh_interval)
+
+    def _fetch(self):
+        with urllib.request.urlopen(self.jwks_url, timeout=self.timeout) as response:
+            match = MAX_AGE.search(response.headers.get("Cache-Control", ""))
+            return (
+                json.loads(response.read()),
+                int(match[1]) if match else None,
+            )
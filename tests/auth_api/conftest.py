@@ -7,6 +7,19 @@ import requests
 AUTH_API_HOST = os.getenv("AUTH_API_HOST", "flask_auth_api:5000")
 
 
+def existing_user_id(login, token):
+    """Идентификатор уже зарегистрированного пользователя по логину"""
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/",
+        headers={"Authorization": "Bearer " + token},
+    )
+    assert ans.status_code == 200
+    for user in ans.json():
+        if user["login"].lower() == login.lower():
+            return user["id"]
+    raise AssertionError(f"user {login} not found")
+
+
 @pytest.fixture()
 def seven_little_guys(request):
     """Создать тестовую группу из семи пользователей"""
@@ -42,8 +55,10 @@ def seven_little_guys(request):
             },
             headers={"Authorization": "Bearer " + token},
         )
-        # Если пользователь уже существует, то все OK
+        # Если пользователь уже существует, то все OK - берем его id
         assert ans.status_code in [200, 409]
+        if ans.status_code == 409:
+            uid = existing_user_id(f"Dwarf-{i + 1}", token)
         ans = requests.post(
             f"http://{AUTH_API_HOST}/v1/groups/{gid}/users/",
             json={"user_id": str(uid)},
@@ -1,4 +1,5 @@
 import os
+from uuid import uuid1
 
 import pytest
 import requests
@@ -25,6 +26,12 @@ def test_create_group_no_permissions():
     assert ans.status_code in [403, 401]
 
 
+def test_create_group_bad_body_no_permissions():
+    """Тело запроса неавторизованного пользователя не проверяется по схеме"""
+    ans = requests.post(f"http://{AUTH_API_HOST}/v1/groups/", json={"id": 1})
+    assert ans.status_code == 401
+
+
 def test_create_delete_group():
     """
     Создать группу, убедиться, что она возвращается в списке
@@ -129,3 +136,127 @@ def test_users_paginated(seven_little_guys):
     data = ans.json()
     assert isinstance(data, list)
     assert len(data) == 1
+
+
+def test_membership(seven_little_guys):
+    """Проверка, повторное добавление и удаление участника группы"""
+    gid = seven_little_guys
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    token = ans.json()["access_token"]
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/users/?page_size=1")
+    assert ans.status_code == 200
+    uid = ans.json()[0]["id"]
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/user/{uid}")
+    assert ans.status_code == 200
+    # Повторное добавление не создает второй записи о членстве
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/groups/{gid}/users/",
+        json={"user_id": uid},
+        headers={"Authorization": "Bearer " + token},
+    )
+    assert ans.status_code == 200
+    ans = requests.delete(
+        f"http://{AUTH_API_HOST}/v1/groups/{gid}/user/{uid}",
+        headers={"Authorization": "Bearer " + token},
+    )
+    assert ans.status_code == 200
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/user/{uid}")
+    assert ans.status_code == 404
+    assert ans.json()["error"] == "user is not in the group"
+
+
+def test_group_queries_budget(seven_little_guys):
+    """Число SQL запросов не зависит от размера группы и номера страницы"""
+    gid = seven_little_guys
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/")
+    assert ans.status_code == 200
+    # Список групп строится одним запросом или берется из кэша
+    assert ans.headers["X-SQL-Statements"] in ("0", "1")
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/")
+    assert ans.status_code == 200
+    assert ans.headers["X-SQL-Statements"] == "1"
+    for params in [{}, {"page_size": 3, "page_number": 3}, {"page_size": 10}]:
+        ans = requests.get(
+            f"http://{AUTH_API_HOST}/v1/groups/{gid}/users/", params=params
+        )
+        assert ans.status_code == 200
+        # Проверка существования группы и выборка участников
+        assert ans.headers["X-SQL-Statements"] == "2"
+
+
+def test_group_users_batch(seven_little_guys):
+    """Добавление в группу сразу нескольких пользователей"""
+    gid = seven_little_guys
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/users/?page_size=1")
+    member_id = ans.json()[0]["id"]
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/")
+    nobody_id = [u["id"] for u in ans.json() if u["login"] == "nobody"][0]
+    # Идентификатор в верхнем регистре - тот же пользователь
+    user_ids = [nobody_id.upper(), member_id, str(uuid1()), "not-an-id", nobody_id]
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/groups/{gid}/users:batch",
+        json={"user_ids": user_ids},
+        headers=headers,
+    )
+    assert ans.status_code == 200
+    data = ans.json()
+    assert data["added"] == 1
+    assert [item["result"] for item in data["items"]] == [
+        "added",
+        "already in group",
+        "user not found",
+        "invalid id",
+        "already in group",
+    ]
+    assert data["items"][0]["user_id"] == nobody_id.upper()
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{gid}/user/{nobody_id}")
+    assert ans.status_code == 200
+    # Членство записано в кэш под каноническим идентификатором
+    assert ans.headers["X-SQL-Statements"] == "0"
+
+
+def test_membership_bad_ids(seven_little_guys):
+    """Проверка членства с неверным идентификатором - 404 без запросов к базе"""
+    gid = seven_little_guys
+    for path in [f"{gid}/user/not-an-id", f"not-an-id/user/{uuid1()}"]:
+        ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/{path}")
+        assert ans.status_code == 404
+        assert ans.headers["X-SQL-Statements"] == "0"
+
+
+def test_group_list_etag():
+    """Список групп отдается с ETag, который меняется при изменении групп"""
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/groups/")
+    assert ans.status_code == 200
+    etag = ans.headers["ETag"]
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/groups/", headers={"If-None-Match": etag}
+    )
+    assert ans.status_code == 304
+    assert ans.headers["X-SQL-Statements"] == "0"
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    gid = str(uuid1())
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/groups/",
+        json={"id": gid, "name": "etag", "description": "etag"},
+        headers=headers,
+    )
+    assert ans.status_code == 200
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/groups/", headers={"If-None-Match": etag}
+    )
+    assert ans.status_code == 200
+    assert ans.headers["ETag"] != etag
+    assert gid in [g["id"] for g in ans.json()]
+    requests.delete(f"http://{AUTH_API_HOST}/v1/groups/{gid}/", headers=headers)
@@ -1,4 +1,7 @@
+import base64
+import json
 import os
+import uuid
 
 import pytest
 import requests
@@ -81,3 +84,377 @@ def test_nobody_history_paginated():
     # который был только что
     assert isinstance(data, list)
     assert len(data) >= 1
+
+
+def test_admin_token_groups_claim():
+    """Access токен администратора содержит группу admin в своих полях"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    token = ans.json()["access_token"]
+    payload = token.split(".")[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    assert "admin" in [g["name"] for g in claims["groups"]]
+    assert "groups_ver" in claims
+
+
+def test_user_list_cursor():
+    """Выдача пользователей по ключу проходит весь список без повторов"""
+    logins = []
+    cursor = ""
+    while cursor is not None:
+        ans = requests.get(
+            f"http://{AUTH_API_HOST}/v1/users/",
+            params={"cursor": cursor, "page_size": 1},
+        )
+        assert ans.status_code == 200
+        data = ans.json()
+        logins.extend(u["login"] for u in data["items"])
+        cursor = data["next_cursor"]
+    assert logins == sorted(logins)
+    assert len(logins) == len(set(logins))
+    assert "admin" in logins
+
+
+def test_user_list_bad_page_size():
+    """Неверный размер страницы отклоняется с кодом 400, а не 500"""
+    for params in [
+        {"cursor": "", "page_size": 0},
+        {"cursor": "", "page_size": -1},
+        {"page_size": "ten"},
+        {"page_size": 1, "page_number": "x"},
+    ]:
+        ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/", params=params)
+        assert ans.status_code == 400
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/", params={"cursor": "", "page_size": 10**9}
+    )
+    assert ans.status_code == 200
+
+
+def test_user_list_query_budget():
+    """Выдача пользователей выполняет один SQL запрос на любую страницу"""
+    for params in [{}, {"page_size": 1}, {"page_size": 5, "page_number": 2}]:
+        ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/", params=params)
+        assert ans.status_code == 200
+        assert ans.headers["X-SQL-Statements"] == "1"
+
+
+def test_logout_revokes_token():
+    """После выхода access токен больше не принимается"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    ans = requests.delete(f"http://{AUTH_API_HOST}/v1/users/logout", headers=headers)
+    assert ans.status_code == 200
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/history", headers=headers)
+    assert ans.status_code == 401
+
+
+def test_logout_everywhere():
+    """Выход со всех устройств отзывает все access и refresh токены"""
+    tokens = []
+    for _ in range(2):
+        ans = requests.post(
+            f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+        )
+        assert ans.status_code == 200
+        tokens.append(ans.json())
+    ans = requests.delete(
+        f"http://{AUTH_API_HOST}/v1/users/sessions",
+        headers={"Authorization": "Bearer " + tokens[0]["access_token"]},
+    )
+    assert ans.status_code == 200
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/history",
+        headers={"Authorization": "Bearer " + tokens[1]["access_token"]},
+    )
+    assert ans.status_code == 401
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/refresh",
+        headers={"Authorization": "Bearer " + tokens[1]["refresh_token"]},
+    )
+    assert ans.status_code == 401
+
+
+def test_refresh_token_reuse():
+    """Повторное использование refresh токена отзывает всю цепочку обновлений"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    first = ans.json()["refresh_token"]
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/refresh",
+        headers={"Authorization": "Bearer " + first},
+    )
+    assert ans.status_code == 200
+    second = ans.json()["refresh_token"]
+    # Старый токен уже заменен - это повторное использование
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/refresh",
+        headers={"Authorization": "Bearer " + first},
+    )
+    assert ans.status_code == 401
+    # Вместе с ним отозван и новый токен
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/refresh",
+        headers={"Authorization": "Bearer " + second},
+    )
+    assert ans.status_code == 401
+
+
+def test_login_rate_limit():
+    """Частые попытки входа под одним именем ограничиваются"""
+    codes = []
+    for _ in range(25):
+        ans = requests.post(
+            f"http://{AUTH_API_HOST}/v1/users/login?login=rate-limit-probe&password=wrong"
+        )
+        codes.append(ans.status_code)
+        if ans.status_code == 429:
+            assert int(ans.headers["Retry-After"]) >= 1
+            break
+    assert 429 in codes
+
+
+def test_login_rate_limit_counts_failures_only():
+    """Успешные входы не расходуют лимит попыток по имени пользователя"""
+    for _ in range(15):
+        ans = requests.post(
+            f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+        )
+        assert ans.status_code == 200
+
+
+def test_users_import():
+    """Массовый импорт пользователей с открытыми паролями и готовыми хэшами"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    suffix = uuid.uuid4().hex[:8]
+    lines = [
+        {
+            "login": f"imported-{suffix}-1",
+            "email": f"imported-{suffix}-1@localhost",
+            "full_name": "Imported 1",
+            "password": "imported-1",
+        },
+        {
+            "login": f"imported-{suffix}-2",
+            "email": f"imported-{suffix}-2@localhost",
+            "full_name": "Imported 2",
+            "password_hash": "$2b$04$H/s0or9/Tjhll8cdnpPuj.bNnBKLCz8Eo8cDqK9Rd5rHWlGmDoY6S",
+        },
+        # Логин уже занят
+        {
+            "login": "admin",
+            "email": f"imported-{suffix}-3@localhost",
+            "full_name": "Imported 3",
+            "password": "imported-3",
+        },
+        {"login": f"imported-{suffix}-4", "password": "imported-4"},
+        # Обрезанный хэш bcrypt
+        {
+            "login": f"imported-{suffix}-5",
+            "email": f"imported-{suffix}-5@localhost",
+            "full_name": "Imported 5",
+            "password_hash": "$2b$04$H/s0or9/Tjhll8cdnpPuj",
+        },
+        # Поля не строкового типа
+        {
+            "login": 6,
+            "email": f"imported-{suffix}-6@localhost",
+            "full_name": "Imported 6",
+            "password": "imported-6",
+        },
+        {
+            "login": f"imported-{suffix}-7",
+            "email": f"imported-{suffix}-7@localhost",
+            "full_name": "Imported 7",
+            "password": 7,
+        },
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users:import",
+        data=body.encode("utf-8"),
+        headers=dict(headers, **{"Content-Type": "application/x-ndjson"}),
+    )
+    assert ans.status_code == 200
+    data = ans.json()
+    assert data["created"] == 2
+    items = data["items"]
+    assert [item.get("result") for item in items[:3]] == [
+        "created",
+        "created",
+        "conflict",
+    ]
+    assert all("error" in item for item in items[3:8])
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login",
+        params={"login": f"imported-{suffix}-1", "password": "imported-1"},
+    )
+    assert ans.status_code == 200
+
+
+def test_export():
+    """Потоковая выгрузка пользователей и истории входов в NDJSON"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/export", headers=headers, stream=True
+    )
+    assert ans.status_code == 200
+    assert ans.headers["Content-Type"].startswith("application/x-ndjson")
+    logins = [json.loads(line)["login"] for line in ans.iter_lines() if line]
+    assert "admin" in logins
+    assert logins == sorted(logins)
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/history/export", headers=headers, stream=True
+    )
+    assert ans.status_code == 200
+    history = [json.loads(line) for line in ans.iter_lines() if line]
+    assert len(history) >= 1
+    timestamps = [h["timestamp"] for h in history]
+    assert timestamps == sorted(timestamps, reverse=True)
+
+
+def test_history_daily():
+    """Дневная сводка входов возвращается списком по дням"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/history/daily?days=7", headers=headers
+    )
+    assert ans.status_code == 200
+    data = ans.json()
+    assert isinstance(data, list)
+    assert [d["day"] for d in data] == sorted(d["day"] for d in data)
+    ans = requests.get(
+        f"http://{AUTH_API_HOST}/v1/users/history/daily?days=week", headers=headers
+    )
+    assert ans.status_code == 400
+
+
+def test_register_invalid_body():
+    """Тело запроса, не соответствующее схеме, отклоняется до обработчика"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/register",
+        json={"login": 42, "email": f"{uuid.uuid4()}@localhost", "password": "x"},
+    )
+    assert ans.status_code == 400
+    assert "login" in ans.json()["error"]
+
+
+def test_jwks():
+    """Токен подписан ключом, опубликованным в JWKS"""
+    ans = requests.get(f"http://{AUTH_API_HOST}/.well-known/jwks.json")
+    assert ans.status_code == 200
+    assert "max-age" in ans.headers["Cache-Control"]
+    kids = {key["kid"] for key in ans.json()["keys"]}
+    ans_cached = requests.get(
+        f"http://{AUTH_API_HOST}/.well-known/jwks.json",
+        headers={"If-None-Match": ans.headers["ETag"]},
+    )
+    assert ans_cached.status_code == 304
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    header = ans.json()["access_token"].split(".")[0]
+    header = json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4)))
+    assert header["alg"] == "RS256"
+    assert header["kid"] in kids
+
+
+def test_introspect():
+    """Пакетная проверка токенов видит отзыв сразу после выхода"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=nobody&password={os.getenv('NOBODY_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    tokens = ans.json()
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/users/login?login=admin&password={os.getenv('ADMIN_PASSWORD')}"
+    )
+    assert ans.status_code == 200
+    admin_headers = {"Authorization": "Bearer " + ans.json()["access_token"]}
+    batch = [tokens["access_token"], tokens["refresh_token"], "junk"]
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/tokens/introspect",
+        json={"tokens": batch},
+        headers=admin_headers,
+    )
+    assert ans.status_code == 200
+    items = ans.json()["items"]
+    assert [item["active"] for item in items] == [True, True, False]
+    assert items[0]["claims"]["type"] == "access"
+    assert items[2]["reason"] == "invalid"
+    ans = requests.delete(
+        f"http://{AUTH_API_HOST}/v1/users/logout",
+        headers={"Authorization": "Bearer " + tokens["access_token"]},
+    )
+    assert ans.status_code == 200
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/tokens/introspect",
+        json={"tokens": batch},
+        headers=admin_headers,
+    )
+    items = ans.json()["items"]
+    assert [item["active"] for item in items] == [False, False, False]
+    assert items[0]["reason"] == "revoked"
+
+
+def test_introspect_requires_auth():
+    """Пакетная проверка токенов недоступна без токена или секрета сервиса"""
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/tokens/introspect", json={"tokens": ["junk"]}
+    )
+    assert ans.status_code == 401
+    ans = requests.post(
+        f"http://{AUTH_API_HOST}/v1/tokens/introspect",
+        json={"tokens": ["junk"]},
+        headers={"X-Service-Secret": "wrong"},
+    )
+    assert ans.status_code == 401
+
+
+def test_metrics():
+    """Метрики запросов отдаются в формате Prometheus"""
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/")
+    assert ans.status_code == 200
+    ans = requests.get(f"http://{AUTH_API_HOST}/metrics")
+    assert ans.status_code == 200
+    assert ans.headers["Content-Type"].startswith("text/plain")
+    assert 'endpoint="users_bp.list_users"' in ans.text
+    assert "auth_sql_statements_per_request_bucket" in ans.text
+
+
+def test_server_timing():
+    """При профилировании SQL в ответ добавляется заголовок Server-Timing"""
+    ans = requests.get(f"http://{AUTH_API_HOST}/v1/users/")
+    assert ans.status_code == 200
+    timing = ans.headers["Server-Timing"]
+    assert timing.startswith("sql;dur=")
+    assert "app;dur=" in timing
+
+
+def test_health():
+    """Процесс жив и готов: база, миграции и Redis проверены"""
+    ans = requests.get(f"http://{AUTH_API_HOST}/healthz")
+    assert ans.status_code == 200
+    ans = requests.get(f"http://{AUTH_API_HOST}/readyz")
+    assert ans.status_code == 200
+    assert ans.json()["checks"] == {"database": "ok", "redis": "ok"}
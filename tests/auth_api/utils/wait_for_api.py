@@ -1,8 +1,8 @@
 #! /usr/bin/env python
 
 """
-Дождаться, пока будет доступен сервер auth_api по адресу
-os.getenv('AUTH_API_HOST')
+Дождаться, пока сервер auth_api по адресу os.getenv('AUTH_API_HOST')
+будет готов принимать запросы (/readyz)
 """
 
 import logging
@@ -18,23 +18,21 @@ def wait_for_auth_api(url: str = None, *, logger=None):
     """
     Дождаться пока по адресу url заработает сервер auth_api
     """
-    url = url or f"http://{API_HOST}/test"
+    url = url or f"http://{API_HOST}/readyz"
     while True:
-        # Делаем пазузу для старта сервисов
-        sleep(5)
         try:
             ans = requests.get(url)
         except requests.ConnectionError:
             if logger:
                 logger.warning("Соединения с auth_api нет, попробуем позже")
-            sleep(5)
+            sleep(1)
             continue
         if ans.status_code != 200:
             if logger:
                 logger.warning(
                     f"Ответ auth_api имеет код отличный от 200, попробуем позже"
                 )
-            sleep(5)
+            sleep(1)
             continue
         if logger:
             logger.warning("Сервис auth_api готов к работе")